@@ -1,40 +1,17 @@
 '''
 File: 3pg.py
 Author: joeyzhou1984@gmail.com
-Description: the entry point of 3-PG model
+Description: the entry point of 3-PG model, runnable from any directory;
+    the command line lives in lib/cli.py (the 3pg command once installed)
 Created: 2012-01-02
 LastModified: 2012-01-02
 '''
 
+import os
 import sys
-sys.path.append('../lib')
-from Model3PG import Model3PG
-
-
-def read_control_file(fpath):
-    model = Model3PG(fpath)
-    model.initialize()
-    return model
-
-
-def run_3pg(fpath_control):
-    # read the control file
-    try:
-        model_3pg = read_control_file(fpath_control)
-    except:
-        print('%s is not a valid control file.' % fpath_control)
-        return
-    model_3pg.run()
-
-
-def main(argv):
-    if len(argv) == 1:
-        print('Please provide at least one control file for running the model')
-        # run_3pg('run1.yaml')
-    else:
-        for fpath in argv[1:]:
-            run_3pg(fpath)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from cli import main
 
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,64 @@
+'''
+File: bench.py
+Description: throughput benchmark of the 3-PG model, JSON report
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from benchmark import run_benchmarks, compare_reports
+
+
+def parse_ints(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='benchmark the 3-PG model on synthetic stands and climate')
+    parser.add_argument('--stands', type=parse_ints, default=[1, 100, 10000],
+            help='comma separated numbers of stands')
+    parser.add_argument('--years', type=parse_ints, default=[10, 100, 1000],
+            help='comma separated numbers of simulated years')
+    parser.add_argument('--budget', type=int, default=2000000,
+            help='skip scales above this many stand-months')
+    parser.add_argument('--engines', default='scalar,kernel,batch',
+            help='comma separated engines among scalar, kernel and batch')
+    parser.add_argument('--workdir', help='scratch directory, a temporary one by default')
+    parser.add_argument('-o', '--output', help='JSON report, printed when omitted')
+    parser.add_argument('--baseline', help='earlier JSON report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help='relative slowdown tolerated against the baseline')
+    args = parser.parse_args(argv[1:])
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench3pg_')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        report = run_benchmarks(workdir, args.stands, args.years, args.budget,
+                args.engines.split(','))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as handler:
+            handler.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as handler:
+            regressions = compare_reports(report, json.load(handler), args.tolerance)
+        for name, before, now in regressions:
+            print('regression: %s %.4g -> %.4g' % (name, before, now))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,89 @@
+'''
+File: calibrate.py
+Description: calibration of 3-PG parameters against observed stand data,
+    JSON report
+'''
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from framework import load_config
+from calibration import Objective, read_observations, differential_evolution, metropolis
+
+
+def parse_bound(text):
+    """name:low:high"""
+    try:
+        name, low, high = text.split(':')
+        low, high = float(low), float(high)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected name:low:high, got %s' % text)
+    if not low < high:
+        raise argparse.ArgumentTypeError('empty bounds for %s' % name)
+    return name, (low, high)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='fit parameters of a control file to observations')
+    parser.add_argument('config', help='control file of the stand')
+    parser.add_argument('observations', help='observation file, see lib/calibration.py')
+    parser.add_argument('-p', '--param', type=parse_bound, action='append', required=True,
+            help='calibrated parameter and its bounds, name:low:high, repeated')
+    parser.add_argument('--method', choices=['de', 'mcmc'], default='de',
+            help='differential evolution, or Metropolis sampling started from its result')
+    parser.add_argument('--popsize', type=int, default=15, help='members per parameter')
+    parser.add_argument('--generations', type=int, default=100)
+    parser.add_argument('--steps', type=int, default=1000, help='steps of every chain')
+    parser.add_argument('--chains', type=int, default=8)
+    parser.add_argument('--step', type=float, default=0.05,
+            help='proposal sd relative to the widths of the bounds')
+    parser.add_argument('--relative-sd', type=float, default=0.1,
+            help='measurement error of the observations without sd')
+    parser.add_argument('--spinup-age', type=int,
+            help='simulate the stand up to this age once with the control file')
+    parser.add_argument('-j', '--workers', type=int, help='processes running the batches')
+    parser.add_argument('--batch-size', type=int, default=500,
+            help='parameter sets run together in one batched run')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--samples', help='.npy file of the chains, (step, chain, parameter)')
+    parser.add_argument('-o', '--output', help='JSON report, printed when omitted')
+    args = parser.parse_args(argv[1:])
+
+    names = [name for name, bounds in args.param]
+    bounds = [bounds for name, bounds in args.param]
+    config = load_config(args.config)
+    observations = read_observations(args.observations, args.relative_sd)
+    with Objective(config, names, observations, args.batch_size, args.workers,
+            args.spinup_age) as objective:
+        result = differential_evolution(objective, bounds, args.popsize,
+                args.generations, seed=args.seed)
+        report = {'parameters': dict(zip(names, result.x.tolist())),
+                'cost': result.cost, 'history': result.history}
+        if args.method == 'mcmc':
+            sample = metropolis(objective, bounds, args.steps, args.chains, args.step,
+                    result.x, args.seed)
+            kept = sample.samples[args.steps // 2:].reshape(-1, len(names))
+            report['posterior'] = dict((name, {'mean': float(np.mean(kept[:, i])),
+                'sd': float(np.std(kept[:, i]))}) for i, name in enumerate(names))
+            report['acceptance'] = sample.acceptance.tolist()
+            if args.samples:
+                np.save(args.samples, sample.samples)
+        report['evaluations'] = objective.evaluations
+        report['memoized'] = objective.hits
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as handler:
+            handler.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
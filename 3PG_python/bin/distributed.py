@@ -0,0 +1,80 @@
+'''
+File: distributed.py
+Description: distributed 3-PG runs over a work queue in a shared directory,
+    see lib/workqueue.py
+
+    distributed.py submit QUEUE MANIFEST --shard-size 1000
+    distributed.py work QUEUE -j 8          (on every node)
+    distributed.py status QUEUE
+    distributed.py merge QUEUE outputs.npy summary.txt
+'''
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+import workqueue
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='run the stands of a manifest over many nodes')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    submit = commands.add_parser('submit', help='split a manifest into queued shards')
+    submit.add_argument('queue', help='queue directory, on a filesystem shared by the nodes')
+    submit.add_argument('manifest', help='file listing control files, one per line')
+    submit.add_argument('--shard-size', type=int, default=1000, help='stands per shard')
+    submit.add_argument('--lease', type=float, default=600,
+            help='seconds without heartbeat after which a shard is taken back')
+    submit.add_argument('--attempts', type=int, default=3, help='attempts of a shard')
+    submit.add_argument('--straggler-factor', type=float, default=3.0,
+            help='shards running longer than this times the median are stragglers')
+
+    work = commands.add_parser('work', help='run shards until the queue is empty')
+    work.add_argument('queue')
+    work.add_argument('-j', '--workers', type=int, default=1, help='worker processes')
+    work.add_argument('--max-shards', type=int, help='shards run by each worker')
+    work.add_argument('--wait', action='store_true',
+            help='keep polling while other workers hold leases')
+
+    status = commands.add_parser('status', help='progress, node throughput and stragglers')
+    status.add_argument('queue')
+    status.add_argument('--json', action='store_true', help='print the report as json')
+
+    merge = commands.add_parser('merge', help='consolidate the shard outputs')
+    merge.add_argument('queue')
+    merge.add_argument('output', help='.npy of (stands, months) records')
+    merge.add_argument('summary', help='status of every stand')
+    merge.add_argument('--partial', action='store_true',
+            help='merge even if shards are missing, their stands are NaN')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'submit':
+        queue = workqueue.submit(args.queue, args.manifest, args.shard_size,
+                args.lease, args.attempts, args.straggler_factor)
+        print('%d stands in %d shards' % (queue.job['n_stands'], queue.job['n_shards']))
+    elif args.command == 'work':
+        if args.workers == 1:
+            n_run = workqueue.work(args.queue, None, args.max_shards, args.wait)
+        else:
+            with ProcessPoolExecutor(args.workers) as executor:
+                n_run = sum(executor.map(workqueue.work, [args.queue] * args.workers,
+                    [None] * args.workers, [args.max_shards] * args.workers,
+                    [args.wait] * args.workers))
+        print('%d shards run' % n_run)
+    elif args.command == 'status':
+        report = workqueue.WorkQueue(args.queue).progress()
+        if args.json:
+            print(json.dumps(report, indent=1))
+        else:
+            print(workqueue.format_progress(report))
+    elif args.command == 'merge':
+        workqueue.merge(args.queue, args.output, args.summary, args.partial)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,46 @@
+'''
+File: serve.py
+Description: 3-PG simulation service, JSON run requests over HTTP
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from service import Service
+from resultcache import ResultCache
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0],
+            description='serve 3-PG runs from warm worker processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8030)
+    parser.add_argument('--socket', help='listen on this Unix socket instead of host:port')
+    parser.add_argument('-j', '--workers', type=int, help='worker processes, one per CPU by default')
+    parser.add_argument('--batch-window', type=float, default=0.005,
+            help='seconds to wait for more requests to batch together')
+    parser.add_argument('--max-batch', type=int, default=256,
+            help='largest number of requests in one batched run')
+    parser.add_argument('--preload', nargs='*', default=[],
+            help='control files whose climate the workers load at startup')
+    parser.add_argument('--cache', metavar='DIR',
+            help='answer repeated runs from a result cache in this directory')
+    parser.add_argument('--cache-size', type=float, default=1024,
+            help='size bound of the result cache, in MB')
+    args = parser.parse_args(argv[1:])
+
+    cache = None
+    if args.cache:
+        cache = ResultCache(args.cache, int(args.cache_size * (1 << 20)))
+    service = Service(args.workers, args.batch_window, args.max_batch, args.preload,
+            cache)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
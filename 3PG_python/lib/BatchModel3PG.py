@@ -0,0 +1,311 @@
+from __future__ import division
+
+import warnings
+from math import pi
+
+import numpy as np
+
+from framework import Model, create_keeper, load_config, precisions, read_precision
+from parameters import compile_parameters, stack_parameters
+from climate import load_climate
+from checkpoint import load_checkpoint
+from utils import get_stand_age
+
+from CanopyProduction import canopy_production_batch
+from BiomassPartition import biomass_partition
+from WaterBalance import water_balance_batch
+from StemMortality import stem_mortality_batch, calc_factors_age_batch
+from Model3PG import mapper, count_steps
+from outputs import plan_outputs
+from management import BatchSchedule, management_events
+from drivers import batch_drivers
+
+
+def partition_stands(T_av, LAI, elev, CaMonthly, D13Catm,
+        WF, WR, WS, TotalLitter, NPP, GPPmolc, stand_age, month, avDBH,
+        modifier_physiology, VPD, d18Osrc,
+        canopy_conductance, canopy_transpiration_sec, configs):
+    # biomass_partition is scalar only, so it is evaluated stand by stand
+    n_stands = len(configs)
+    before = [np.broadcast_to(v, (n_stands,)).tolist() for v in (T_av, LAI, elev,
+            CaMonthly, D13Catm, WF, WR, WS, TotalLitter, NPP, GPPmolc, stand_age)]
+    after = [np.broadcast_to(v, (n_stands,)).tolist() for v in (avDBH,
+            modifier_physiology, VPD, d18Osrc,
+            canopy_conductance, canopy_transpiration_sec)]
+    res = []
+    for i, config in enumerate(configs):
+        res.append(biomass_partition(*([v[i] for v in before] + [month] +
+                [v[i] for v in after] + [config])))
+    return tuple(np.array(column) for column in zip(*res))
+
+
+class BatchModel3PG(Model):
+    """run the 3-PG model for many stands at once,
+    the stand state is held in numpy arrays over the stand axis
+
+    With the precision float32 the climate series, the climate drivers,
+    the state carried from month to month and the outputs are float32
+    arrays, halving their memory. The parameters and the stand age stay
+    float64, so the terms of a month are evaluated in float64 and rounded
+    once at its end, and the self-thinning solve, the power laws of the
+    stand update and the soil water modifier take float64 inputs
+    (see accuracy.py for the resulting error)."""
+
+    def __init__(self, settings, fpath_output=None, exact_thinning=False,
+            resume_from=None, sink=None, data=None, events=None, precision=None,
+            verbose=False):
+        """settings is a list of control file paths or of configs
+        already returned by load_config, one per stand; exact_thinning
+        solves the self-thinning to convergence (see getMortality_batch);
+        resume_from is a checkpoint to start all the stands from, and sink
+        a callable receiving the output blocks (see Model3PG); data is a
+        list of climate.Climate, one per stand, replacing the [IO] inputs,
+        and events a list of management events (see management.py), one
+        per stand, replacing the [IO] management files; precision (float64
+        or float32) overrides the [IO] option precision; verbose prints the
+        simulated years as they go"""
+        configs = [load_config(setting) if isinstance(setting, str) else setting
+                for setting in settings]
+        fpath_setting = settings[0] if isinstance(settings[0], str) else None
+        super(BatchModel3PG, self).__init__(fpath_setting, configs[0])
+        self.configs = configs
+        self.fpath_output = fpath_output
+        self.exact_thinning = exact_thinning
+        self.resume_from = resume_from
+        self.sink = sink
+        self.data = data
+        self.events = events
+        self.precision = precision
+        self.verbose = verbose
+        # (year, month, stand indices) whose self-thinning did not converge
+        # in the last run
+        self.not_converged = []
+        self.initialize()
+
+    @property
+    def n_stands(self):
+        return len(self.configs)
+
+    def initialize(self):
+        if self.precision is None:
+            self.precision = read_precision(self.config.IO)
+        elif self.precision not in precisions:
+            raise ValueError('unknown precision %s, expected float64 or float32' % self.precision)
+
+        self.params = stack_parameters([compile_parameters(config)
+            for config in self.configs])
+
+        if self.data is None:
+            fpaths_input = [config.IO.input for config in self.configs]
+            unique_inputs = sorted(set(fpaths_input))
+            cache_dir = getattr(self.config.IO, 'climate_cache', None)
+            self.data = [load_climate(fpath, cache_dir) for fpath in unique_inputs]
+            self.climate_index = np.array([unique_inputs.index(fpath) for fpath in fpaths_input])
+        else:
+            self.climate_index = np.arange(self.n_stands)
+
+        self.checkpoint = None
+        if self.resume_from:
+            self.checkpoint = load_checkpoint(self.resume_from)
+
+        if self.events is None:
+            cache = {}
+            self.events = [management_events(config.IO, cache) for config in self.configs]
+        if len(self.events) != self.n_stands:
+            raise ValueError('expected the management events of %d stands' % self.n_stands)
+
+        self.plan = plan_outputs(self.config.Output, mapper)
+        self.keeper = create_keeper(self.config.IO, self.fpath_output, self.n_stands,
+                self.sink, self.precision)
+        self.keeper.initialize(self.config.Output,
+                count_steps(self.config, self.params, self.checkpoint))
+
+    def teardown(self):
+        self.data = None
+        self.keeper.shutdown()
+
+    def run(self):
+        self.not_converged = []
+        params = self.params
+        params_time = params.TimeRange
+        params_initial = params.InitialState
+        params_stem = params.StemMortality
+        n_stands = self.n_stands
+
+        EndYear = params_time.endyear
+        InitialYear = params_time.initialyear
+        InitialMonth = params_time.initialmonth
+        YearPlanted = params_time.yearplanted
+        MonthPlanted = params_time.monthplanted
+        EndAge = params_time.endage
+
+        # Assign initial state of stands
+        stand_ages = [get_stand_age(config.SiteCharacteristics.lat,
+                        InitialYear, InitialMonth,
+                        YearPlanted, MonthPlanted, EndAge) for config in self.configs]
+        stand_age = np.array([ages[0] for ages in stand_ages])
+        StartAge, InitialYear, InitialMonth, MonthPlanted = stand_ages[0][1:]
+
+        elev = params.SiteCharacteristics.elev
+        dtype = np.dtype(self.precision)
+        compact = dtype != np.float64
+
+        # climate series by column name, (climate file, month)
+        def stack_column(name):
+            return np.array([climate.column(name) for climate in self.data], dtype=dtype)
+        series_T_av = stack_column('Tav')
+        series_VPD = stack_column('VPD')
+        series_rain = stack_column('Rain')
+        series_solar_rad = stack_column('Solar rad')
+        series_CaMonthly = stack_column('Ca')
+        series_D13Catm = stack_column('D13Catm')
+        series_d18Osrc = stack_column('d18O')
+        climate_index = self.climate_index
+        shrub = self.plan.shrub
+        # climate terms of the modules, by (distinct climate and parameters, row)
+        drivers, driver_index = batch_drivers(self.data, climate_index, params,
+                np.broadcast_to(params.SiteCharacteristics.lat, (n_stands,)), InitialMonth)
+        if compact:
+            drivers = drivers.astype(dtype)
+        schedule = doThinning = doDefoliation = None
+        if any(self.events):
+            schedule = BatchSchedule(self.events)
+            doThinning = schedule.thinning
+            doDefoliation = schedule.defoliation
+
+        # do annual calculation
+        metMonth = InitialMonth
+        if self.checkpoint is not None:
+            # the saved state, scalar or per stand, copied to every stand
+            state = dict((name, np.array(np.broadcast_to(value, (n_stands,)), dtype=np.float64))
+                    for name, value in self.checkpoint.state.items())
+            WF = state['WF']
+            WR = state['WR']
+            WS = state['WS']
+            StemNo = state['StemNo']
+            ASW = state['ASW']
+            LAI = state['LAI']
+            stand_age = state['stand_age']
+            TotalLitter = state['TotalLitter']
+            delStemNo = state['delStemNo']
+            avDBH = state['avDBH']
+            AvStemMass = state['AvStemMass']
+            BasArea = state['BasArea']
+            StandVol = state['StandVol']
+            MAI = state['MAI']
+            Height = state['Height']
+            CounterforShrub = state['CounterforShrub']
+            irrig = state['irrig']
+            l = 0
+            StartAge = self.checkpoint.year + 1
+            metMonth = self.checkpoint.metMonth
+            if schedule is not None:
+                schedule.seek(stand_age)
+        for year in range(StartAge, EndAge + 1):
+            if self.verbose:
+                print('year', year)
+
+            # do monthly calculations
+            month = InitialMonth
+            for month_counter in range(1, 12 + 1):
+                if (year == 0) and (month == InitialMonth):
+                    WS = params_initial.initialws.copy()
+                    WF = params_initial.initialwf.copy()
+                    WR = params_initial.initialwr.copy()
+                    StemNo = params_initial.initialstocking.copy()
+                    ASW = params_initial.initialasw.copy()
+                    TotalLitter = np.zeros(n_stands)
+                    irrig = 0                                       # Ml/ha/year, no irrigation
+
+                    SLA, fracBB = calc_factors_age_batch(stand_age, params_stem.sla0,
+                            params_stem.sla1, params_stem.tsla,
+                            params_stem.fracbb0, params_stem.fracbb1, params_stem.tbb)
+                    AvStemMass = WS * 1000 / StemNo                 # kg/tree
+                    avDBH = (AvStemMass / params_stem.stemconst) ** (1 / params_stem.stempower)
+                    BasArea = (((avDBH / 200) ** 2) * pi) * StemNo
+                    LAI = WF * SLA * 0.1
+                    StandVol = WS * (1 - fracBB) / params_stem.density
+                    MAI = np.where(stand_age > 0,
+                            StandVol / np.where(stand_age > 0, stand_age, 1), 0.0)
+
+                    Height = D13CTissue = NPP = InterCiPPM = delWF = delWR = delWS = 0
+                    d18Oleaf = d18Ocell = d18Ocell_peclet = canopy_conductance = GPPdm = 0
+                    transp = loss_water = canopy_transpiration_sec = l = 0
+                    LAIShrub = transpall = transpshrub = 0
+                    modifiers = 7 * [0]
+                    delStemNo = np.zeros(n_stands)
+                    modifier_physiology = 0
+                    PAR = 0
+                    CounterforShrub = params.ShrubEffect.counterforshrub
+                else:
+                    if month >= 12:
+                        month = 1
+
+                    T_av = series_T_av[climate_index, metMonth]
+                    VPD = series_VPD[climate_index, metMonth]
+                    rain = series_rain[climate_index, metMonth]
+                    solar_rad = series_solar_rad[climate_index, metMonth]
+                    month_drivers, day_length, days_in_month = drivers.take(driver_index, metMonth)
+                    CaMonthly = series_CaMonthly[climate_index, metMonth]
+                    D13Catm = series_D13Catm[climate_index, metMonth]
+                    d18Osrc = series_d18Osrc[climate_index, metMonth]
+
+                    # the scalar model restarts the shrub counter from the config every month
+                    CounterforShrub = None
+
+                    # Canopy Production Module
+                    PAR, APAR, APARu, \
+                        GPPmolc, GPPdm, NPP, \
+                        modifiers, LAIShrub, \
+                        CounterforShrub, canopy_conductance = canopy_production_batch(T_av, VPD,
+                                    ASW, None, stand_age,
+                                    LAI, solar_rad, days_in_month, CounterforShrub, params, shrub,
+                                    month_drivers)
+
+                    # Water Balance Module
+                    transpall, transp, transpshrub, loss_water, ASW, \
+                        monthlyIrrig, canopy_transpiration_sec = water_balance_batch(solar_rad, VPD,
+                                day_length, LAI, rain, irrig,
+                                days_in_month, ASW, canopy_conductance, LAIShrub, params, shrub)
+
+                    # Biomass Partion Module
+                    modifier_physiology = modifiers[-1]
+                    WF, WR, WS, TotalW, TotalLitter, \
+                        D13CTissue, InterCiPPM, \
+                        delWF, delWR, delWS, d18Oleaf, d18Ocell, \
+                        d18Ocell_peclet = partition_stands(T_av, LAI,
+                                elev, CaMonthly, D13Catm,
+                                WF, WR, WS, TotalLitter,
+                                NPP, GPPmolc, stand_age, month, avDBH,
+                                modifier_physiology, VPD, d18Osrc,
+                                canopy_conductance, canopy_transpiration_sec, self.configs)
+
+                    # Stem Mortality Module
+                    stand_age, LAI, MAI, \
+                        avDBH, BasArea, Height, \
+                        StemNo, delStemNo, StandVol, \
+                        WF, WR, WS, AvStemMass, \
+                        not_converged = stem_mortality_batch(WF, WR, WS, StemNo, delStemNo,
+                                    stand_age, params, self.exact_thinning,
+                                    doThinning, doDefoliation)
+                    if not_converged.size:
+                        self.not_converged.append((year, month, not_converged))
+
+                if compact:
+                    # the state carried to the next month, the stand age is
+                    # kept in float64 for the ages of the management events
+                    WF, WR, WS, StemNo, ASW, LAI, TotalLitter, delStemNo, \
+                        avDBH, AvStemMass, BasArea, StandVol, MAI, Height = [
+                            np.asarray(v, dtype) for v in (WF, WR, WS, StemNo, ASW,
+                            LAI, TotalLitter, delStemNo, avDBH, AvStemMass,
+                            BasArea, StandVol, MAI, Height)]
+
+                self.keeper.keep(mapper, locals())
+
+                metMonth = metMonth + 1
+                month = month + 1
+
+        if self.not_converged:
+            stands = np.unique(np.concatenate([s for _, _, s in self.not_converged]))
+            warnings.warn('self-thinning did not converge in %d months, over %d stands '
+                    '(see BatchModel3PG.not_converged)' % (len(self.not_converged), stands.size))
@@ -3,7 +3,9 @@ Canopy Production Module
 """
 from __future__ import division
 from math import exp
-from utils import get_days_in_month
+
+import numpy as np
+
 from constants import molPAR_MJ, gDM_mol
 
 def calc_modifier_temp(T_av, T_min, T_max, T_opt):
@@ -59,29 +61,38 @@ def calc_canopy_cover(stand_age, LAI, fullCanAge, canpower, k):
 
     return canopy_cover, light_interception
 
+def calc_conductance_temperature(T_av, TK2, TK3):
+    # temperature modifier of the canopy conductance_ Liang Wei
+    return max(0, min(1, TK2 + TK3 * T_av))
+
+
 #added modifier_frost here -Danielle
-def calc_canopy_conductance(T_av, LAI, modifier_frost, modifier_physiology,
-        TK2, TK3, MaxCond, LAIgcx):
+def calc_canopy_conductance(conductance_temperature, LAI, modifier_frost,
+        modifier_physiology, MaxCond, LAIgcx):
     # calculate canopy conductance from stomatal conductance
     # with added temperature modifier_ Liang Wei
 	#added modifier_frost here -Danielle
-    canopy_conductance = max(0, min(1, TK2 + TK3 * T_av)) * \
+    canopy_conductance = conductance_temperature * \
         MaxCond * modifier_frost * modifier_physiology * min(1, LAI / LAIgcx)
     if canopy_conductance == 0:
         canopy_conductance = 0.0001
     return canopy_conductance
 
 
-def calc_canopy_production(solar_rad, month,
+def calc_PAR(solar_rad, days_in_month):
+    RAD = solar_rad * days_in_month        # MJ/m^2
+    PAR = RAD * molPAR_MJ                      # mol/m^2
+    return PAR
+
+
+def calc_canopy_production(PAR,
         light_interception, canopy_cover,
         modifier_physiology, modifier_nutrition,
         modifier_temperature, modifier_frost,
         alpha, y):
     # Determine gross and net biomass production
-    # Calculate PAR, APAR, APARu and GPP
+    # Calculate APAR, APARu and GPP from PAR
 
-    RAD = solar_rad * get_days_in_month(month)        # MJ/m^2
-    PAR = RAD * molPAR_MJ                      # mol/m^2
     APAR = PAR * light_interception * canopy_cover
     APARu = APAR * modifier_physiology
     alphaC = alpha * modifier_nutrition * modifier_temperature * modifier_frost
@@ -93,62 +104,71 @@ def calc_canopy_production(solar_rad, month,
 
 
 def canopy_production(T_av, VPD, ASW, frost_days, stand_age,
-        LAI, solar_rad, month, CounterforShrub, config):
-    
-    config_canopy = config.CanopyProduction
-    config_shrub = config.ShrubEffect
-    config_bio = config.BiomassPartition
+        LAI, solar_rad, days_in_month, CounterforShrub, params, shrub=True,
+        drivers=None):
+    """the shrub layer is evaluated only if shrub, LAIShrub is None otherwise;
+    drivers are the climate terms of the month precomputed by
+    drivers.climate_drivers, replacing T_av, VPD, frost_days and solar_rad"""
+    params_canopy = params.CanopyProduction
+    params_shrub = params.ShrubEffect
+    params_bio = params.BiomassPartition
 
-    T_min = float(config_canopy.t_min)
-    T_max = float(config_canopy.t_max)
-    T_opt = float(config_canopy.t_opt)
+    T_min = params_canopy.t_min
+    T_max = params_canopy.t_max
+    T_opt = params_canopy.t_opt
 
-    CoeffCond = float(config_canopy.coeffcond)
+    CoeffCond = params_canopy.coeffcond
 
-    MaxASW = float(config_canopy.maxasw)
-    SWconst = float(config_canopy.swconst0)
-    SWpower = float(config_canopy.swpower0)
+    MaxASW = params_canopy.maxasw
+    SWconst = params_canopy.swconst0
+    SWpower = params_canopy.swpower0
 
-    FR = float(config_canopy.fr)
-    fN0 = float(config_canopy.fn0)
+    FR = params_canopy.fr
+    fN0 = params_canopy.fn0
 
-    kF = float(config_canopy.kf)
+    kF = params_canopy.kf
 
-    MaxAge = float(config_canopy.maxage)
-    rAge = float(config_canopy.rage)
-    nAge = float(config_canopy.nage)
+    MaxAge = params_canopy.maxage
+    rAge = params_canopy.rage
+    nAge = params_canopy.nage
     
-    TK2 = float(config_bio.tk2)
-    TK3 = float(config_bio.tk3)
-    MaxCond = float(config_bio.maxcond)
-    LAIgcx = float(config_bio.laigcx)
+    TK2 = params_bio.tk2
+    TK3 = params_bio.tk3
+    MaxCond = params_bio.maxcond
+    LAIgcx = params_bio.laigcx
 
-    fullCanAge = float(config_canopy.fullcanage)
-    canpower = float(config_canopy.canpower)
-    k = float(config_canopy.k)
+    fullCanAge = params_canopy.fullcanage
+    canpower = params_canopy.canpower
+    k = params_canopy.k
 
-    alpha = float(config_canopy.alpha)
-    y = float(config_canopy.y)
+    alpha = params_canopy.alpha
+    y = params_canopy.y
 
     if CounterforShrub is None:
-        CounterforShrub = float(config_shrub.counterforshrub)
-    KL = float(config_shrub.kl)
-    Lsx = float(config_shrub.lsx)
-
-    modifier_temperature = calc_modifier_temp(T_av, T_min, T_max, T_opt)
-    modifier_VPD = calc_modifier_VPD(VPD, CoeffCond)
+        CounterforShrub = params_shrub.counterforshrub
+    KL = params_shrub.kl
+    Lsx = params_shrub.lsx
+
+    if drivers is None:
+        modifier_temperature = calc_modifier_temp(T_av, T_min, T_max, T_opt)
+        modifier_VPD = calc_modifier_VPD(VPD, CoeffCond)
+        modifier_frost = calc_modifier_frost(frost_days, kF)
+        modifier_nutrition = calc_modifier_soilnutrition(FR, fN0)
+        conductance_temperature = calc_conductance_temperature(T_av, TK2, TK3)
+        PAR = calc_PAR(solar_rad, days_in_month)
+    else:
+        modifier_temperature, modifier_VPD, modifier_frost, modifier_nutrition, \
+            conductance_temperature, PAR = drivers
     modifier_soilwater = calc_modifier_soilwater(ASW, MaxASW, SWconst, SWpower)
-    modifier_nutrition = calc_modifier_soilnutrition(FR, fN0)
-    modifier_frost = calc_modifier_frost(frost_days, kF)
     modifier_age = calc_modifier_age(stand_age, MaxAge, rAge, nAge)
     modifier_physiology = calc_physiological_modifier(modifier_VPD,
             modifier_soilwater, modifier_age)
 
     canopy_cover, light_interception = calc_canopy_cover(stand_age, LAI, fullCanAge, canpower, k)
     #added modifier_frost here -Danielle
-    canopy_conductance = calc_canopy_conductance(T_av, LAI, modifier_frost, modifier_physiology,
-        TK2, TK3, MaxCond, LAIgcx)
-    PAR, APAR, APARu, GPPmolc, GPPdm, NPP = calc_canopy_production(solar_rad, month,
+    canopy_conductance = calc_canopy_conductance(conductance_temperature, LAI,
+        modifier_frost, modifier_physiology, MaxCond, LAIgcx)
+    PAR, APAR, APARu, GPPmolc, GPPdm, NPP = calc_canopy_production(PAR,
         light_interception, canopy_cover,
         modifier_physiology, modifier_nutrition,
         modifier_temperature, modifier_frost,
@@ -158,15 +178,107 @@ def canopy_production(T_av, VPD, ASW, frost_days, stand_age,
             modifier_soilwater, modifier_nutrition,
             modifier_frost, modifier_age, modifier_physiology]
 
-    if CounterforShrub == 0:
-        LsOpen = LAI * KL
-        LsClosed = Lsx * exp(-k * LAI)
-        LAIShrub = min(LsOpen, LsClosed)
-    elif CounterforShrub == 1:
-        LAIShrub = Lsx * exp(-k * LAI)
+    if not shrub:
+        LAIShrub = None
+    else:
+        if CounterforShrub == 0:
+            LsOpen = LAI * KL
+            LsClosed = Lsx * exp(-k * LAI)
+            LAIShrub = min(LsOpen, LsClosed)
+        elif CounterforShrub == 1:
+            LAIShrub = Lsx * exp(-k * LAI)
+
+        if LsClosed <= LsOpen:
+            CounterforShrub = 1
+
+
+    return PAR, APAR, APARu, GPPmolc, GPPdm, NPP, modifiers, LAIShrub, CounterforShrub, canopy_conductance
 
-    if LsClosed <= LsOpen:
-        CounterforShrub = 1
 
+def calc_modifier_temp_batch(T_av, T_min, T_max, T_opt):
+    # masked version of calc_modifier_temp, 0 outside of (T_min, T_max)
+    inside = (T_av > T_min) & (T_av < T_max)
+    T_in = np.where(inside, T_av, T_opt)
+    res = ((T_in - T_min) / (T_opt - T_min)) * \
+            ((T_max - T_in) / (T_max - T_opt)) ** \
+            ((T_max - T_opt) / (T_opt - T_min))
+    return np.where(inside, res, 0.0)
+
+
+def calc_canopy_cover_batch(stand_age, LAI, fullCanAge, canpower, k):
+    growing = (fullCanAge > 0) & (stand_age < fullCanAge)
+    safe_age = np.where(growing, fullCanAge, 1.0)
+    canopy_cover = np.where(growing, (stand_age / safe_age) ** canpower, 1.0)
+    light_interception = (1 - (np.exp(-1 * k * LAI)))
+    return canopy_cover, light_interception
+
+
+def calc_conductance_temperature_batch(T_av, TK2, TK3):
+    return np.clip(TK2 + TK3 * T_av, 0, 1)
+
+
+def calc_canopy_conductance_batch(conductance_temperature, LAI, modifier_frost,
+        modifier_physiology, MaxCond, LAIgcx):
+    canopy_conductance = conductance_temperature * \
+        MaxCond * modifier_frost * modifier_physiology * np.minimum(1, LAI / LAIgcx)
+    return np.where(canopy_conductance == 0, 0.0001, canopy_conductance)
+
+
+def canopy_production_batch(T_av, VPD, ASW, frost_days, stand_age,
+        LAI, solar_rad, days_in_month, CounterforShrub, params, shrub=True,
+        drivers=None):
+    """
+    Description:
+        array version of canopy_production, every argument except days_in_month
+        may be a numpy array over the stand axis, as may the options of
+        params (see parameters.stack_parameters) and the drivers.
+    """
+    params_canopy = params.CanopyProduction
+    params_shrub = params.ShrubEffect
+    params_bio = params.BiomassPartition
+
+    k = params_canopy.k
+
+    if drivers is None:
+        modifier_temperature = calc_modifier_temp_batch(T_av, params_canopy.t_min,
+                params_canopy.t_max, params_canopy.t_opt)
+        modifier_VPD = np.exp(-1 * params_canopy.coeffcond * VPD)
+        modifier_frost = calc_modifier_frost(frost_days, params_canopy.kf)
+        modifier_nutrition = calc_modifier_soilnutrition(params_canopy.fr, params_canopy.fn0)
+        conductance_temperature = calc_conductance_temperature_batch(T_av,
+                params_bio.tk2, params_bio.tk3)
+        PAR = calc_PAR(solar_rad, days_in_month)
+    else:
+        modifier_temperature, modifier_VPD, modifier_frost, modifier_nutrition, \
+            conductance_temperature, PAR = drivers
+    # in float64, the power law is steep near the wilting point
+    modifier_soilwater = calc_modifier_soilwater(np.asarray(ASW, dtype=np.float64),
+            params_canopy.maxasw, params_canopy.swconst0, params_canopy.swpower0)
+    modifier_age = calc_modifier_age(stand_age, params_canopy.maxage,
+            params_canopy.rage, params_canopy.nage)
+    modifier_physiology = np.minimum(modifier_VPD, modifier_soilwater) * modifier_age
+
+    canopy_cover, light_interception = calc_canopy_cover_batch(stand_age, LAI,
+            params_canopy.fullcanage, params_canopy.canpower, k)
+    canopy_conductance = calc_canopy_conductance_batch(conductance_temperature, LAI,
+            modifier_frost, modifier_physiology, params_bio.maxcond, params_bio.laigcx)
+    PAR, APAR, APARu, GPPmolc, GPPdm, NPP = calc_canopy_production(PAR,
+        light_interception, canopy_cover,
+        modifier_physiology, modifier_nutrition,
+        modifier_temperature, modifier_frost,
+        params_canopy.alpha, params_canopy.y)
+
+    modifiers = [modifier_temperature, modifier_VPD,
+            modifier_soilwater, modifier_nutrition,
+            modifier_frost, modifier_age, modifier_physiology]
+
+    if CounterforShrub is None:
+        CounterforShrub = params_shrub.counterforshrub
+    LAIShrub = None
+    if shrub:
+        LsOpen = LAI * params_shrub.kl
+        LsClosed = params_shrub.lsx * np.exp(-k * LAI)
+        LAIShrub = np.where(CounterforShrub == 0, np.minimum(LsOpen, LsClosed), LsClosed)
+        CounterforShrub = np.where(LsClosed <= LsOpen, 1, CounterforShrub)
 
     return PAR, APAR, APARu, GPPmolc, GPPdm, NPP, modifiers, LAIShrub, CounterforShrub, canopy_conductance
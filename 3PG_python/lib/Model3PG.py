@@ -1,12 +1,18 @@
 from __future__ import division
 
+import importlib.util
 import re
 from math import pi
 
-import numpy as np
-
-from framework import Model, BookKepper
-from utils import get_stand_age, get_day_length
+from framework import Model, create_keeper
+from parameters import compile_parameters
+from climate import load_climate, stream_climate
+from checkpoint import load_checkpoint, save_checkpoint
+from outputs import plan_outputs
+from management import Schedule, management_events
+from drivers import climate_drivers, parameter_values
+from utils import get_stand_age
+from lookup import day_length_table, days_in_month_table, month_index
 
 from CanopyProduction import canopy_production
 from BiomassPartition import biomass_partition
@@ -44,75 +50,216 @@ mapper = {"stand_age": "stand_age",
         "canopy_transpiration_sec": "canopy_transpiration_sec",
         "l": "l",
         "gppdm": "GPPdm",
-        "totallitter": "TotalLitter"}
+        "totallitter": "TotalLitter",
+        "laishrub": "LAIShrub",
+        "transpall": "transpall",
+        "transpshrub": "transpshrub"}
+
+def count_steps(config, params, checkpoint=None):
+    """number of monthly steps (and output rows) of a run,
+    resumed from checkpoint if given"""
+    params_time = params.TimeRange
+    StartAge = get_stand_age(config.SiteCharacteristics.lat,
+            params_time.initialyear, params_time.initialmonth,
+            params_time.yearplanted, params_time.monthplanted, params_time.endage)[1]
+    if checkpoint is not None:
+        StartAge = checkpoint.year + 1
+    return 12 * (params_time.endage - StartAge + 1)
+
 
 class Model3PG(Model):
-    def __init__(self, fpath_setting):
-        super(Model3PG, self).__init__(fpath_setting)
+    def __init__(self, fpath_setting, data=None, use_kernel=None, config=None,
+            resume_from=None, profiler=None, sink=None, verbose=True):
+        super(Model3PG, self).__init__(fpath_setting, config)
+        # checkpoint to continue from, instead of InitialState
+        self.resume_from = resume_from
+        # climate data already loaded by the caller, shared between runs,
+        # or a climate.ClimateStream
+        self.data = data
+        # callable receiving the output blocks, instead of the [IO] output
+        self.sink = sink
+        # use the compiled kernel, by default whenever numba is installed;
+        # kernel (and numba) are only imported by runs using it
+        if use_kernel is None:
+            use_kernel = importlib.util.find_spec('numba') is not None
+        self.use_kernel = use_kernel
+        # profiling.Profiler timing the modules, None to run them plainly
+        self.profiler = profiler
+        # print the simulated years as they go
+        self.verbose = verbose
         self.initialize()
 
     def initialize(self):
         fpath_input = self.config.IO.input
-        fpath_output = self.config.IO.output
 
-        self.data = np.loadtxt(fpath_input, skiprows=1)
-        self.keeper = BookKepper(fpath_output)
-        self.keeper.initialize(self.config.Output)
+        self.params = compile_parameters(self.config)
+        if self.data is None:
+            if int(getattr(self.config.IO, 'climate_stream', 0)):
+                self.data = stream_climate(fpath_input,
+                        int(getattr(self.config.IO, 'climate_chunk', 1200)))
+            else:
+                self.data = load_climate(fpath_input,
+                        getattr(self.config.IO, 'climate_cache', None))
+
+        # checkpoints, written every checkpoint_every years to the path
+        # pattern checkpoint, e.g. spinup_{year}.npz
+        config_io = self.config.IO
+        self.checkpoint_every = int(getattr(config_io, 'checkpoint_every', 0))
+        self.fpath_checkpoint = getattr(config_io, 'checkpoint', 'checkpoint_{year}.npz')
+        resume_from = self.resume_from or getattr(config_io, 'resume_from', None)
+        self.checkpoint = None
+        if resume_from:
+            self.checkpoint = load_checkpoint(resume_from)
+        # thinning and defoliation events, see management.py
+        self.events = management_events(config_io)
+
+        # diagnostics evaluated, after the outputs requested
+        self.plan = plan_outputs(self.config.Output, mapper)
+        self.keeper = create_keeper(self.config.IO, sink=self.sink)
+        self.keeper.initialize(self.config.Output,
+                count_steps(self.config, self.params, self.checkpoint))
 
     def teardown(self):
         self.data = None
         self.keeper.shutdown()
 
+    def step_functions(self):
+        """the monthly modules and the book keeper, timed by the profiler
+        if there is one"""
+        production_step = mortality_step = None
+        if self.use_kernel:
+            import kernel
+            production_step = kernel.production_step
+            mortality_step = kernel.mortality_step
+        functions = [('canopy_production', canopy_production),
+                ('water_balance', water_balance),
+                ('biomass_partition', biomass_partition),
+                ('stem_mortality', stem_mortality),
+                ('production_step', production_step),
+                ('mortality_step', mortality_step),
+                ('keep', self.keeper.keep)]
+        if self.profiler is None:
+            return [function for name, function in functions]
+        return [function and self.profiler.wrap(name, function)
+                for name, function in functions]
+
     def run(self):
-        config_time = self.config.TimeRange
-        config_site = self.config.SiteCharacteristics
-        config_initial = self.config.InitialState
-        config_stem = self.config.StemMortality
-
-        lat = float(config_site.lat)
-        EndYear = int(config_time. endyear)
-        InitialYear = int(config_time.initialyear)
-        InitialMonth = int(config_time.initialmonth)
-        YearPlanted = int(config_time.yearplanted)
-        MonthPlanted = int(config_time.monthplanted)
-        EndAge = int(config_time.endage)
+        params = self.params
+        params_time = params.TimeRange
+        params_initial = params.InitialState
+        params_stem = params.StemMortality
+
+        lat = params.SiteCharacteristics.lat
+        elev = params.SiteCharacteristics.elev
+        EndYear = params_time.endyear
+        InitialYear = params_time.initialyear
+        InitialMonth = params_time.initialmonth
+        YearPlanted = params_time.yearplanted
+        MonthPlanted = params_time.monthplanted
+        EndAge = params_time.endage
 
         nYears = EndYear - InitialYear + 1
         
         # Assign initial state of stand
         stand_age, StartAge, \
-            InitialYear, InitialMonth, MonthPlanted = get_stand_age(config_site.lat,
+            InitialYear, InitialMonth, MonthPlanted = get_stand_age(self.config.SiteCharacteristics.lat,
                         InitialYear, InitialMonth,
                         YearPlanted, MonthPlanted, EndAge)
 
+        # calendar terms of this site, by month_index
+        day_lengths = day_length_table(lat)
+
+        # positions of the climate columns in a row
+        climate = self.data
+        i_T_av = climate.position('Tav')
+        i_VPD = climate.position('VPD')
+        i_rain = climate.position('Rain')
+        i_solar_rad = climate.position('Solar rad')
+        i_frost_days = climate.position('Frost Days')
+        i_CaMonthly = climate.position('Ca')
+        i_D13Catm = climate.position('D13Catm')
+        i_d18Osrc = climate.position('d18O')
+
+        shrub = self.plan.shrub
+        use_kernel = self.use_kernel
+        if use_kernel:
+            import kernel
+            packed_params = kernel.pack_parameters(params)
+        # climate terms of the modules, by climate row (see drivers.py);
+        # not for a climate stream, nor for the kernel computing its own
+        drivers = None
+        if not use_kernel and climate.data is not None:
+            drivers = climate_drivers(climate, parameter_values(params),
+                    lat, InitialMonth, scalar=True).rows()
+
+        canopy_production, water_balance, biomass_partition, stem_mortality, \
+            production_step, mortality_step, keep = self.step_functions()
+        profiler = self.profiler
+        on_newton_iterations = None
+        if profiler is not None:
+            on_newton_iterations = profiler.newton_iterations
+        schedule = doThinning = doDefoliation = None
+        if self.events:
+            schedule = Schedule(self.events)
+            doThinning = schedule.thinning
+            doDefoliation = schedule.defoliation
+
         # do annual calculation
         metMonth = InitialMonth
+        if self.checkpoint is not None:
+            state = self.checkpoint.state
+            WF = state['WF']
+            WR = state['WR']
+            WS = state['WS']
+            StemNo = state['StemNo']
+            ASW = state['ASW']
+            LAI = state['LAI']
+            stand_age = state['stand_age']
+            TotalLitter = state['TotalLitter']
+            delStemNo = state['delStemNo']
+            avDBH = state['avDBH']
+            AvStemMass = state['AvStemMass']
+            BasArea = state['BasArea']
+            StandVol = state['StandVol']
+            MAI = state['MAI']
+            Height = state['Height']
+            CounterforShrub = state['CounterforShrub']
+            irrig = state['irrig']
+            l = 0
+            StartAge = self.checkpoint.year + 1
+            metMonth = self.checkpoint.metMonth
+            if schedule is not None:
+                schedule.seek(stand_age)
+        # climate rows, read one month at a time from metMonth on
+        records = climate.records(metMonth)
         for year in range(StartAge, EndAge + 1):
-            print('year', year)
+            if self.verbose:
+                print('year', year)
+            if profiler is not None:
+                profiler.year = year
 
             # do monthly calculations
             month = InitialMonth
             for month_counter in range(1, 12 + 1):
+                record = next(records, None)
                 if (year == 0) and (month == InitialMonth):
-                    WS = float(config_initial.initialws)
-                    WF = float(config_initial.initialwf)
-                    WR = float(config_initial.initialwr)
-                    StemNo = float(config_initial.initialstocking)
-                    ASW = float(config_initial.initialasw)
+                    WS = params_initial.initialws
+                    WF = params_initial.initialwf
+                    WR = params_initial.initialwr
+                    StemNo = params_initial.initialstocking
+                    ASW = params_initial.initialasw
                     TotalLitter = 0
-                    # thinEventNo = 1
-                    # defoltnEventNo = 1
                     irrig = 0 # TODO
 
-                    SLA0 = float(config_stem.sla0)
-                    SLA1 = float(config_stem.sla1)
-                    tSLA = float(config_stem.tsla)
-                    fracBB0 = float(config_stem.fracbb0)
-                    fracBB1 = float(config_stem.fracbb1)
-                    tBB = float(config_stem.tbb)
-                    StemConst = float(config_stem.stemconst)
-                    StemPower = float(config_stem.stempower)
-                    Density = float(config_stem.density)
+                    SLA0 = params_stem.sla0
+                    SLA1 = params_stem.sla1
+                    tSLA = params_stem.tsla
+                    fracBB0 = params_stem.fracbb0
+                    fracBB1 = params_stem.fracbb1
+                    tBB = params_stem.tbb
+                    StemConst = params_stem.stemconst
+                    StemPower = params_stem.stempower
+                    Density = params_stem.density
 
                     SLA, fracBB = calc_factors_age(stand_age, SLA0,
                             SLA1, tSLA, fracBB0, fracBB1, tBB)
@@ -130,54 +277,71 @@ class Model3PG(Model):
                     Height = D13CTissue = NPP = InterCiPPM = delWF = delWR = delWS = 0
                     d18Oleaf = d18Ocell = d18Ocell_peclet = canopy_conductance = GPPdm = 0
                     transp = loss_water = canopy_transpiration_sec = l = TotalLitter = 0
+                    LAIShrub = transpall = transpshrub = 0
                     modifiers = 7 * [0]
                     delStemNo = 0
                     modifier_physiology = 0
                     PAR = 0
                 else:
                     #print 'month', month
-                    config_site = self.config.SiteCharacteristics
-
-                    lat = float(config_site.lat)
-                    elev = float(config_site.elev)
                     # assign meteorological data at this month
                     if month >= 12:
                         month = 1
                     # if metMonth > 12 * mYears:
                     #     metMonth = 1
 
+                    if record is None:
+                        raise ValueError('the climate series ends before month %d' % metMonth)
                     # T_max = self.data[metMonth, 0] #CJS note: does not need Tmax met. data: VPD and SRAD are already in inputs
                     # T_min = self.data[metMonth, 1] #CJS note: does not need Tmax met. data: VPD and SRAD are already in inputs
-                    T_av = self.data[metMonth, 2]
+                    T_av = record[i_T_av]
                     # VPD = get_VPD(T_min, T_max) #CJS note: does not need VPD met. data: VPD data are already in inputs
-                    VPD = self.data[metMonth, 3]
-                    rain = self.data[metMonth, 4]
-                    solar_rad = self.data[metMonth, 5]
+                    VPD = record[i_VPD]
+                    rain = record[i_rain]
+                    solar_rad = record[i_solar_rad]
                     # rain_days = int(self.data[metMonth, 6])
-                    day_length = get_day_length(lat, month)
-                    frost_days = int(self.data[metMonth, 7])
-                    CaMonthly = self.data[metMonth, 8]
-                    D13Catm = self.data[metMonth, 9]
-                    d18Osrc = self.data[metMonth, 10]
+                    month_drivers = None
+                    if drivers is not None:
+                        month_drivers, day_length, days_in_month = drivers[metMonth]
+                    else:
+                        day_length = day_lengths[month_index(month)]
+                        days_in_month = days_in_month_table[month_index(month)]
+                    frost_days = int(record[i_frost_days])
+                    CaMonthly = record[i_CaMonthly]
+                    D13Catm = record[i_D13Catm]
+                    d18Osrc = record[i_d18Osrc]
 
                     CounterforShrub = None
 
-                    # Canopy Production Module
-                    PAR, APAR, APARu, \
-                        GPPmolc, GPPdm, NPP, \
-                        modifiers, LAIShrub, \
-                        CounterforShrub, canopy_conductance = canopy_production(T_av, VPD,
-                                    ASW, frost_days, stand_age,
-                                    LAI, solar_rad, month, CounterforShrub, self.config)
+                    if use_kernel:
+                        # Canopy Production and Water Balance Modules, fused
+                        PAR, APAR, APARu, GPPmolc, GPPdm, NPP, \
+                            modifier_physiology, LAIShrub, \
+                            CounterforShrub, canopy_conductance, \
+                            transpall, transp, transpshrub, loss_water, ASW, \
+                            monthlyIrrig, canopy_transpiration_sec = production_step(
+                                    packed_params, T_av, VPD, rain, solar_rad,
+                                    frost_days, day_length, days_in_month,
+                                    ASW, LAI, stand_age,
+                                    params.ShrubEffect.counterforshrub, irrig)
+                    else:
+                        # Canopy Production Module
+                        PAR, APAR, APARu, \
+                            GPPmolc, GPPdm, NPP, \
+                            modifiers, LAIShrub, \
+                            CounterforShrub, canopy_conductance = canopy_production(T_av, VPD,
+                                        ASW, frost_days, stand_age,
+                                        LAI, solar_rad, days_in_month, CounterforShrub, params, shrub,
+                                        month_drivers)
 
-					# Water Balance Module
-                    transpall, transp, transpshrub, loss_water, ASW, \
-                        monthlyIrrig, canopy_transpiration_sec = water_balance(solar_rad, VPD,
-                                day_length, LAI, rain, irrig,
-                                month, ASW, canopy_conductance, LAIShrub, self.config)
+                        # Water Balance Module
+                        transpall, transp, transpshrub, loss_water, ASW, \
+                            monthlyIrrig, canopy_transpiration_sec = water_balance(solar_rad, VPD,
+                                    day_length, LAI, rain, irrig,
+                                    days_in_month, ASW, canopy_conductance, LAIShrub, params, shrub)
+                        modifier_physiology = modifiers[-1]
 
                     # Biomass Partion Module
-                    modifier_physiology = modifiers[-1]
                     WF, WR, WS, TotalW, TotalLitter, \
                         D13CTissue, InterCiPPM, \
                         delWF, delWR, delWS, d18Oleaf, d18Ocell, \
@@ -189,16 +353,34 @@ class Model3PG(Model):
                                 canopy_conductance, canopy_transpiration_sec, self.config)
 
                     # Stem Mortality Module
-                    stand_age, LAI, MAI, \
-                        avDBH, BasArea, Height, \
-                        StemNo, delStemNo, StandVol, \
-                        WF, WR, WS, AvStemMass = stem_mortality(WF, WR, WS, StemNo, delStemNo,
-                                    stand_age, self.config)
+                    if use_kernel:
+                        if schedule is not None:
+                            WF, WR, WS, StemNo = doThinning(stand_age, WF, WR, WS, StemNo,
+                                    params_stem.stempower)
+                            WF = doDefoliation(stand_age, WF)
+                        stand_age, LAI, MAI, \
+                            avDBH, BasArea, Height, \
+                            StemNo, delStemNo, StandVol, \
+                            WF, WR, WS, AvStemMass, n_newton = mortality_step(packed_params,
+                                    WF, WR, WS, StemNo, delStemNo, stand_age)
+                        if on_newton_iterations is not None:
+                            on_newton_iterations(n_newton)
+                    else:
+                        stand_age, LAI, MAI, \
+                            avDBH, BasArea, Height, \
+                            StemNo, delStemNo, StandVol, \
+                            WF, WR, WS, AvStemMass = stem_mortality(WF, WR, WS, StemNo, delStemNo,
+                                        stand_age, params, doThinning, doDefoliation,
+                                        on_newton_iterations)
 
-                self.keeper.keep(mapper, locals())
+                keep(mapper, locals())
 
                 metMonth = metMonth + 1
                 month = month + 1
+
+            if self.checkpoint_every and (year + 1) % self.checkpoint_every == 0:
+                save_checkpoint(self.fpath_checkpoint.format(year=year),
+                        year, metMonth, locals())
             # break
 
 
@@ -209,3 +391,4 @@ if __name__ == '__main__':
     print(model.data)
 
     model.run()
+    model.teardown()
@@ -1,38 +1,66 @@
 from __future__ import division
 from math import exp, log, pi
 
+import numpy as np
+
 """
 Stem Mortality Module
 """
 
-# def doThinning(n As Integer, table As Variant)
-# function for manually thinning
-# not implemented yet
-
-
-# def doDefoliation(n As Integer, table As Variant)
-# function for defoliation
-# not implemented yet
-
+def thin_stand(WF, WR, WS, StemNo, delN, fF=1.0, fR=1.0, fS=1.0):
+    """
+    Description:
+        removes the fraction delN of the stems, the removed trees holding
+        fF, fR and fS times the foliage, root and stem mass of the mean
+        tree. Scalars or arrays.
+    """
+    WF = WF * (1 - delN * fF)
+    WR = WR * (1 - delN * fR)
+    WS = WS * (1 - delN * fS)
+    StemNo = StemNo * (1 - delN)
+    return WF, WR, WS, StemNo
 
 
-# Update tree and stand data at the end of this time period,
-# taking mortality, thinning or defoliation into account
+def stems_removed(kind, value, StemNo, fS, StemPower):
+    """
+    Input:
+        kind, 'stocking', 'stems' or 'basal_area' (see management.py)
+        value, the stocking left or the fraction removed
+        StemNo, fS (relative stem mass of the removed trees), StemPower
+    Output:
+        fraction of the stems a thinning removes, scalars or arrays
+    Description:
+        the basal area of the mean tree goes with AvStemMass ** (2 / StemPower),
+        so removing the fraction d of the stems leaves the fraction
+          (1 - d) ** (1 - 2 / StemPower) * (1 - d * fS) ** (2 / StemPower)
+        of the basal area, solved for d by bisection unless fS is 1.
+    """
+    kind, value, StemNo, fS, StemPower = np.broadcast_arrays(kind,
+            np.asarray(value, dtype=np.float64), np.asarray(StemNo, dtype=np.float64),
+            np.asarray(fS, dtype=np.float64), np.asarray(StemPower, dtype=np.float64))
+    e = 2 / StemPower
+    low = np.zeros(value.shape)
+    high = np.minimum(1, 1 / np.maximum(fS, 1e-12))
+    for i in range(60):
+        d = (low + high) / 2
+        left = (1 - d) ** (1 - e) * (1 - d * fS) ** e
+        more = left > 1 - value
+        low = np.where(more, d, low)
+        high = np.where(more, high, d)
+    basal_area = np.where(fS == 1, value, (low + high) / 2)
+    stocking = np.maximum(StemNo - value, 0) / StemNo
+    return np.where(kind == 'stocking', stocking,
+            np.where(kind == 'basal_area', basal_area, value))
 
-"""
-    # Perform any thinning or defoliation events for this time period
-    if thinEventNo <= nThinning:
-        doThinning(thinEventNo, Thinning)
-    if defoltnEventNo <= nDefoliation:
-        doDefoliation(defoltnEventNo, Defoliation)
-"""
 
 def getMortality(oldN, oldW,
-        mS, wSx1000, thinPower):
+        mS, wSx1000, thinPower, on_newton_iterations=None):
     """
     Input:
         oldN, Double
         oldW, Double
+        on_newton_iterations, called with the number of Newton iterations
+            of the solve when given, see profiling.Profiler
     Output:
         mortality rate, Double
     Description:
@@ -58,19 +86,21 @@ def getMortality(oldN, oldW,
         n = n + dN
         if (abs(dN) <= accuracy) or (i >= 5):
             break
+    if on_newton_iterations is not None:
+        on_newton_iterations(i)
     res = oldN - 1000 * n
     return int(res)
 
 
 def calc_mortality(WF, WR, WS, StemNo, delStemNo,
-        wSx1000, thinPower, mF, mR, mS):
+        wSx1000, thinPower, mF, mR, mS, on_newton_iterations=None):
     # Calculate mortality
     wSmax = wSx1000 * (1000 / StemNo) ** thinPower
     AvStemMass = WS * 1000 / StemNo
     delStems = 0
     if wSmax < AvStemMass:
         delStems = getMortality(StemNo, WS,
-              mS, wSx1000, thinPower)
+              mS, wSx1000, thinPower, on_newton_iterations)
         WF = WF - mF * delStems * (WF / StemNo)
         WR = WR - mR * delStems * (WR / StemNo)
         WS = WS - mS * delStems * (WS / StemNo)
@@ -110,41 +140,166 @@ def update_stands(stand_age, WF, WS, AvStemMass, StemNo,
 
 
 def stem_mortality(WF, WR, WS,
-        StemNo, delStemNo, stand_age, config, doThinning=None, doDefoliation=None):
+        StemNo, delStemNo, stand_age, params, doThinning=None, doDefoliation=None,
+        on_newton_iterations=None):
 
-    config_stem = config.StemMortality
+    params_stem = params.StemMortality
 
-    wSx1000 = float(config_stem.wsx1000)
-    thinPower = float(config_stem.thinpower)
-    mF = float(config_stem.mf)
-    mR = float(config_stem.mr)
-    mS = float(config_stem.ms)
+    wSx1000 = params_stem.wsx1000
+    thinPower = params_stem.thinpower
+    mF = params_stem.mf
+    mR = params_stem.mr
+    mS = params_stem.ms
 
-    SLA0 = float(config_stem.sla0)
-    SLA1 = float(config_stem.sla1)
-    tSLA = float(config_stem.tsla)
-    fracBB0 = float(config_stem.fracbb0)
-    fracBB1 = float(config_stem.fracbb1)
-    tBB = float(config_stem.tbb)
+    SLA0 = params_stem.sla0
+    SLA1 = params_stem.sla1
+    tSLA = params_stem.tsla
+    fracBB0 = params_stem.fracbb0
+    fracBB1 = params_stem.fracbb1
+    tBB = params_stem.tbb
 
-    StemConst = float(config_stem.stemconst)
-    StemPower = float(config_stem.stempower)
-    Density = float(config_stem.density)
-    HtC0 = float(config_stem.htc0)
-    HtC1 = float(config_stem.htc1)
+    StemConst = params_stem.stemconst
+    StemPower = params_stem.stempower
+    Density = params_stem.density
+    HtC0 = params_stem.htc0
+    HtC1 = params_stem.htc1
 
+    # Perform any thinning or defoliation events for this time period
+    # (see management.Schedule)
     if doThinning is not None:
-        doThinning()
+        WF, WR, WS, StemNo = doThinning(stand_age, WF, WR, WS, StemNo, StemPower)
     if doDefoliation is not None:
-        doDefoliation()
+        WF = doDefoliation(stand_age, WF)
 
     stand_age = stand_age + 1.0 / 12
 
     WF, WR, WS, AvStemMass, StemNo, delStemNo = calc_mortality(WF, WR, WS, StemNo, delStemNo,
-        wSx1000, thinPower, mF, mR, mS)
+        wSx1000, thinPower, mF, mR, mS, on_newton_iterations)
     SLA, fracBB = calc_factors_age(stand_age, SLA0, SLA1, tSLA,
         fracBB0, fracBB1, tBB)
     LAI, MAI, avDBH, BasArea, Height, StandVol = update_stands(stand_age, WF, WS, AvStemMass, StemNo,
         SLA, fracBB, StemConst, StemPower, Density, HtC0, HtC1)
     return stand_age, LAI, MAI, avDBH, BasArea, Height, StemNo, delStemNo, StandVol, WF, WR, WS, AvStemMass
 
+
+def getMortality_batch(oldN, oldW, mS, wSx1000, thinPower, exact=False):
+    """
+    Input:
+        oldN, oldW, arrays over the over-dense stands
+        mS, wSx1000, thinPower, arrays or scalars
+        exact, iterate until the step is within 1e-13 of n, up to 100
+            iterations, instead of to 1 stem or less, up to 5 iterations
+    Output:
+        mortality, truncated to whole stems as getMortality does
+        iterations, Newton iterations of each stand
+        converged, False where the iteration cap was hit first
+    Description:
+        getMortality for all the stands at once, each stand stops
+        updating as soon as its own step is within the accuracy. The
+        solve is done in float64 whatever the type of the state.
+    """
+    max_iterations = 100 if exact else 5
+    oldN = np.asarray(oldN, dtype=np.float64)
+    oldW = np.asarray(oldW, dtype=np.float64)
+    shape = np.shape(oldN)
+    mS = np.broadcast_to(mS, shape)
+    wSx1000 = np.broadcast_to(wSx1000, shape)
+    thinPower = np.broadcast_to(thinPower, shape)
+    n = oldN / 1000
+    x1 = 1000 * mS * oldW / oldN
+    iterations = np.zeros(shape, dtype=int)
+    converged = np.zeros(shape, dtype=bool)
+    active = np.arange(n.size)
+    for i in range(1, max_iterations + 1):
+        n_ = n[active]
+        x2 = wSx1000[active] * (n_ ** (1 - thinPower[active]))
+        fN = x2 - x1[active] * n_ - (1 - mS[active]) * oldW[active]
+        dfN = (1 - thinPower[active]) * x2 / n_ - x1[active]
+        dN = -1 * fN / dfN
+        n_ = n_ + dN
+        n[active] = n_
+        iterations[active] = i
+        done = np.abs(dN) <= (1e-13 * np.abs(n_) if exact else 1 / 1000)
+        converged[active[done]] = True
+        active = active[~done]
+        if not active.size:
+            break
+    return np.trunc(oldN - 1000 * n), iterations, converged
+
+
+def calc_mortality_batch(WF, WR, WS, StemNo, delStemNo,
+        wSx1000, thinPower, mF, mR, mS, exact=False):
+    # masked version of calc_mortality, only over-dense stands are thinned,
+    # also returns the indices of the stands whose solve did not converge,
+    # the outputs are float64 even for a float32 state
+    WF, WR, WS, StemNo = [np.asarray(v, dtype=np.float64) for v in (WF, WR, WS, StemNo)]
+    wSmax = wSx1000 * (1000 / StemNo) ** thinPower
+    AvStemMass = WS * 1000 / StemNo
+    delStems = np.zeros(np.shape(StemNo))
+    crowded = np.flatnonzero(wSmax < AvStemMass)
+    not_converged = crowded[:0]
+    if crowded.size:
+        shape = delStems.shape
+        delStems[crowded], iterations, converged = getMortality_batch(
+                StemNo[crowded], WS[crowded], np.broadcast_to(mS, shape)[crowded],
+                np.broadcast_to(wSx1000, shape)[crowded],
+                np.broadcast_to(thinPower, shape)[crowded], exact)
+        not_converged = crowded[~converged]
+        WF = WF - mF * delStems * (WF / StemNo)
+        WR = WR - mR * delStems * (WR / StemNo)
+        WS = WS - mS * delStems * (WS / StemNo)
+    StemNo = StemNo - delStems
+    AvStemMass = WS * 1000 / StemNo
+    delStemNo = delStemNo + delStems
+    return WF, WR, WS, AvStemMass, StemNo, delStemNo, not_converged
+
+
+def calc_factors_age_batch(stand_age, SLA0, SLA1, tSLA,
+        fracBB0, fracBB1, tBB):
+    SLA = SLA1 + (SLA0 - SLA1) * np.exp(-log(2) * (stand_age / tSLA) ** 2)
+    fracBB = fracBB1 + (fracBB0 - fracBB1) * np.exp(-log(2) * (stand_age / tBB))
+    return SLA, fracBB
+
+
+def update_stands_batch(stand_age, WF, WS, AvStemMass, StemNo,
+        SLA, fracBB, StemConst, StemPower, Density, HtC0, HtC1):
+    # the power laws are evaluated in float64 even for a float32 state
+    AvStemMass = np.asarray(AvStemMass, dtype=np.float64)
+    StemNo = np.asarray(StemNo, dtype=np.float64)
+    LAI = WF * SLA * 0.1
+    avDBH = (AvStemMass / StemConst) ** (1 / StemPower)
+    BasArea = (((avDBH / 200) ** 2) * pi) * StemNo
+    StandVol = WS * (1 - fracBB) / Density
+    MAI = np.where(stand_age > 0, StandVol / np.where(stand_age > 0, stand_age, 1), 0.0)
+    Height = (np.exp(HtC0 + HtC1 / (avDBH / 2.54 + 1)) + 4.5) * 0.3048
+    return LAI, MAI, avDBH, BasArea, Height, StandVol
+
+
+def stem_mortality_batch(WF, WR, WS,
+        StemNo, delStemNo, stand_age, params, exact=False,
+        doThinning=None, doDefoliation=None):
+    """
+    Description:
+        array version of stem_mortality over the stand axis, the options of
+        params may be arrays (see parameters.stack_parameters). The outputs
+        are followed by the indices of the stands whose self-thinning solve
+        hit the iteration cap, see getMortality_batch for exact.
+        doThinning and doDefoliation are those of management.BatchSchedule.
+    """
+    c = params.StemMortality
+
+    if doThinning is not None:
+        WF, WR, WS, StemNo = doThinning(stand_age, WF, WR, WS, StemNo, c.stempower)
+    if doDefoliation is not None:
+        WF = doDefoliation(stand_age, WF)
+
+    stand_age = stand_age + 1.0 / 12
+
+    WF, WR, WS, AvStemMass, StemNo, delStemNo, not_converged = calc_mortality_batch(WF, WR, WS,
+        StemNo, delStemNo, c.wsx1000, c.thinpower, c.mf, c.mr, c.ms, exact)
+    SLA, fracBB = calc_factors_age_batch(stand_age, c.sla0, c.sla1, c.tsla,
+        c.fracbb0, c.fracbb1, c.tbb)
+    LAI, MAI, avDBH, BasArea, Height, StandVol = update_stands_batch(stand_age,
+        WF, WS, AvStemMass, StemNo, SLA, fracBB,
+        c.stemconst, c.stempower, c.density, c.htc0, c.htc1)
+    return stand_age, LAI, MAI, avDBH, BasArea, Height, StemNo, delStemNo, StandVol, WF, WR, WS, AvStemMass, not_converged
@@ -2,8 +2,10 @@
 Water Balance Module
 """
 from __future__ import division
+
+import numpy as np
+
 from constants import Qa, Qb
-from utils import get_days_in_month
 
 def calc_transpiration_PM(Q, VPD, h, gBL, gC):
     """
@@ -60,33 +62,38 @@ def calc_soil_water_balance(ASW, rain, loss_water,
 
 
 def water_balance(solar_rad, VPD, day_length, LAI,
-        rain, irrig, month, ASW, CanCond, LAIShrub, config):
+        rain, irrig, days_in_month, ASW, CanCond, LAIShrub, params, shrub=True):
+    """the shrub transpiration is evaluated only if shrub, transpall and
+    transpshrub are None otherwise"""
 
-    config_water = config.WaterBalance
-    config_canopy = config.CanopyProduction
-    config_shrub = config.ShrubEffect
+    params_water = params.WaterBalance
+    params_canopy = params.CanopyProduction
+    params_shrub = params.ShrubEffect
 
-    BLcond = float(config_water.blcond)
+    BLcond = params_water.blcond
 
-    LAImaxIntcptn = float(config_water.laimaxintcptn)
-    MaxIntcptn = float(config_water.maxintcptn)
+    LAImaxIntcptn = params_water.laimaxintcptn
+    MaxIntcptn = params_water.maxintcptn
 
-    MinASW = float(config_canopy.minasw)
-    MaxASW = float(config_canopy.maxasw)
+    MinASW = params_canopy.minasw
+    MaxASW = params_canopy.maxasw
 
-    TrShrub = float(config_shrub.trshrub)
+    TrShrub = params_shrub.trshrub
 
     transp = max(0, calc_transpiration_PM(solar_rad, VPD, day_length, BLcond, CanCond)) #kg/m2/day
     #canopy transpiration in mol/m2/sec for Peclet effect calculations - make sure does not go to 0 to avoid divide by zero errors
     #canopy_transpiration_sec = max(0.01, transp*(1.e3/(18.*86400.)))
 
-    transpall = get_days_in_month(month) * transp * (LAIShrub * TrShrub + LAI) / LAI # total transpiration
-    transp = get_days_in_month(month) * transp # tree only transpiration, in kg/m2/month
+    transpall = transpshrub = None
+    if shrub:
+        transpall = days_in_month * transp * (LAIShrub * TrShrub + LAI) / LAI # total transpiration
+    transp = days_in_month * transp # tree only transpiration, in kg/m2/month
     # added canopy transp here instead
     #canopy_transpiration_sec = max(0.01, transp*(1.e3*30/(18.*86400.)))
     # remove the 30 in this eqn
     canopy_transpiration_sec = max(0.000001, transp*(1.e3/(18.*86400.)))
-    transpshrub = max(0, transpall - transp) # shrub only transpiration
+    if shrub:
+        transpshrub = max(0, transpall - transp) # shrub only transpiration
 
     intercepted_water = calc_interception(rain, LAI, LAImaxIntcptn, MaxIntcptn)
 
@@ -95,3 +102,51 @@ def water_balance(solar_rad, VPD, day_length, LAI,
     ASW, monthlyIrrig = calc_soil_water_balance(ASW, rain, loss_water,
         irrig, MinASW, MaxASW)
     return transpall, transp, transpshrub, loss_water, ASW, monthlyIrrig, canopy_transpiration_sec
+
+
+def calc_interception_batch(rain, LAI, LAImaxIntcptn, MaxIntcptn):
+    no_limit = LAImaxIntcptn <= 0
+    safe_max = np.where(no_limit, 1.0, LAImaxIntcptn)
+    Intcptn = np.where(no_limit, MaxIntcptn,
+            MaxIntcptn * np.minimum(1, LAI / safe_max))
+    return Intcptn * rain
+
+
+def calc_soil_water_balance_batch(ASW, rain, loss_water,
+        irrig, MinASW, MaxASW):
+    ASW = ASW + rain + (100 * irrig / 12) - loss_water # Irrig is Ml/ha/year
+    deficit = ASW < MinASW
+    monthlyIrrig = np.where(deficit & (MinASW > 0), MinASW - ASW, 0.0)
+    ASW = np.where(deficit, MinASW, np.minimum(ASW, MaxASW))
+    return ASW, monthlyIrrig
+
+
+def water_balance_batch(solar_rad, VPD, day_length, LAI,
+        rain, irrig, days_in_month, ASW, CanCond, LAIShrub, params, shrub=True):
+    """
+    Description:
+        array version of water_balance over the stand axis, the options of
+        params may be arrays (see parameters.stack_parameters).
+    """
+    params_water = params.WaterBalance
+    params_canopy = params.CanopyProduction
+    params_shrub = params.ShrubEffect
+
+    transp = np.maximum(0, calc_transpiration_PM(solar_rad, VPD, day_length,
+        params_water.blcond, CanCond)) #kg/m2/day
+    transpall = transpshrub = None
+    if shrub:
+        transpall = days_in_month * transp * (LAIShrub * params_shrub.trshrub + LAI) / LAI # total transpiration
+    transp = days_in_month * transp # tree only transpiration, in kg/m2/month
+    canopy_transpiration_sec = np.maximum(0.000001, transp*(1.e3/(18.*86400.)))
+    if shrub:
+        transpshrub = np.maximum(0, transpall - transp) # shrub only transpiration
+
+    intercepted_water = calc_interception_batch(rain, LAI,
+            params_water.laimaxintcptn, params_water.maxintcptn)
+
+    loss_water = transp + intercepted_water
+
+    ASW, monthlyIrrig = calc_soil_water_balance_batch(ASW, rain, loss_water,
+        irrig, params_canopy.minasw, params_canopy.maxasw)
+    return transpall, transp, transpshrub, loss_water, ASW, monthlyIrrig, canopy_transpiration_sec
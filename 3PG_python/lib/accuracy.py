@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Accuracy of the float32 precision of BatchModel3PG
+
+The same stands are run with the precision float64 and float32, and the
+trajectories of every output are compared month by month:
+
+    max_abs,    largest absolute difference
+    max_rel,    largest difference relative to 1 + |float64 value|, the
+                measure of kernel.check_parity
+    final_rel,  the same at the last month
+
+Run as a script it reports on the test run (test/Test_config.cfg over
+test/Test_input.txt, 272 years).
+"""
+
+import os
+
+import numpy as np
+
+from framework import copy_config, load_config
+
+
+def precision_records(configs, precision):
+    """records of a BatchModel3PG run of configs at precision, nothing written"""
+    from BatchModel3PG import BatchModel3PG
+    configs = [copy_config(config) for config in configs]
+    for config in configs:
+        config.IO.format = 'records'
+    model = BatchModel3PG(configs, precision=precision)
+    try:
+        model.run()
+        return np.array(model.keeper.records)
+    finally:
+        model.teardown()
+
+
+def compare_records(reference, compact):
+    """
+    Input:
+        reference, compact, record arrays of the same outputs, months on
+            the first axis
+    Output:
+        dict of output name to (max_abs, max_rel, final_rel)
+    """
+    res = {}
+    for name in reference.dtype.names:
+        ref = reference[name].astype(np.float64)
+        diff = np.abs(compact[name].astype(np.float64) - ref)
+        rel = diff / (1 + np.abs(ref))
+        res[name] = (float(np.max(diff)), float(np.max(rel)), float(np.max(rel[-1])))
+    return res
+
+
+def check_precision(configs):
+    """
+    Input:
+        configs, one config per stand, as returned by load_config
+    Output:
+        compare_records of the float64 and float32 runs, and the bytes
+        of their outputs
+    """
+    reference = precision_records(configs, 'float64')
+    compact = precision_records(configs, 'float32')
+    return compare_records(reference, compact), (reference.nbytes, compact.nbytes)
+
+
+def format_report(errors):
+    lines = ['%-28s %12s %12s %12s' % ('output', 'max_abs', 'max_rel', 'final_rel')]
+    for name in sorted(errors):
+        lines.append('%-28s %12.3g %12.3g %12.3g' % ((name,) + errors[name]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    dpath_test = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+    config = load_config(os.path.join(dpath_test, 'Test_config.cfg'))
+    config.IO.input = os.path.join(dpath_test, 'Test_input.txt')
+    errors, (n_reference, n_compact) = check_precision([config])
+    print(format_report(errors))
+    print('max relative difference', max(error[1] for error in errors.values()))
+    print('output bytes, float64 %d, float32 %d' % (n_reference, n_compact))
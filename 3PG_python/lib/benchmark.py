@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark harness
+
+Generates synthetic climate series and stand control files from the
+parameters of test/Test_config.cfg, then times
+    - config load (parse and compile the control files)
+    - input load (climate text parse, then cached load)
+    - the cost of one call of each monthly module, scalar and batched
+    - output write, for every book keeper backend
+    - cold start, new interpreters importing the model or validating a
+      control file
+    - whole runs, at several numbers of stands and years
+Every whole run happens in a fresh process, so its peak RSS is its own.
+The report is a dict, written as JSON by bin/bench.py.
+"""
+
+import configparser
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+dpath_lib = os.path.dirname(os.path.abspath(__file__))
+fpath_template = os.path.join(dpath_lib, '..', 'test', 'Test_config.cfg')
+fpath_cli = os.path.join(dpath_lib, '..', 'bin', '3pg.py')
+
+climate_header = ['Tmax', 'Tmin', 'Tav', 'VPD', 'Rain', 'Solar rad',
+        'Rain Days', 'Frost Days', 'Ca', 'D13Catm', 'd18O', 'Year', 'Month']
+
+
+def peak_rss_mb():
+    """peak resident set size of this process"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2.0 ** 20 # bytes on macOS
+    return rss / 2.0 ** 10 # kB elsewhere
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    res = function(*args, **kwargs)
+    return res, time.perf_counter() - start
+
+
+def write_synthetic_climate(fpath, n_years, start_year=1740, seed=0):
+    """monthly climate with a seasonal cycle and noise, 12 * n_years rows"""
+    rng = np.random.default_rng(seed)
+    n = 12 * n_years
+    month = np.arange(n) % 12
+    season = -np.cos(2 * np.pi * month / 12)
+    T_av = 8 + 10 * season + rng.normal(0, 1.5, n)
+    VPD = np.maximum(0.2, 0.9 + 0.7 * season + rng.normal(0, 0.2, n))
+    rain = rng.gamma(2.0, 40.0, n)
+    solar_rad = np.maximum(1.0, 12 + 8 * season + rng.normal(0, 1, n))
+    rain_days = np.clip(np.round(rain / 10), 0, 30)
+    frost_days = np.clip(3 * (-(T_av - 6)), 0, 30)
+    columns = [T_av + 6, T_av - 6, T_av, VPD, rain, solar_rad, rain_days,
+            frost_days, 280 + 0.4 * np.arange(n) / 12,
+            np.full(n, -6.4), np.full(n, -14.0),
+            start_year + np.arange(n) // 12, month + 1]
+    with open(fpath, 'w') as handler:
+        handler.write('\t'.join(climate_header) + '\n')
+        np.savetxt(handler, np.stack(columns, axis=1), delimiter='\t', fmt='%.6g')
+
+
+def write_stand_configs(dpath, n_stands, n_years, fpath_input, seed=0):
+    """control files derived from the test config, with small variations
+    of site and initial state between stands"""
+    rng = np.random.default_rng(seed)
+    template = configparser.ConfigParser(interpolation=None)
+    template.optionxform = str
+    template.read(fpath_template)
+    template.set('TimeRange', 'EndAge', str(n_years - 1))
+    template.set('TimeRange', 'EndYear', str(1740 + n_years - 1))
+    template.set('IO', 'input', fpath_input)
+    template.set('IO', 'format', 'records')
+    lat = float(template.get('SiteCharacteristics', 'lat'))
+    stocking = float(template.get('InitialState', 'InitialStocking'))
+    res = []
+    for i in range(n_stands):
+        template.set('IO', 'output', os.path.join(dpath, 'stand_%d.txt' % i))
+        template.set('SiteCharacteristics', 'lat', repr(lat + rng.uniform(-2, 2)))
+        template.set('InitialState', 'InitialStocking',
+                repr(round(stocking * rng.uniform(0.8, 1.2))))
+        fpath = os.path.join(dpath, 'stand_%d.cfg' % i)
+        with open(fpath, 'w') as handler:
+            template.write(handler)
+        res.append(fpath)
+    return res
+
+
+def bench_config_load(fpaths):
+    from framework import load_config
+    from parameters import compile_parameters
+    configs, seconds_parse = timed(lambda: [load_config(f) for f in fpaths])
+    _, seconds_compile = timed(lambda: [compile_parameters(c) for c in configs])
+    return {'configs': len(fpaths), 'parse_seconds': seconds_parse,
+            'compile_seconds': seconds_compile}
+
+
+def bench_input_load(fpath_input, dpath_cache):
+    import climate
+    _, seconds_text = timed(np.loadtxt, fpath_input, skiprows=1)
+    _, seconds_cold = timed(climate.load_climate, fpath_input, dpath_cache)
+    climate.loaded.clear()
+    _, seconds_warm = timed(climate.load_climate, fpath_input, dpath_cache)
+    return {'loadtxt_seconds': seconds_text, 'cache_build_seconds': seconds_cold,
+            'cached_load_seconds': seconds_warm}
+
+
+def bench_modules(fpath_config, n_calls=2000, n_stands=1000):
+    """seconds per call of each monthly module, at a typical stand state;
+    the batched modules are timed over n_stands and reported per stand"""
+    from framework import load_config
+    from parameters import compile_parameters, stack_parameters
+    from CanopyProduction import canopy_production, canopy_production_batch
+    from WaterBalance import water_balance, water_balance_batch
+    from StemMortality import stem_mortality, stem_mortality_batch
+    from BiomassPartition import biomass_partition
+
+    config = load_config(fpath_config)
+    params = compile_parameters(config)
+    batch = stack_parameters([params] * n_stands)
+    ones = np.ones(n_stands)
+
+    def per_call(function, args, n):
+        start = time.perf_counter()
+        for _ in range(n):
+            function(*args)
+        return (time.perf_counter() - start) / n
+
+    res = {}
+    res['canopy_production'] = per_call(canopy_production,
+            (15.0, 1.0, 100.0, 2, 10.0, 3.0, 15.0, 30, None, params), n_calls)
+    res['water_balance'] = per_call(water_balance,
+            (15.0, 1.0, 50000.0, 3.0, 80.0, 0, 30, 100.0, 0.005, 1.0, params), n_calls)
+    res['biomass_partition'] = per_call(biomass_partition,
+            (15.0, 3.0, 900.0, 300.0, -6.4, 5.0, 4.0, 30.0, 2.0, 1.0, 0.04,
+                10.0, 6, 10.0, 0.5, 1.0, -14.0, 0.005, 0.0001, config), n_calls)
+    res['stem_mortality'] = per_call(stem_mortality,
+            (5.0, 4.0, 30.0, 1000.0, 0, 10.0, params), n_calls)
+    n_batch = max(1, n_calls // 100)
+    res['canopy_production_batch_per_stand'] = per_call(canopy_production_batch,
+            (15 * ones, ones, 100 * ones, 2 * ones, 10 * ones, 3 * ones,
+                15 * ones, 30, None, batch), n_batch) / n_stands
+    res['water_balance_batch_per_stand'] = per_call(water_balance_batch,
+            (15 * ones, ones, 50000 * ones, 3 * ones, 80 * ones, 0, 30,
+                100 * ones, 0.005 * ones, ones, batch), n_batch) / n_stands
+    res['stem_mortality_batch_per_stand'] = per_call(stem_mortality_batch,
+            (5 * ones, 4 * ones, 30 * ones, 1000 * ones, 0 * ones,
+                10 * ones, batch), n_batch) / n_stands
+    return res
+
+
+def bench_output(dpath, n_steps=12000):
+    """seconds to keep n_steps monthly rows of every output variable"""
+    from framework import Empty, create_keeper
+    from Model3PG import mapper
+    config_output = Empty()
+    for name in mapper:
+        setattr(config_output, name, '1')
+    env = dict((var, 1.2345678901234567) for var in mapper.values())
+    res = {}
+    for fmt in ['tsv', 'records', 'npy']:
+        config_io = Empty()
+        config_io.format = fmt
+        config_io.output = os.path.join(dpath, 'bench_output.' + fmt)
+        keeper = create_keeper(config_io)
+        start = time.perf_counter()
+        keeper.initialize(config_output, n_steps)
+        for _ in range(n_steps):
+            keeper.keep(mapper, env)
+        keeper.shutdown()
+        res[fmt] = time.perf_counter() - start
+    return res
+
+
+def bench_cold_start(fpath_config, repeats=5):
+    """seconds from launching a new interpreter to its exit, best of
+    repeats, for an empty interpreter, importing Model3PG, and the
+    command line validating a control file"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([dpath_lib] +
+            [path for path in [env.get('PYTHONPATH')] if path])
+    commands = {'interpreter': [sys.executable, '-c', 'pass'],
+            'import_model': [sys.executable, '-c', 'import Model3PG'],
+            'validate': [sys.executable, fpath_cli, '--validate', fpath_config]}
+    res = {}
+    for name, command in commands.items():
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+            seconds.append(time.perf_counter() - start)
+        res[name] = min(seconds)
+    return res
+
+
+def run_scale(fpaths, n_years, engine):
+    """one whole run, meant to be called in a fresh process"""
+    from Model3PG import Model3PG
+    from BatchModel3PG import BatchModel3PG
+    if engine not in ('scalar', 'kernel', 'batch'):
+        raise ValueError('unknown engine %s' % engine)
+    start = time.perf_counter()
+    if engine == 'batch':
+        model = BatchModel3PG(fpaths)
+        model.run()
+        model.teardown()
+    else:
+        for fpath in fpaths:
+            model = Model3PG(fpath, use_kernel=engine == 'kernel', verbose=False)
+            model.run()
+            model.teardown()
+    seconds = time.perf_counter() - start
+    stand_months = 12 * n_years * len(fpaths)
+    return {'engine': engine, 'stands': len(fpaths), 'years': n_years,
+            'seconds': seconds, 'stand_months_per_second': stand_months / seconds,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run_benchmarks(dpath, stands=(1, 100, 10000), years=(10, 100, 1000),
+        budget=2000000, engines=('scalar', 'kernel', 'batch')):
+    """
+    Input:
+        dpath, scratch directory for the generated inputs and outputs
+        stands, years, the scales to run
+        budget, scales above this many stand-months are skipped
+        engines, 'scalar' runs Model3PG per stand with the module functions,
+            'kernel' with the fused kernel steps (compiled when numba is
+            importable), 'batch' runs BatchModel3PG
+    Output:
+        report dict
+    """
+    import kernel
+    report = {'machine': {'python': platform.python_version(),
+                'numpy': np.__version__, 'platform': platform.platform(),
+                'cpus': os.cpu_count(), 'numba': kernel.available},
+            'phases': {}, 'scales': []}
+
+    fpath_input = os.path.join(dpath, 'climate_%d.txt' % max(years))
+    write_synthetic_climate(fpath_input, max(years))
+    fpaths, seconds = timed(write_stand_configs, dpath, max(stands), max(years), fpath_input)
+
+    report['phases']['config_load'] = bench_config_load(fpaths)
+    report['phases']['input_load'] = bench_input_load(fpath_input,
+            os.path.join(dpath, 'climate_cache'))
+    report['phases']['module_call_seconds'] = bench_modules(fpaths[0])
+    report['phases']['output_write_seconds'] = bench_output(dpath)
+    report['phases']['cold_start_seconds'] = bench_cold_start(fpaths[0])
+
+    context = multiprocessing.get_context('spawn')
+    for n_years in years:
+        fpath_climate = os.path.join(dpath, 'climate_%d.txt' % n_years)
+        write_synthetic_climate(fpath_climate, n_years)
+        dpath_scale = os.path.join(dpath, 'years_%d' % n_years)
+        if not os.path.isdir(dpath_scale):
+            os.makedirs(dpath_scale)
+        scale_fpaths = write_stand_configs(dpath_scale, max(stands), n_years, fpath_climate)
+        for n_stands in stands:
+            for engine in engines:
+                if 12 * n_years * n_stands > budget:
+                    report['scales'].append({'engine': engine, 'stands': n_stands,
+                        'years': n_years, 'skipped': 'over the stand-month budget'})
+                    continue
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    report['scales'].append(executor.submit(run_scale,
+                        scale_fpaths[:n_stands], n_years, engine).result())
+    return report
+
+
+def compare_reports(report, baseline, tolerance=0.2):
+    """
+    Output:
+        list of (name, baseline value, current value) for the module costs
+        and cold starts that grew, and the throughputs that dropped, by
+        more than tolerance
+    """
+    res = []
+    for phase in ['module_call_seconds', 'cold_start_seconds']:
+        current = report['phases'].get(phase, {})
+        for name, before in baseline['phases'].get(phase, {}).items():
+            if name in current and current[name] > before * (1 + tolerance):
+                res.append((name, before, current[name]))
+    scales = dict(((s['engine'], s['stands'], s['years']), s) for s in report['scales'])
+    for before in baseline['scales']:
+        key = (before['engine'], before['stands'], before['years'])
+        if 'skipped' in before or 'skipped' in scales.get(key, {'skipped': 1}):
+            continue
+        now = scales[key]['stand_months_per_second']
+        if now < before['stand_months_per_second'] * (1 - tolerance):
+            res.append(('%s %d stands %d years' % key,
+                before['stand_months_per_second'], now))
+    return res
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+"""
+Calibration of parameters against observed stand data
+
+The observations of a stand are read from a text file, one per line, '#'
+starting a comment:
+
+    # age   variable    value   sd
+    10      height      8.2     0.5
+    10      stemno      1180
+    25      basarea     31.5    2
+    25      standvol    290
+
+variable is an output name (as in [Output], case insensitive) and age the
+stand age of the measurement, compared with the simulated month closest to
+it. sd is the measurement error, relative_sd times the value when omitted.
+
+Objective maps parameter sets to the misfit 0.5 * sum(((sim - obs) / sd) ** 2),
+the negative log-likelihood of Gaussian errors up to a constant. A call
+evaluates a whole population: the parameter sets not seen before are run
+as the stands of BatchModel3PG, batch_size at a time and over workers
+processes, and the misfit of every parameter set is kept, so repeated
+ones are not run again.
+
+With spinup_age, the history of the stand up to that age is simulated once
+with the base config, and every evaluation resumes from there (as in
+ensemble.py). This only holds when the calibrated parameters do not act
+before spinup_age, e.g. when the state at that age is known from an
+inventory the base config reproduces, and all the observations must be
+at or after spinup_age.
+
+    config = load_config('stand.cfg')
+    names = ['alpha', 'MaxCond', 'wSx1000', 'fN0', 'SWconst0']
+    bounds = [(0.03, 0.06), (0.01, 0.03), (80, 300), (0.2, 1), (0.5, 0.8)]
+    with Objective(config, names, read_observations('plot.txt'), workers=4) as objective:
+        result = differential_evolution(objective, bounds, generations=50)
+        sample = metropolis(objective, bounds, 2000, x0=result.x)
+"""
+
+import collections
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from BatchModel3PG import BatchModel3PG
+from Model3PG import mapper
+from ensemble import run_spinup
+from parameters import compile_parameters
+from sweep import apply_values, find_option, latin_hypercube, prepare_config
+from utils import get_stand_age
+
+
+Observation = collections.namedtuple('Observation', ['age', 'variable', 'value', 'sd'])
+
+# the outcome of differential_evolution
+Result = collections.namedtuple('Result', ['x', 'cost', 'population', 'costs', 'history'])
+
+# the outcome of metropolis, samples and costs by (step, chain)
+Sample = collections.namedtuple('Sample', ['samples', 'costs', 'acceptance'])
+
+
+def make_observation(age, variable, value, sd=None, relative_sd=0.1):
+    """checked Observation, raises ValueError"""
+    age, variable, value = float(age), variable.lower(), float(value)
+    sd = relative_sd * abs(value) if sd is None else float(sd)
+    if variable not in mapper:
+        raise ValueError('unknown output %s' % variable)
+    if not sd > 0:
+        raise ValueError('the sd of %s must be positive' % variable)
+    return Observation(age, variable, value, sd)
+
+
+def read_observations(fpath, relative_sd=0.1):
+    """observations of an observation file, sorted by age"""
+    observations = []
+    with open(fpath) as handler:
+        for line_no, line in enumerate(handler, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) not in (3, 4):
+                raise ValueError('%s line %d: expected age, variable, value '
+                        'and optionally sd' % (fpath, line_no))
+            try:
+                observations.append(make_observation(*fields, relative_sd=relative_sd))
+            except ValueError as e:
+                raise ValueError('%s line %d: %s' % (fpath, line_no, e))
+    return sorted(observations, key=lambda observation: observation.age)
+
+
+def observed_rows(stand_age, observations):
+    """index of the simulated month closest to every observation"""
+    stand_age = np.asarray(stand_age, dtype=np.float64)
+    rows = []
+    for observation in observations:
+        row = int(np.argmin(np.abs(stand_age - observation.age)))
+        if abs(stand_age[row] - observation.age) > 1.0 / 24 + 1e-6:
+            raise ValueError('no simulated month at age %g' % observation.age)
+        rows.append(row)
+    return rows
+
+
+def simulate_members(config, names, rows, observations, resume_from=None):
+    """
+    Input:
+        config, as returned by sweep.prepare_config, recording stand_age
+            and the observed outputs
+        names, rows, the parameters and their values, one row per member
+    Output:
+        (n_members, n_observations) simulated values
+    """
+    configs = [apply_values(config, names, row) for row in rows]
+    model = BatchModel3PG(configs, resume_from=resume_from)
+    try:
+        model.run()
+        records = model.keeper.records
+    finally:
+        model.teardown()
+    index = observed_rows(records['stand_age'][:, 0], observations)
+    return np.stack([records[observation.variable][row]
+        for observation, row in zip(observations, index)], axis=1)
+
+
+def simulate_chunk(args):
+    return simulate_members(*args)
+
+
+class Objective(object):
+    """misfit of parameter sets to the observations of a stand, see the
+    module docstring; call close (or use it as a context manager) to stop
+    the worker processes and remove the spin-up"""
+
+    def __init__(self, config, names, observations, batch_size=500, workers=None,
+            spinup_age=None):
+        super(Objective, self).__init__()
+        if not observations:
+            raise ValueError('no observations to calibrate against')
+        for name in names:
+            find_option(config, name)
+        self.names = list(names)
+        self.observations = list(observations)
+        self.batch_size = batch_size
+        self.workers = workers
+        outputs = sorted(set(['stand_age'] + [o.variable for o in self.observations]))
+        self.config = prepare_config(config, outputs)
+        self.values = np.array([o.value for o in self.observations])
+        self.sd = np.array([o.sd for o in self.observations])
+        # parameter set (tuple of floats) -> misfit
+        self.memo = {}
+        self.hits = 0
+        self.evaluations = 0
+        self.executor = None
+        self.dpath_spinup = None
+        self.resume_from = None
+        if spinup_age is not None:
+            self.spinup(int(spinup_age))
+
+    def spinup(self, age):
+        params = compile_parameters(self.config)
+        params_time = params.TimeRange
+        StartAge = get_stand_age(self.config.SiteCharacteristics.lat,
+                params_time.initialyear, params_time.initialmonth,
+                params_time.yearplanted, params_time.monthplanted, params_time.endage)[1]
+        if not StartAge < age <= params_time.endage:
+            raise ValueError('spin-up age %d is outside of the simulated years' % age)
+        first = min(observation.age for observation in self.observations)
+        if first < age:
+            raise ValueError('observation at age %g, before the spin-up age %d' % (first, age))
+        self.dpath_spinup = tempfile.mkdtemp(prefix='calibration_')
+        self.resume_from = os.path.join(self.dpath_spinup, 'spinup.npz')
+        run_spinup(self.config, age, self.resume_from, verbose=False)
+
+    def simulate(self, design):
+        """(n_members, n_observations) simulated values of design"""
+        chunks = [(self.config, self.names, design[start:start + self.batch_size],
+            self.observations, self.resume_from)
+            for start in range(0, len(design), self.batch_size)]
+        if self.workers and self.workers > 1 and len(chunks) > 1:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            results = list(self.executor.map(simulate_chunk, chunks))
+        else:
+            results = [simulate_chunk(chunk) for chunk in chunks]
+        return np.concatenate(results)
+
+    def misfit(self, simulated):
+        res = 0.5 * np.sum(((simulated - self.values) / self.sd) ** 2, axis=1)
+        return np.where(np.isfinite(res), res, np.inf)
+
+    def __call__(self, design):
+        """misfit of every row of design, (n_members, len(names))"""
+        design = np.atleast_2d(np.asarray(design, dtype=float))
+        keys = [tuple(row) for row in design.tolist()]
+        new = sorted(set(key for key in keys if key not in self.memo))
+        self.hits += len(keys) - len(new)
+        if new:
+            self.evaluations += len(new)
+            costs = self.misfit(self.simulate(np.array(new)))
+            self.memo.update(zip(new, costs.tolist()))
+        return np.array([self.memo[key] for key in keys])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.dpath_spinup is not None:
+            shutil.rmtree(self.dpath_spinup, ignore_errors=True)
+            self.dpath_spinup = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def differential_evolution(objective, bounds, popsize=15, generations=100,
+        F=0.8, CR=0.9, tol=1e-6, seed=None, callback=None):
+    """
+    Input:
+        objective, callable mapping a (n, k) design to n costs, e.g. Objective
+        bounds, (low, high) of the k parameters
+        popsize, members per parameter
+        generations, at most this many generations
+        F, CR, differential weight and crossover probability
+        tol, stop once the spread of the costs is below tol times their mean
+        callback, called with (generation, population, costs) after each one
+    Output:
+        Result, the best parameters and cost, the last population and its
+        costs, and the best cost of every generation
+    Description:
+        DE/rand/1/bin (Storn and Price 1997), the trial members of a
+        generation are evaluated in one call of objective
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    rng = np.random.default_rng(seed)
+    n, k = max(popsize * len(bounds), 4), len(bounds)
+    population = latin_hypercube(bounds, n, rng)
+    costs = objective(population)
+    history = [float(np.min(costs))]
+    others = np.array([np.delete(np.arange(n), i) for i in range(n)])
+    for generation in range(generations):
+        picks = np.array([rng.choice(row, 3, replace=False) for row in others])
+        a, b, c = population[picks[:, 0]], population[picks[:, 1]], population[picks[:, 2]]
+        mutant = np.clip(a + F * (b - c), bounds[:, 0], bounds[:, 1])
+        cross = rng.random((n, k)) < CR
+        cross[np.arange(n), rng.integers(k, size=n)] = True
+        trial = np.where(cross, mutant, population)
+        trial_costs = objective(trial)
+        better = trial_costs <= costs
+        population[better] = trial[better]
+        costs[better] = trial_costs[better]
+        history.append(float(np.min(costs)))
+        if callback is not None:
+            callback(generation, population, costs)
+        if np.all(np.isfinite(costs)) and np.std(costs) <= tol * abs(np.mean(costs)):
+            break
+    best = int(np.argmin(costs))
+    return Result(population[best].copy(), float(costs[best]), population, costs, history)
+
+
+def metropolis(objective, bounds, n_steps, n_chains=8, step=0.05, x0=None, seed=None):
+    """
+    Input:
+        objective, the negative log-likelihood of a (n, k) design
+        bounds, (low, high) of the k parameters, a uniform prior
+        n_steps, steps of every chain
+        n_chains, chains advanced together, their proposals evaluated in
+            one call of objective
+        step, sd of the Gaussian proposals relative to the widths of bounds
+        x0, start of the chains, spread over bounds when None
+    Output:
+        Sample, the states and costs of the chains (n_steps, n_chains, k)
+        and (n_steps, n_chains), and the acceptance rate of every chain
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    rng = np.random.default_rng(seed)
+    low, high = bounds[:, 0], bounds[:, 1]
+    scale = step * (high - low)
+    if x0 is None:
+        x = latin_hypercube(bounds, n_chains, rng)
+    else:
+        x = np.clip(np.asarray(x0, dtype=float) +
+                rng.normal(size=(n_chains, len(bounds))) * scale, low, high)
+    cost = objective(x)
+    samples = np.zeros((n_steps, n_chains, len(bounds)))
+    costs = np.zeros((n_steps, n_chains))
+    accepted = np.zeros(n_chains)
+    for i in range(n_steps):
+        proposal = x + rng.normal(size=x.shape) * scale
+        inside = np.all((proposal >= low) & (proposal <= high), axis=1)
+        proposal_cost = np.full(n_chains, np.inf)
+        if inside.any():
+            proposal_cost[inside] = objective(proposal[inside])
+        with np.errstate(invalid='ignore'):
+            accept = np.log(rng.random(n_chains)) < cost - proposal_cost
+        x[accept] = proposal[accept]
+        cost[accept] = proposal_cost[accept]
+        accepted += accept
+        samples[i] = x
+        costs[i] = cost
+    return Sample(samples, costs, accepted / n_steps)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints of a running simulation
+
+A checkpoint is taken at the end of a simulated year and holds the stand
+state carried from one month to the next, the position in the climate
+series (metMonth) and the shrub counter, as float64 arrays in one .npz
+file. Scalars round-trip exactly, so a run resumed from a checkpoint
+continues bit-identically; the values may also be arrays over a stand axis.
+"""
+
+import os
+
+import numpy as np
+
+
+# variables carried over from one month to the next
+state_names = ['WF', 'WR', 'WS', 'StemNo', 'ASW', 'LAI', 'stand_age',
+        'TotalLitter', 'delStemNo', 'avDBH', 'AvStemMass', 'BasArea',
+        'StandVol', 'MAI', 'Height', 'CounterforShrub', 'irrig']
+
+
+class Checkpoint(object):
+    __slots__ = ('year', 'metMonth', 'state')
+
+    def __init__(self, year, metMonth, state):
+        self.year = year
+        self.metMonth = metMonth
+        self.state = state
+
+
+def save_checkpoint(fpath, year, metMonth, env):
+    """
+    Input:
+        fpath, path of the .npz file
+        year, the simulated year that just ended
+        metMonth, index of the next month in the climate series
+        env, mapping holding (at least) the variables of state_names
+    """
+    arrays = dict((name, np.asarray(env[name], dtype=np.float64)) for name in state_names)
+    fpath_tmp = fpath + '.tmp'
+    with open(fpath_tmp, 'wb') as handler:
+        np.savez(handler, year=year, metMonth=metMonth, **arrays)
+    os.replace(fpath_tmp, fpath)
+
+
+def load_checkpoint(fpath):
+    with np.load(fpath) as archive:
+        missing = [name for name in state_names if name not in archive.files]
+        if missing:
+            raise ValueError('%s is not a checkpoint, missing %s' % (fpath, ', '.join(missing)))
+        state = {}
+        for name in state_names:
+            value = archive[name]
+            state[name] = value.item() if value.ndim == 0 else value
+        return Checkpoint(int(archive['year']), int(archive['metMonth']), state)
@@ -0,0 +1,122 @@
+'''
+File: cli.py
+Description: command line of the 3-PG model, installed as the 3pg command
+    (see bin/3pg.py for running it from the source tree)
+
+Only argparse is imported up front, the model and numpy are imported by
+the commands that need them.
+'''
+
+import argparse
+import os
+import sys
+
+
+def read_control_file(fpath):
+    from Model3PG import Model3PG
+    return Model3PG(fpath)
+
+
+def validate_control_file(fpath):
+    """
+    Description:
+        checks the control file the way a run would, without loading the
+        climate nor opening the output: the parameters, the outputs, the
+        output format and time range, the management events, and that the
+        input exists.
+        Raises ValueError on the first problem.
+    """
+    from framework import load_config, create_keeper
+    from parameters import compile_parameters
+    from outputs import plan_outputs
+    from management import management_events
+    from Model3PG import mapper, count_steps
+
+    if not os.path.isfile(fpath):
+        raise ValueError('no such file')
+    config = load_config(fpath)
+    if not hasattr(config, 'IO'):
+        raise ValueError('missing section [IO]')
+    params = compile_parameters(config)
+    plan_outputs(config.Output, mapper)
+    create_keeper(config.IO)
+    management_events(config.IO)
+    if not os.path.isfile(config.IO.input):
+        raise ValueError('missing climate input %s' % config.IO.input)
+    if count_steps(config, params) <= 0:
+        raise ValueError('the time range holds no month')
+
+
+def run_3pg(fpath_control):
+    # read the control file
+    try:
+        model_3pg = read_control_file(fpath_control)
+    except Exception as e:
+        print('%s is not a valid control file: %s' % (fpath_control, e))
+        return False
+    try:
+        model_3pg.run()
+    finally:
+        model_3pg.teardown()
+    return True
+
+
+def run_batch(fpaths_control, args):
+    from runner import run_batch, write_summary
+    results = run_batch(fpaths_control, args.workers, args.chunksize, args.timeout)
+    write_summary(args.summary, results)
+    n_failed = sum(1 for result in results if result[1] != 'ok')
+    print('%d runs, %d failed, summary in %s' % (len(results), n_failed, args.summary))
+    return n_failed == 0
+
+
+def validate(fpaths_control):
+    ok = True
+    for fpath in fpaths_control:
+        try:
+            validate_control_file(fpath)
+        except Exception as e:
+            ok = False
+            print('%s\tinvalid\t%s' % (fpath, e))
+        else:
+            print('%s\tok' % fpath)
+    return ok
+
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]),
+            description='run the 3-PG model for the given control files')
+    parser.add_argument('control', nargs='*', help='control files')
+    parser.add_argument('-m', '--manifest',
+            help='file listing control files, one per line (implies batch mode)')
+    parser.add_argument('-j', '--workers', type=int,
+            help='run in batch mode over this many processes')
+    parser.add_argument('--chunksize', type=int, default=1,
+            help='control files handed to a worker at a time (batch mode)')
+    parser.add_argument('--timeout', type=float,
+            help='seconds allowed for each run (batch mode)')
+    parser.add_argument('--summary', default='batch_summary.txt',
+            help='status, wall time and error of each run (batch mode)')
+    parser.add_argument('--validate', '--dry-run', dest='validate', action='store_true',
+            help='only check the control files, without loading climate nor running')
+    args = parser.parse_args(argv[1:])
+
+    fpaths = list(args.control)
+    if args.manifest:
+        from runner import read_manifest
+        fpaths.extend(read_manifest(args.manifest))
+    if not fpaths:
+        print('Please provide at least one control file for running the model')
+        return 2
+    if args.validate:
+        ok = validate(fpaths)
+    elif args.manifest or args.workers:
+        ok = run_batch(fpaths, args)
+    else:
+        ok = all([run_3pg(fpath) for fpath in fpaths])
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
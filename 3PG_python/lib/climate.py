@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Climate store, monthly climate series read by column name
+
+The tab separated input is parsed once and saved as a .npy file (plus a
+small .json header) in a cache directory, keyed by the SHA-1 of the bytes
+of the input, so an edited file is never served from a stale copy. Later
+loads hash the file and map the .npy file read-only instead of parsing the
+text again, and loads within one process share the mapping.
+
+The cache directory is the climate_cache option of [IO], else the
+PY3PG_CACHE_DIR environment variable, else ~/.cache/py3pg/climate.
+
+A ClimateStream instead pulls the rows one at a time from any iterable,
+e.g. stream_climate reading the file a chunk at a time, or a generator fed
+by a downscaling pipeline, so the length of a run is not bounded by memory.
+"""
+
+import hashlib
+import io
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# climates already loaded by this process, keyed by the digest of the file
+loaded = {}
+
+
+def normalize(name):
+    """'Solar rad' -> 'solar_rad', 'Tav' -> 'tav'"""
+    return '_'.join(name.strip().lower().split())
+
+
+class Climate(object):
+    """monthly climate series, one row per month"""
+
+    def __init__(self, data, columns, digest=None):
+        super(Climate, self).__init__()
+        self.data = data
+        self.columns = [normalize(name) for name in columns]
+        self.index = dict((name, i) for i, name in enumerate(self.columns))
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.data)
+
+    def position(self, name):
+        key = normalize(name)
+        if key not in self.index:
+            raise KeyError('no climate column %s, available: %s' %
+                    (name, ', '.join(self.columns)))
+        return self.index[key]
+
+    def column(self, name):
+        return self.data[:, self.position(name)]
+
+    def records(self, start=0):
+        """iterator over the rows, from row start on"""
+        return iter(np.asarray(self.data[start:]))
+
+
+class ClimateStream(Climate):
+    """monthly climate pulled row by row from an iterable, never held
+    whole in memory; it is read once, front to back"""
+
+    def __init__(self, rows, columns):
+        super(ClimateStream, self).__init__(None, columns)
+        self.rows = iter(rows)
+        self.n_read = 0
+
+    def __len__(self):
+        raise TypeError('the length of a climate stream is unknown')
+
+    def column(self, name):
+        raise TypeError('a climate stream cannot be read by column')
+
+    def records(self, start=0):
+        if start < self.n_read:
+            raise ValueError('the climate stream is already past row %d' % start)
+        for row in self.rows:
+            self.n_read += 1
+            if self.n_read > start:
+                yield row
+
+
+def read_climate_chunks(fpath, chunk_rows=1200):
+    """rows of the tab separated climate file, parsed chunk_rows lines
+    at a time"""
+    with open(fpath) as handler:
+        handler.readline()
+        while True:
+            lines = [line for line in itertools.islice(handler, chunk_rows) if line.strip()]
+            if not lines:
+                break
+            for row in np.loadtxt(lines, ndmin=2):
+                yield row
+
+
+def stream_climate(fpath, chunk_rows=1200):
+    """ClimateStream over the climate file, see read_climate_chunks"""
+    with open(fpath) as handler:
+        columns = handler.readline().rstrip('\r\n').split('\t')
+    return ClimateStream(read_climate_chunks(fpath, chunk_rows), columns)
+
+
+def default_cache_dir():
+    return os.environ.get('PY3PG_CACHE_DIR',
+            os.path.join(os.path.expanduser('~'), '.cache', 'py3pg', 'climate'))
+
+
+def parse_climate(content):
+    """Climate of the bytes of a tab separated climate file, first line is
+    the header"""
+    header = content.split(b'\n', 1)[0].decode('utf-8')
+    columns = header.rstrip('\r').split('\t')
+    data = np.loadtxt(io.BytesIO(content), skiprows=1, ndmin=2)
+    return Climate(data, columns, hashlib.sha1(content).hexdigest())
+
+
+def read_climate_text(fpath):
+    """parse the tab separated climate file, first line is the header"""
+    with open(fpath, 'rb') as handler:
+        return parse_climate(handler.read())
+
+
+def replace_atomic(fpath, write):
+    """call write with a file object open on a temporary file of the
+    directory of fpath, then move it to fpath, so readers never see half
+    a file and concurrent writers never share a temporary name"""
+    fd, fpath_tmp = tempfile.mkstemp(dir=os.path.dirname(fpath),
+            prefix=os.path.basename(fpath) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as handler:
+            write(handler)
+        os.replace(fpath_tmp, fpath)
+    except BaseException:
+        try:
+            os.remove(fpath_tmp)
+        except OSError:
+            pass
+        raise
+
+
+def load_climate(fpath, cache_dir=None):
+    """
+    Input:
+        fpath, path of the tab separated climate file
+        cache_dir, where the binary copies are kept, see default_cache_dir
+    Output:
+        Climate, whose data is a read-only memory map of the cached copy
+    """
+    with open(fpath, 'rb') as handler:
+        content = handler.read()
+    digest = hashlib.sha1(content).hexdigest()
+    if digest in loaded:
+        return loaded[digest]
+
+    cache_dir = cache_dir or default_cache_dir()
+    fpath_npy = os.path.join(cache_dir, digest + '.npy')
+    fpath_meta = os.path.join(cache_dir, digest + '.json')
+
+    try:
+        with open(fpath_meta) as handler:
+            meta = json.load(handler)
+        if meta['digest'] != digest:
+            raise ValueError('stale climate cache %s' % fpath_meta)
+        climate = Climate(np.load(fpath_npy, mmap_mode='r'), meta['columns'], digest)
+    except (IOError, OSError, ValueError, KeyError):
+        climate = parse_climate(content)
+        meta = {'columns': climate.columns, 'digest': digest}
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # the .npy file first, a .json file always has its data
+            replace_atomic(fpath_npy, lambda handler: np.save(handler, climate.data))
+            replace_atomic(fpath_meta,
+                    lambda handler: handler.write(json.dumps(meta).encode('utf-8')))
+        except (IOError, OSError):
+            pass # no writable cache, keep the parsed copy
+
+    loaded[digest] = climate
+    return climate
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Climate drivers precomputed over a climate series
+
+Part of a month of canopy production and water balance depends on the
+climate and the parameters only, not on the stand: the temperature, VPD,
+frost and nutrition modifiers, the temperature term TK2 + TK3 * T_av of the
+canopy conductance, PAR, the day length and the number of days. They are
+evaluated for every row of the climate series in one pass of array
+operations, and the monthly loops hand the drivers of the month to
+canopy_production (drivers=) and water_balance, which then only evaluate
+the terms depending on the stand state (soil water, age, LAI).
+
+The drivers are kept by climate digest, parameter values, latitude and
+first month, so later runs, and the stands of a batch sharing a climate
+file and those parameters, reuse them.
+"""
+
+import collections
+
+import numpy as np
+
+from CanopyProduction import calc_modifier_temp, calc_modifier_temp_batch, \
+        calc_modifier_VPD, calc_modifier_frost, calc_modifier_soilnutrition, \
+        calc_conductance_temperature_batch, calc_PAR
+from lookup import day_length_table, days_in_month_table
+
+
+# parameters the drivers depend on
+driver_parameters = [('CanopyProduction', 't_min'), ('CanopyProduction', 't_max'),
+        ('CanopyProduction', 't_opt'), ('CanopyProduction', 'coeffcond'),
+        ('CanopyProduction', 'kf'), ('CanopyProduction', 'fr'),
+        ('CanopyProduction', 'fn0'),
+        ('BiomassPartition', 'tk2'), ('BiomassPartition', 'tk3')]
+
+# the canopy drivers, in the order of the drivers argument of canopy_production
+canopy_drivers = ['modifier_temperature', 'modifier_VPD', 'modifier_frost',
+        'modifier_nutrition', 'conductance_temperature', 'PAR']
+
+driver_names = canopy_drivers + ['day_length', 'days_in_month']
+
+# drivers of the climates with a digest, least recently used first
+cache = collections.OrderedDict()
+max_cached = 64
+
+
+class Drivers(object):
+    """drivers by name, arrays with the climate rows on the last axis"""
+    __slots__ = driver_names
+
+    def __init__(self, values):
+        for name, value in zip(driver_names, values):
+            setattr(self, name, value)
+
+    def rows(self):
+        """(canopy drivers, day_length, days_in_month) of every row, as floats"""
+        canopy = list(zip(*[getattr(self, name).tolist() for name in canopy_drivers]))
+        return list(zip(canopy, self.day_length.tolist(), self.days_in_month.tolist()))
+
+    def take(self, index, row):
+        """(canopy drivers, day_length, days_in_month) of row for a batch,
+        index selecting the drivers of every stand, None if they all share
+        the first (the drivers are then scalars)"""
+        if index is None:
+            index = 0
+        canopy = tuple(getattr(self, name)[index, row] for name in canopy_drivers)
+        return canopy, self.day_length[index, row], self.days_in_month[index, row]
+
+    def astype(self, dtype):
+        """copy of the drivers as arrays of dtype"""
+        return Drivers([getattr(self, name).astype(dtype) for name in driver_names])
+
+
+def row_months(InitialMonth, n_rows):
+    """the month Model3PG.run uses at each row of the climate series, a year
+    of rows starting at InitialMonth (12 is read as 1, as in the run)"""
+    month = InitialMonth + (np.arange(n_rows) - InitialMonth) % 12
+    return np.where(month >= 12, month - 11, month)
+
+
+def parameter_values(params):
+    """values of driver_parameters, scalars or arrays over the stands"""
+    return [getattr(getattr(params, section), name) for section, name in driver_parameters]
+
+
+def precompute_drivers(climate, values, lat, InitialMonth, scalar=False):
+    """
+    Input:
+        climate, climate.Climate
+        values, the scalar values of driver_parameters
+        lat, InitialMonth
+        scalar, evaluate the temperature and VPD modifiers row by row with
+            the functions of canopy_production, as numpy's power and exp may
+            differ from them in the last bit; Model3PG then gives the same
+            results as without drivers (canopy_production_batch uses numpy)
+    Output:
+        Drivers over the rows of climate
+    """
+    T_min, T_max, T_opt, CoeffCond, kF, FR, fN0, TK2, TK3 = values
+    T_av = climate.column('Tav')
+    VPD = climate.column('VPD')
+    index = row_months(InitialMonth, len(climate)) % 12
+    days_in_month = np.array(days_in_month_table, dtype=np.float64)[index]
+    day_length = np.array(day_length_table(lat), dtype=np.float64)[index]
+    if scalar:
+        modifier_temperature = np.array([calc_modifier_temp(t, T_min, T_max, T_opt)
+            for t in T_av.tolist()], dtype=np.float64)
+        modifier_VPD = np.array([calc_modifier_VPD(v, CoeffCond) for v in VPD.tolist()])
+    else:
+        modifier_temperature = calc_modifier_temp_batch(T_av, T_min, T_max, T_opt)
+        modifier_VPD = np.exp(-1 * CoeffCond * VPD)
+    return Drivers([modifier_temperature, modifier_VPD,
+        calc_modifier_frost(np.trunc(climate.column('Frost Days')), kF),
+        np.full(len(climate), calc_modifier_soilnutrition(FR, fN0)),
+        calc_conductance_temperature_batch(T_av, TK2, TK3),
+        calc_PAR(climate.column('Solar rad'), days_in_month),
+        day_length, days_in_month])
+
+
+def climate_drivers(climate, values, lat, InitialMonth, scalar=False):
+    """precompute_drivers, kept for the climates with a digest"""
+    if climate.digest is None:
+        return precompute_drivers(climate, values, lat, InitialMonth, scalar)
+    key = (climate.digest, tuple(float(value) for value in values), float(lat),
+            InitialMonth, scalar)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    drivers = precompute_drivers(climate, values, lat, InitialMonth, scalar)
+    cache[key] = drivers
+    while len(cache) > max_cached:
+        cache.popitem(last=False)
+    return drivers
+
+
+def batch_drivers(climates, climate_index, params, lats, InitialMonth):
+    """
+    Input:
+        climates, list of climate.Climate
+        climate_index, climate of every stand
+        params, stacked parameters (see parameters.stack_parameters)
+        lats, latitude of every stand
+    Output:
+        Drivers stacked over the distinct (climate, parameters, latitude)
+        of the stands, and the position of every stand in that stack (None
+        when there is one, see Drivers.take)
+    """
+    n_stands = len(climate_index)
+    columns = [np.broadcast_to(value, (n_stands,)).tolist() for value in
+            parameter_values(params) + [lats]]
+    keys = [(int(climate_index[i]),) + tuple(column[i] for column in columns)
+            for i in range(n_stands)]
+    unique = sorted(set(keys))
+    position = dict((key, i) for i, key in enumerate(unique))
+    stacked = [climate_drivers(climates[key[0]], key[1:-1], key[-1], InitialMonth)
+            for key in unique]
+    drivers = Drivers([np.stack([getattr(d, name) for d in stacked]) for name in driver_names])
+    if len(unique) == 1:
+        return drivers, None
+    return drivers, np.array([position[key] for key in keys])
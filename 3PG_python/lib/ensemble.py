@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Climate ensembles of one stand
+
+The members are climate files that share their history up to fork_year
+and diverge afterwards. The shared prefix is simulated once by Model3PG,
+which leaves a checkpoint at the end of the last shared year (its output
+goes to the [IO] output of the config as usual). From that checkpoint all
+the members are then advanced together by BatchModel3PG, one member per
+stand, and their outputs are gathered by an EnsembleRecorder:
+
+    recorder = run_ensemble('stand.cfg', ['member_01.txt', ...], 2013)
+    recorder.values       # (member, month, variable)
+    recorder.summaries    # (month, percentile, variable)
+    recorder.names        # the variables
+
+The member climate files hold the whole series, the shared prefix included,
+so that the months line up with the control file.
+"""
+
+import os
+
+import numpy as np
+
+from framework import load_config, copy_config
+from parameters import compile_parameters
+from utils import get_stand_age
+from Model3PG import Model3PG
+from BatchModel3PG import BatchModel3PG
+
+
+class EnsembleRecorder(object):
+    """sink of the members' book keeper, see framework.StreamBookKepper
+
+    keeps every output as a (member, month, variable) array, in memory or
+    memory-mapped to fpath (.npy), and the percentiles over the members of
+    every month as a (month, percentile, variable) array, computed block by
+    block while the run goes"""
+
+    def __init__(self, n_members, n_steps, percentiles=(5, 50, 95), fpath=None):
+        super(EnsembleRecorder, self).__init__()
+        self.n_members = n_members
+        self.n_steps = n_steps
+        self.percentiles = list(percentiles)
+        self.fpath = fpath
+        self.names = None
+        self.values = None
+        self.summaries = None
+        self.n_kept = 0
+
+    def allocate(self, names):
+        self.names = list(names)
+        shape = (self.n_members, self.n_steps, len(self.names))
+        if self.fpath:
+            self.values = np.lib.format.open_memmap(self.fpath, mode='w+',
+                    dtype=np.float64, shape=shape)
+        else:
+            self.values = np.zeros(shape)
+        self.summaries = np.zeros((self.n_steps, len(self.percentiles), len(self.names)))
+
+    def __call__(self, block):
+        if self.values is None:
+            self.allocate(block.dtype.names)
+        # (month, member, variable)
+        stacked = np.stack([block[name] for name in self.names], axis=-1)
+        end = self.n_kept + len(block)
+        self.values[:, self.n_kept:end] = stacked.transpose(1, 0, 2)
+        self.summaries[self.n_kept:end] = np.percentile(stacked,
+                self.percentiles, axis=1).transpose(1, 0, 2)
+        self.n_kept = end
+
+    def summary(self, name, percentile):
+        """monthly series of one percentile of one variable"""
+        return self.summaries[:, self.percentiles.index(percentile), self.names.index(name)]
+
+
+def fork_age(config, params, fork_year):
+    """the simulated year (stand age) of the calendar year fork_year"""
+    params_time = params.TimeRange
+    StartAge = get_stand_age(config.SiteCharacteristics.lat,
+            params_time.initialyear, params_time.initialmonth,
+            params_time.yearplanted, params_time.monthplanted, params_time.endage)[1]
+    return StartAge + fork_year - params_time.initialyear, StartAge
+
+
+def run_spinup(config, age, fpath_checkpoint, verbose=True):
+    """simulate config up to the end of the simulated year age - 1 with
+    Model3PG, leaving the state there in fpath_checkpoint for the runs
+    resumed at age"""
+    spinup = copy_config(config)
+    spinup.TimeRange.endage = str(age - 1)
+    spinup.IO.checkpoint = fpath_checkpoint
+    spinup.IO.checkpoint_every = str(age)
+    model = Model3PG(None, config=spinup, verbose=verbose)
+    model.run()
+    model.teardown()
+
+
+def run_ensemble(fpath_config, fpaths_members, fork_year, percentiles=(5, 50, 95),
+        fpath_checkpoint=None, fpath_values=None):
+    """
+    Input:
+        fpath_config, control file of the stand
+        fpaths_members, climate files of the members
+        fork_year, first calendar year in which the members differ
+        percentiles, summaries computed over the members
+        fpath_checkpoint, state at the fork, next to the output by default
+        fpath_values, .npy file of the member outputs, in memory if None
+    Output:
+        EnsembleRecorder
+    """
+    config = load_config(fpath_config)
+    params = compile_parameters(config)
+    age, StartAge = fork_age(config, params, fork_year)
+    if not StartAge < age <= params.TimeRange.endage:
+        raise ValueError('fork year %d is outside of the simulated years' % fork_year)
+    if fpath_checkpoint is None:
+        fpath_checkpoint = os.path.splitext(config.IO.output)[0] + '_fork.npz'
+
+    # shared history, up to the end of the simulated year age - 1
+    run_spinup(config, age, fpath_checkpoint)
+
+    members = []
+    for fpath in fpaths_members:
+        member = copy_config(config)
+        member.IO.input = fpath
+        members.append(member)
+    recorder = EnsembleRecorder(len(members),
+            12 * (params.TimeRange.endage - age + 1), percentiles, fpath_values)
+    batch = BatchModel3PG(members, resume_from=fpath_checkpoint, sink=recorder)
+    batch.run()
+    batch.teardown()
+    if fpath_values:
+        recorder.values.flush()
+    return recorder
@@ -2,29 +2,47 @@
 
 from configparser import SafeConfigParser
 
+import numpy as np
+
+def select_outputs(config):
+    """names of the variables switched on in the [Output] section"""
+    list_out = []
+    for name in dir(config):
+        if not name.startswith('_'):
+            if getattr(config, name) == '1':
+                list_out.append(name)
+    return list_out
+
+
 class BookKepper(object):
-    """a book keeper class, for output calculation results at each step"""
+    """a book keeper class, for output calculation results at each step
+
+    lines are tab separated and written block_size steps at a time
+    """
 
-    def __init__(self, fpath):
+    def __init__(self, fpath, block_size=256, n_stands=None, precision='float64'):
         super(BookKepper, self).__init__()
         self.fpath = fpath
+        self.block_size = block_size
+        self.n_stands = n_stands
+        self.precision = precision
+        self.handler = None
 
     def open(self):
         self.handler = open(self.fpath, 'w+')
 
     def shutdown(self):
+        self.flush()
         if self.handler:
             self.handler.close()
 
     def write(self, message):
         self.handler.write(message)
 
-    def initialize(self, config):
-        self.list_out = []
-        for name in dir(config):
-            if not name.startswith('_'):
-                if getattr(config, name) == '1':
-                    self.list_out.append(name)
+    def initialize(self, config, n_steps=None):
+        self.list_out = select_outputs(config)
+        self.n_steps = n_steps
+        self.lines = []
         self.open()
         
         self.handler.write('\t'.join(self.list_out) + '\n')
@@ -32,15 +50,328 @@ class BookKepper(object):
     def keep(self, mapper, env):
         v_out = [env[mapper[name]] for name in self.list_out]
         message = '\t'.join(str(v) for v in v_out)
-        self.write('%s\n' % message)
+        self.lines.append('%s\n' % message)
+        if len(self.lines) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.write(''.join(self.lines))
+            self.lines = []
+
+
+class BatchBookKepper(BookKepper):
+    """book keeper for the batched model, one line per stand and step,
+    prefixed with the stand index"""
+
+    def open(self):
+        super(BatchBookKepper, self).open()
+        self.handler.write('stand\t')
+
+    def keep(self, mapper, env):
+        n_stands = env['n_stands']
+        columns = [np.broadcast_to(env[mapper[name]], (n_stands,)).tolist()
+                for name in self.list_out]
+        for stand, v_out in enumerate(zip(*columns)):
+            self.lines.append('%d\t%s\n' % (stand, '\t'.join(str(v) for v in v_out)))
+        if len(self.lines) >= self.block_size * n_stands:
+            self.flush()
+
+
+class ArrayBookKepper(BookKepper):
+    """base class of the binary book keepers, steps are gathered in a
+    record array of block_size rows (times n_stands for a batch) and
+    handed to write_block once the buffer is full, the values are kept
+    as floats of precision (float64 or float32)"""
+
+    def initialize(self, config, n_steps=None):
+        self.list_out = select_outputs(config)
+        self.n_steps = n_steps
+        self.dtype = np.dtype([(name, self.precision) for name in self.list_out])
+        self.shape = () if self.n_stands is None else (self.n_stands,)
+        self.buffer = np.zeros((self.block_size,) + self.shape, self.dtype)
+        self.n_buffered = 0
+        self.n_kept = 0
+        self.open()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        self.flush()
+        self.close()
+
+    def keep(self, mapper, env):
+        i = self.n_buffered
+        for name in self.list_out:
+            self.buffer[name][i] = env[mapper[name]]
+        self.n_buffered = i + 1
+        if self.n_buffered == self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered:
+            self.write_block(self.buffer[:self.n_buffered])
+            self.n_kept += self.n_buffered
+            self.n_buffered = 0
+
+    def write_block(self, block):
+        raise Exception('Not Impelemnted')
+
+
+class RecordBookKepper(ArrayBookKepper):
+    """keeps the outputs in memory, in a record array preallocated for
+    n_steps steps (grown as needed when n_steps is unknown)"""
+
+    def open(self):
+        n_rows = self.n_steps or self.block_size
+        self.store = np.zeros((n_rows,) + self.shape, self.dtype)
+
+    def write_block(self, block):
+        end = self.n_kept + len(block)
+        if end > len(self.store):
+            grown = np.zeros((max(end, 2 * len(self.store)),) + self.shape, self.dtype)
+            grown[:self.n_kept] = self.store[:self.n_kept]
+            self.store = grown
+        self.store[self.n_kept:end] = block
+
+    @property
+    def records(self):
+        self.flush()
+        return self.store[:self.n_kept]
+
+
+class NpyBookKepper(ArrayBookKepper):
+    """writes the outputs into a memory-mapped .npy file of n_steps rows,
+    readable with np.load(fpath, mmap_mode='r')"""
+
+    def open(self):
+        if self.n_steps is None:
+            raise ValueError('the npy output needs the number of steps in advance')
+        self.store = np.lib.format.open_memmap(self.fpath, mode='w+',
+                dtype=self.dtype, shape=(self.n_steps,) + self.shape)
+
+    def write_block(self, block):
+        self.store[self.n_kept:self.n_kept + len(block)] = block
+
+    def close(self):
+        self.store.flush()
+        self.store = None
+
+
+class ColumnarBookKepper(ArrayBookKepper):
+    """writes the outputs column by column, one chunk per block,
+    to a Parquet file (needs pyarrow) or an HDF5 file (needs h5py)
+    depending on the file extension"""
+
+    def open(self):
+        self.hdf5 = self.fpath.endswith(('.h5', '.hdf5'))
+        if self.hdf5:
+            import h5py
+            self.handler = h5py.File(self.fpath, 'w')
+            for name in self.list_out:
+                self.handler.create_dataset(name, shape=(0,) + self.shape,
+                        maxshape=(None,) + self.shape, dtype=self.precision,
+                        chunks=(self.block_size,) + self.shape)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            self.pyarrow = pyarrow
+            value_type = pyarrow.from_numpy_dtype(np.dtype(self.precision))
+            fields = [(name, value_type) for name in self.list_out]
+            if self.shape:
+                fields.insert(0, ('stand', pyarrow.int64()))
+            self.handler = pyarrow.parquet.ParquetWriter(self.fpath,
+                    pyarrow.schema(fields))
+
+    def write_block(self, block):
+        if self.hdf5:
+            for name in self.list_out:
+                dataset = self.handler[name]
+                dataset.resize(self.n_kept + len(block), axis=0)
+                dataset[self.n_kept:] = block[name]
+        else:
+            columns = dict((name, block[name].ravel()) for name in self.list_out)
+            if self.shape:
+                columns['stand'] = np.tile(np.arange(self.n_stands), len(block))
+            self.handler.write_table(self.pyarrow.Table.from_pydict(columns,
+                    schema=self.handler.schema))
+
+    def close(self):
+        self.handler.close()
+
+
+class StreamBookKepper(ArrayBookKepper):
+    """hands every block of block_size steps to sink, a callable taking a
+    record array, so that no more than one block is held"""
+
+    def __init__(self, sink, block_size=256, n_stands=None, precision='float64'):
+        super(StreamBookKepper, self).__init__(None, block_size, n_stands, precision)
+        self.sink = sink
+
+    def write_block(self, block):
+        self.sink(block.copy())
+
+
+# how each output is summarized over an aggregation period, the outputs
+# not listed keep their value at the end of the period
+aggregation_rules = {'npp': 'sum', 'gppdm': 'sum', 'par': 'sum',
+        'transp': 'sum', 'loss_water': 'sum', 'transpall': 'sum', 'transpshrub': 'sum',
+        'delwf': 'sum', 'delwr': 'sum', 'delws': 'sum',
+        'lai': 'mean', 'asw': 'mean', 'laishrub': 'mean',
+        'modifier_physiology': 'mean', 'canopy_conductance': 'mean',
+        'canopy_transpiration_sec': 'mean', 'd13ctissue': 'mean', 'intercippm': 'mean',
+        'd18oleaf': 'mean', 'd18ocell': 'mean', 'd18ocell_peclet': 'mean'}
+
+# floating point types of the [IO] option precision
+precisions = ('float64', 'float32')
+
+
+def read_precision(config_io):
+    """the [IO] option precision, float64 by default; float32 halves the
+    outputs and the state of BatchModel3PG, see there"""
+    precision = getattr(config_io, 'precision', 'float64').strip().lower()
+    if precision not in precisions:
+        raise ValueError('unknown precision %s, expected float64 or float32' % precision)
+    return precision
+
+
+# number of monthly steps of an aggregation period
+periods = {'monthly': 1, 'annual': 12, 'decadal': 120}
+
+
+class AggregatingBookKepper(object):
+    """keeps one summary per period of the outputs, instead of one row per
+    month, through another book keeper; each output is accumulated during
+    the run by its rule (sum, mean, min, max, or last for the value at the
+    end of the period)"""
+
+    def __init__(self, keeper, period, rules=None):
+        super(AggregatingBookKepper, self).__init__()
+        self.keeper = keeper
+        self.period = period
+        self.rules = rules or {}
+
+    def __getattr__(self, name):
+        # records, fpath... of the book keeper writing the summaries
+        if name == 'keeper':
+            raise AttributeError(name)
+        return getattr(self.keeper, name)
+
+    def initialize(self, config, n_steps=None):
+        self.list_out = select_outputs(config)
+        self.list_rules = [self.rules.get(name, aggregation_rules.get(name, 'last'))
+                for name in self.list_out]
+        for name, rule in zip(self.list_out, self.list_rules):
+            if rule not in ('sum', 'mean', 'min', 'max', 'last'):
+                raise ValueError('unknown aggregation %s of %s' % (rule, name))
+        self.identity = dict((name, name) for name in self.list_out)
+        self.values = {}
+        self.count = 0
+        self.n_stands = None
+        if n_steps is not None:
+            n_steps = -(-n_steps // self.period)
+        self.keeper.initialize(config, n_steps)
+
+    def keep(self, mapper, env):
+        values = self.values
+        first = self.count == 0
+        for name, rule in zip(self.list_out, self.list_rules):
+            value = env[mapper[name]]
+            if first or rule == 'last':
+                values[name] = value
+            elif rule == 'sum' or rule == 'mean':
+                values[name] = values[name] + value
+            elif rule == 'min':
+                values[name] = np.minimum(values[name], value)
+            else:
+                values[name] = np.maximum(values[name], value)
+        if first:
+            self.n_stands = env.get('n_stands')
+        self.count += 1
+        if self.count == self.period:
+            self.emit()
+
+    def emit(self):
+        env = dict(self.values)
+        for name, rule in zip(self.list_out, self.list_rules):
+            if rule == 'mean':
+                env[name] = env[name] / self.count
+        env['n_stands'] = self.n_stands
+        self.keeper.keep(self.identity, env)
+        self.values = {}
+        self.count = 0
+
+    def flush(self):
+        self.keeper.flush()
+
+    def shutdown(self):
+        # the last period may be incomplete
+        if self.count:
+            self.emit()
+        self.keeper.shutdown()
+
+
+keepers = {'tsv': BookKepper,
+        'records': RecordBookKepper,
+        'npy': NpyBookKepper,
+        'parquet': ColumnarBookKepper,
+        'hdf5': ColumnarBookKepper}
+
+
+def create_keeper(config_io, fpath=None, n_stands=None, sink=None, precision=None):
+    """
+    Input:
+        config_io, the [IO] section, with the optional options
+            format (tsv, records, npy, parquet or hdf5) and block_size,
+            aggregate (monthly, annual or decadal) and aggregate_rules
+            (e.g. lai:max, ws:mean) overriding aggregation_rules,
+            precision (float64 or float32) of the binary outputs
+        fpath, overrides the output option of [IO]
+        n_stands, number of stands of a batched model
+        sink, callable receiving the output blocks, overrides format
+        precision, overrides the precision option of [IO]
+    Output:
+        a book keeper, to be initialized with the [Output] section
+    """
+    block_size = int(getattr(config_io, 'block_size', 256))
+    if precision is None:
+        precision = read_precision(config_io)
+    if sink is not None:
+        keeper = StreamBookKepper(sink, block_size, n_stands, precision)
+    else:
+        fmt = getattr(config_io, 'format', 'tsv').strip().lower()
+        if fmt not in keepers:
+            raise ValueError('unknown output format %s' % fmt)
+        cls = keepers[fmt]
+        if cls is BookKepper and n_stands is not None:
+            cls = BatchBookKepper
+        keeper = cls(fpath or config_io.output, block_size, n_stands, precision)
+
+    aggregate = getattr(config_io, 'aggregate', 'monthly').strip().lower()
+    if aggregate not in periods:
+        raise ValueError('unknown aggregation period %s' % aggregate)
+    if periods[aggregate] == 1:
+        return keeper
+    rules = {}
+    for item in getattr(config_io, 'aggregate_rules', '').split(','):
+        if item.strip():
+            name, rule = item.split(':')
+            rules[name.strip().lower()] = rule.strip().lower()
+    return AggregatingBookKepper(keeper, periods[aggregate], rules)
 
 
 class Model(object):
-    def __init__(self, fpath_config):
+    def __init__(self, fpath_config, config=None):
         super(Model, self).__init__()
 
         self.fpath_config = fpath_config
-        self.config = load_config(fpath_config)
+        if config is None:
+            config = load_config(fpath_config)
+        self.config = config
 
         self.data = None
         self.bookeeper = None
@@ -73,6 +404,16 @@ def load_config(fpath_cfg):
     return res
 
 
+def copy_config(config):
+    """copy of a config returned by load_config, sections are copied too"""
+    res = Empty()
+    for section_name, section in vars(config).items():
+        copy = Empty()
+        vars(copy).update(vars(section))
+        setattr(res, section_name, copy)
+    return res
+
+
 if __name__ == '__main__':
     fpath_test = r'/Users/christopherstill/still/OSU/forestry/FES_599_Winter_2014/Py3PG/test/Test_config.cfg'
     m = Model(fpath_test)
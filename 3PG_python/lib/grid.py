@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""
+Gridded runs
+
+Every cell of a (y, x) grid is a stand with its own site parameters and
+climate. The inputs are
+    - parameter rasters, (y, x) arrays named after the config options they
+      replace (lat, elev, MaxASW, FR...), the other options come from the
+      control file
+    - the climate cube, (time, y, x) arrays named after the climate columns
+      read by the model (Tav, VPD, Rain, Solar rad, Frost Days, Ca, D13Catm,
+      d18O), with one step per row of the usual climate file
+each given as a directory of .npy files (memory-mapped, 'Solar rad' is
+solar_rad.npy) or as a NetCDF file (needs netCDF4).
+
+The grid is run tile by tile through BatchModel3PG, one stand per valid
+cell, so that only one tile of inputs is held at a time; the outputs of a
+tile are streamed to the cubes a block of steps at a time (block_size of
+[IO]), whatever the length of the run. Cells
+with a NaN (or the nodata value) in a raster or anywhere in their climate
+are skipped. The outputs selected in [Output] are written as (time, y, x)
+cubes, NaN in the skipped cells, to a directory of .npy files or to a
+NetCDF file.
+
+    run_grid('stand.cfg', 'params/', 'climate.nc', 'outputs/', tile=(32, 32))
+"""
+
+import os
+
+import numpy as np
+
+from framework import load_config, select_outputs
+from climate import Climate, normalize
+from sweep import apply_values
+from BatchModel3PG import BatchModel3PG
+
+
+# climate columns read by the model
+climate_names = ['Tav', 'VPD', 'Rain', 'Solar rad', 'Frost Days', 'Ca', 'D13Catm', 'd18O']
+
+
+class GridSource(object):
+    """arrays by (case insensitive) name, from a directory of .npy files
+    or a NetCDF file, read lazily slice by slice"""
+
+    def __init__(self, path):
+        super(GridSource, self).__init__()
+        self.path = path
+        self.netcdf = os.path.isfile(path)
+        if self.netcdf:
+            import netCDF4
+            self.dataset = netCDF4.Dataset(path)
+            self.dataset.set_auto_mask(False)
+            names = list(self.dataset.variables)
+        else:
+            self.dataset = None
+            names = [os.path.splitext(f)[0] for f in sorted(os.listdir(path))
+                    if f.endswith('.npy')]
+        self.index = dict((normalize(name), name) for name in names)
+
+    def names(self):
+        return sorted(self.index.values())
+
+    def __contains__(self, name):
+        return normalize(name) in self.index
+
+    def __getitem__(self, name):
+        key = normalize(name)
+        if key not in self.index:
+            raise KeyError('no variable %s in %s' % (name, self.path))
+        if self.netcdf:
+            return self.dataset.variables[self.index[key]]
+        return np.load(os.path.join(self.path, self.index[key] + '.npy'), mmap_mode='r')
+
+    def close(self):
+        if self.netcdf:
+            self.dataset.close()
+
+
+class CubeWriter(object):
+    """(time, y, x) output cubes, as .npy files of a directory or as the
+    variables of a NetCDF file, created once the number of steps is known"""
+
+    def __init__(self, path, names, shape):
+        super(CubeWriter, self).__init__()
+        self.path = path
+        self.names = names
+        self.shape = shape
+        self.netcdf = path.endswith('.nc')
+        self.cubes = None
+
+    def create(self, n_steps):
+        shape = (n_steps,) + self.shape
+        if self.netcdf:
+            import netCDF4
+            self.dataset = netCDF4.Dataset(self.path, 'w')
+            for dim, size in zip(('time', 'y', 'x'), shape):
+                self.dataset.createDimension(dim, size)
+            self.cubes = dict((name, self.dataset.createVariable(name, 'f8',
+                ('time', 'y', 'x'), fill_value=np.nan)) for name in self.names)
+        else:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.cubes = {}
+            for name in self.names:
+                cube = np.lib.format.open_memmap(os.path.join(self.path, name + '.npy'),
+                        mode='w+', dtype=np.float64, shape=shape)
+                cube[:] = np.nan
+                self.cubes[name] = cube
+
+    def write(self, y, x, valid, start, records):
+        """records, (time, cell) outputs of the valid cells of the tile at y, x,
+        from step start on"""
+        end = start + len(records)
+        for name in self.names:
+            block = np.full((len(records),) + valid.shape, np.nan)
+            block[:, valid] = records[name]
+            self.cubes[name][start:end, y:y + valid.shape[0], x:x + valid.shape[1]] = block
+
+    def close(self):
+        if self.cubes is None:
+            return
+        if self.netcdf:
+            self.dataset.close()
+        else:
+            for cube in self.cubes.values():
+                cube.flush()
+        self.cubes = None
+
+
+class TileSink(object):
+    """sink of the book keeper of a tile (see framework.StreamBookKepper),
+    writing every block of steps to the cubes as it comes"""
+
+    def __init__(self, writer, y, x, valid):
+        super(TileSink, self).__init__()
+        self.writer = writer
+        self.y = y
+        self.x = x
+        self.valid = valid
+        self.n_kept = 0
+
+    def __call__(self, block):
+        self.writer.write(self.y, self.x, self.valid, self.n_kept, block)
+        self.n_kept += len(block)
+
+
+def read_tile(params, climate, names, y, x, ny, nx, nodata=None):
+    """
+    Output:
+        valid, (ny, nx) mask of the cells to run
+        values, (cell, parameter) raster values of the valid cells
+        series, (cell, time, column) climate of the valid cells
+    """
+    rasters = np.stack([np.asarray(params[name][y:y + ny, x:x + nx], dtype=np.float64)
+        for name in names], axis=-1)
+    cube = np.stack([np.asarray(climate[name][:, y:y + ny, x:x + nx], dtype=np.float64)
+        for name in climate_names], axis=-1)
+    valid = np.isfinite(rasters).all(axis=-1) & np.isfinite(cube).all(axis=(0, -1))
+    if nodata is not None:
+        valid &= ~(rasters == nodata).any(axis=-1) & ~(cube == nodata).any(axis=(0, -1))
+    return valid, rasters[valid], cube[:, valid].transpose(1, 0, 2)
+
+
+def run_grid(fpath_config, path_params, path_climate, path_output,
+        tile=(64, 64), nodata=None):
+    """
+    Input:
+        fpath_config, control file holding the options common to every cell
+        path_params, parameter rasters, see GridSource
+        path_climate, climate cube, see GridSource
+        path_output, directory of .npy cubes or .nc file
+        tile, (y, x) size of the tiles
+        nodata, value marking the missing cells, besides NaN
+    Output:
+        number of cells run
+    """
+    config = load_config(fpath_config)
+    params = GridSource(path_params)
+    climate = GridSource(path_climate)
+    names = params.names()
+    shape = params[names[0]].shape
+    for name in names:
+        if params[name].shape != shape:
+            raise ValueError('raster %s is %s, not %s' % (name, params[name].shape, shape))
+    for name in climate_names:
+        if climate[name].shape[1:] != shape:
+            raise ValueError('climate %s is %s, not (time,) + %s' % (name, climate[name].shape, shape))
+
+    writer = CubeWriter(path_output, select_outputs(config.Output), shape)
+    n_cells = 0
+    try:
+        for y in range(0, shape[0], tile[0]):
+            for x in range(0, shape[1], tile[1]):
+                valid, values, series = read_tile(params, climate, names,
+                        y, x, tile[0], tile[1], nodata)
+                if not values.size:
+                    continue
+                configs = [apply_values(config, names, row) for row in values]
+                data = [Climate(cell, climate_names) for cell in series]
+                model = BatchModel3PG(configs, data=data,
+                        sink=TileSink(writer, y, x, valid))
+                try:
+                    if writer.cubes is None:
+                        writer.create(model.keeper.n_steps)
+                    model.run()
+                finally:
+                    model.teardown()
+                n_cells += len(configs)
+    finally:
+        writer.close()
+        params.close()
+        climate.close()
+    return n_cells
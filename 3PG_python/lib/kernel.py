@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled monthly kernel
+
+The canopy production and water balance steps are fused into one function,
+and the mortality step (self-thinning Newton loop included) with the stand
+update into another, both over plain floats with the parameters packed in
+one float array. When numba is importable they are compiled with njit,
+otherwise Model3PG keeps calling the functions of the module files.
+
+biomass_partition is called between the two fused steps as before.
+"""
+
+from __future__ import division
+
+from math import exp, log, pi
+
+import numpy as np
+
+from constants import molPAR_MJ, gDM_mol, Qa, Qb
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+available = numba is not None
+
+
+def jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+# positions of the parameters in the packed array
+packed = [('CanopyProduction', 't_min'), ('CanopyProduction', 't_max'),
+        ('CanopyProduction', 't_opt'), ('CanopyProduction', 'coeffcond'),
+        ('CanopyProduction', 'maxasw'), ('CanopyProduction', 'minasw'),
+        ('CanopyProduction', 'swconst0'), ('CanopyProduction', 'swpower0'),
+        ('CanopyProduction', 'fr'), ('CanopyProduction', 'fn0'),
+        ('CanopyProduction', 'kf'), ('CanopyProduction', 'maxage'),
+        ('CanopyProduction', 'rage'), ('CanopyProduction', 'nage'),
+        ('CanopyProduction', 'fullcanage'), ('CanopyProduction', 'canpower'),
+        ('CanopyProduction', 'k'), ('CanopyProduction', 'alpha'),
+        ('CanopyProduction', 'y'),
+        ('BiomassPartition', 'tk2'), ('BiomassPartition', 'tk3'),
+        ('BiomassPartition', 'maxcond'), ('BiomassPartition', 'laigcx'),
+        ('WaterBalance', 'blcond'), ('WaterBalance', 'laimaxintcptn'),
+        ('WaterBalance', 'maxintcptn'),
+        ('ShrubEffect', 'kl'), ('ShrubEffect', 'trshrub'), ('ShrubEffect', 'lsx'),
+        ('StemMortality', 'wsx1000'), ('StemMortality', 'thinpower'),
+        ('StemMortality', 'mf'), ('StemMortality', 'mr'), ('StemMortality', 'ms'),
+        ('StemMortality', 'sla0'), ('StemMortality', 'sla1'),
+        ('StemMortality', 'tsla'), ('StemMortality', 'fracbb0'),
+        ('StemMortality', 'fracbb1'), ('StemMortality', 'tbb'),
+        ('StemMortality', 'stemconst'), ('StemMortality', 'stempower'),
+        ('StemMortality', 'density'), ('StemMortality', 'htc0'),
+        ('StemMortality', 'htc1')]
+
+(T_MIN, T_MAX, T_OPT, COEFFCOND, MAXASW, MINASW, SWCONST, SWPOWER, FR, FN0,
+        KF, MAXAGE, RAGE, NAGE, FULLCANAGE, CANPOWER, K, ALPHA, Y,
+        TK2, TK3, MAXCOND, LAIGCX, BLCOND, LAIMAXINTCPTN, MAXINTCPTN,
+        KL, TRSHRUB, LSX, WSX1000, THINPOWER, MF, MR, MS,
+        SLA0, SLA1, TSLA, FRACBB0, FRACBB1, TBB,
+        STEMCONST, STEMPOWER, DENSITY, HTC0, HTC1) = range(len(packed))
+
+
+def pack_parameters(params):
+    """parameters used by the kernel, as one float array"""
+    return np.array([getattr(getattr(params, section), name)
+        for section, name in packed], dtype=np.float64)
+
+
+@jit
+def production_step(p, T_av, VPD, rain, solar_rad, frost_days, day_length,
+        days_in_month, ASW, LAI, stand_age, CounterforShrub, irrig):
+    """canopy_production followed by water_balance"""
+    # modifiers
+    if (T_av <= p[T_MIN]) or (T_av >= p[T_MAX]):
+        modifier_temperature = 0.0
+    else:
+        modifier_temperature = ((T_av - p[T_MIN]) / (p[T_OPT] - p[T_MIN])) * \
+                ((p[T_MAX] - T_av) / (p[T_MAX] - p[T_OPT])) ** \
+                ((p[T_MAX] - p[T_OPT]) / (p[T_OPT] - p[T_MIN]))
+    modifier_VPD = exp(-1 * p[COEFFCOND] * VPD)
+    moist_ratio = ASW / p[MAXASW]
+    modifier_soilwater = 1 / (1 + ((1 - moist_ratio) / p[SWCONST]) ** p[SWPOWER])
+    modifier_nutrition = p[FN0] + (1 - p[FN0]) * p[FR]
+    modifier_frost = 1 - p[KF] * (frost_days / 30)
+    modifier_age = (1 / (1 + ((stand_age / p[MAXAGE]) / p[RAGE]) ** p[NAGE]))
+    modifier_physiology = min(modifier_VPD, modifier_soilwater) * modifier_age
+
+    # canopy cover, conductance and production
+    canopy_cover = 1.0
+    if (p[FULLCANAGE] > 0) and (stand_age < p[FULLCANAGE]):
+        canopy_cover = (stand_age / p[FULLCANAGE]) ** p[CANPOWER]
+    light_interception = (1 - (exp(-1 * p[K] * LAI)))
+    canopy_conductance = max(0.0, min(1.0, p[TK2] + p[TK3] * T_av)) * \
+        p[MAXCOND] * modifier_frost * modifier_physiology * min(1, LAI / p[LAIGCX])
+    if canopy_conductance == 0:
+        canopy_conductance = 0.0001
+
+    RAD = solar_rad * days_in_month
+    PAR = RAD * molPAR_MJ
+    APAR = PAR * light_interception * canopy_cover
+    APARu = APAR * modifier_physiology
+    alphaC = p[ALPHA] * modifier_nutrition * modifier_temperature * modifier_frost
+    GPPmolc = APARu * alphaC
+    GPPdm = (GPPmolc * gDM_mol) / 100
+    NPP = GPPdm * p[Y]
+
+    # shrub
+    LsOpen = LAI * p[KL]
+    LsClosed = p[LSX] * exp(-p[K] * LAI)
+    if CounterforShrub == 0:
+        LAIShrub = min(LsOpen, LsClosed)
+    else:
+        LAIShrub = LsClosed
+    if LsClosed <= LsOpen:
+        CounterforShrub = 1.0
+
+    # water balance, Penman-Monteith transpiration
+    e20 = 2.2
+    rhoAir = 1.2
+    lambda_ = 2460000
+    VPDconv = 0.000622
+    gBL = p[BLCOND]
+    netRad = Qa + Qb * (solar_rad * (10 ** 6) / day_length)
+    defTerm = rhoAir * lambda_ * (VPDconv * VPD) * gBL
+    div = (1 + e20 + gBL / canopy_conductance)
+    Etransp = (e20 * netRad + defTerm) / div
+    transp = max(0.0, Etransp / lambda_ * day_length)
+
+    transpall = days_in_month * transp * (LAIShrub * p[TRSHRUB] + LAI) / LAI
+    transp = days_in_month * transp
+    canopy_transpiration_sec = max(0.000001, transp*(1.e3/(18.*86400.)))
+    transpshrub = max(0.0, transpall - transp)
+
+    if p[LAIMAXINTCPTN] <= 0:
+        Intcptn = p[MAXINTCPTN]
+    else:
+        Intcptn = p[MAXINTCPTN] * min(1, LAI / p[LAIMAXINTCPTN])
+    loss_water = transp + Intcptn * rain
+
+    ASW = ASW + rain + (100 * irrig / 12) - loss_water
+    monthlyIrrig = 0.0
+    if ASW < p[MINASW]:
+        if p[MINASW] > 0:
+            monthlyIrrig = p[MINASW] - ASW
+        ASW = p[MINASW]
+    elif ASW > p[MAXASW]:
+        ASW = p[MAXASW]
+
+    return (PAR, APAR, APARu, GPPmolc, GPPdm, NPP, modifier_physiology,
+            LAIShrub, CounterforShrub, canopy_conductance,
+            transpall, transp, transpshrub, loss_water, ASW,
+            monthlyIrrig, canopy_transpiration_sec)
+
+
+@jit
+def mortality_step(p, WF, WR, WS, StemNo, delStemNo, stand_age):
+    """stem_mortality without thinning or defoliation, followed by the
+    number of Newton iterations of the self-thinning solve (0 if none)"""
+    stand_age = stand_age + 1.0 / 12
+
+    thinPower = p[THINPOWER]
+    mS = p[MS]
+    wSmax = p[WSX1000] * (1000 / StemNo) ** thinPower
+    AvStemMass = WS * 1000 / StemNo
+    delStems = 0.0
+    i = 0
+    if wSmax < AvStemMass:
+        # getMortality
+        accuracy = 1 / 1000
+        n = StemNo / 1000
+        x1 = 1000 * mS * WS / StemNo
+        while True:
+            i = i + 1
+            x2 = p[WSX1000] * (n ** (1 - thinPower))
+            fN = x2 - x1 * n - (1 - mS) * WS
+            dfN = (1 - thinPower) * x2 / n - x1
+            dN = -1 * fN / dfN
+            n = n + dN
+            if (abs(dN) <= accuracy) or (i >= 5):
+                break
+        delStems = float(int(StemNo - 1000 * n))
+        WF = WF - p[MF] * delStems * (WF / StemNo)
+        WR = WR - p[MR] * delStems * (WR / StemNo)
+        WS = WS - mS * delStems * (WS / StemNo)
+    StemNo = StemNo - delStems
+    AvStemMass = WS * 1000 / StemNo
+    delStemNo = delStemNo + delStems
+
+    SLA = p[SLA1] + (p[SLA0] - p[SLA1]) * exp(-log(2) * (stand_age / p[TSLA]) ** 2)
+    fracBB = p[FRACBB1] + (p[FRACBB0] - p[FRACBB1]) * exp(-log(2) * (stand_age / p[TBB]))
+
+    LAI = WF * SLA * 0.1
+    avDBH = (AvStemMass / p[STEMCONST]) ** (1 / p[STEMPOWER])
+    BasArea = (((avDBH / 200) ** 2) * pi) * StemNo
+    StandVol = WS * (1 - fracBB) / p[DENSITY]
+    if stand_age > 0:
+        MAI = StandVol / stand_age
+    else:
+        MAI = 0.0
+    Height = (exp(p[HTC0] + p[HTC1] / (avDBH / 2.54 + 1)) + 4.5) * 0.3048
+
+    return (stand_age, LAI, MAI, avDBH, BasArea, Height,
+            StemNo, delStemNo, StandVol, WF, WR, WS, AvStemMass, i)
+
+
+# largest difference relative to 1 + |reference| tolerated between the
+# kernel and the module functions
+parity_tolerance = 1e-9
+
+
+def parity_difference(out, ref):
+    """largest difference relative to 1 + |ref|, per output of the record
+    arrays out and ref"""
+    return dict((name, float(np.max(np.abs(out[name] - ref[name]) / (1 + np.abs(ref[name])))))
+            for name in ref.dtype.names)
+
+
+def check_parity(fpath_config, fpath_input, fpath_reference, fpath_output):
+    """
+    Output:
+        largest relative difference, per output column, between a run
+        with the kernel and the reference output, to be compared with
+        parity_tolerance
+    """
+    from framework import load_config
+    from Model3PG import Model3PG
+
+    config = load_config(fpath_config)
+    config.IO.input = fpath_input
+    config.IO.output = fpath_output
+    config.IO.format = 'tsv'
+    model = Model3PG(fpath_config, use_kernel=True, config=config)
+    model.run()
+    model.teardown()
+
+    out = np.genfromtxt(fpath_output, names=True)
+    ref = np.genfromtxt(fpath_reference, names=True)
+    return parity_difference(out, ref)
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    dpath_test = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+    if not available:
+        print('numba is not installed, Model3PG will use the module functions')
+    diffs = check_parity(os.path.join(dpath_test, 'Test_config.cfg'),
+            os.path.join(dpath_test, 'Test_input.txt'),
+            os.path.join(dpath_test, 'Test_output.txt'),
+            os.path.join(tempfile.gettempdir(), 'kernel_parity.txt'))
+    for name in sorted(diffs):
+        print(name, diffs[name])
+    print('max relative difference', max(diffs.values()))
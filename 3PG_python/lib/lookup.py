@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lookup tables of the calendar terms
+
+Day length depends on the latitude and the month only, and the number of
+days on the month only, so both are tabulated once for the months 0 to 11
+the model passes (the table of a latitude is cached, and shared by the
+stands at that latitude) and read with month_index instead of being
+recomputed monthly.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from utils import get_day_length, get_days_in_month
+
+
+days_in_month_table = tuple(get_days_in_month(month) for month in range(12))
+
+
+def month_index(month):
+    """position of month (0 to 11) in the tables"""
+    return month % 12
+
+
+@lru_cache(maxsize=4096)
+def day_length_table(lat):
+    """day lengths at lat, for months 0 to 11"""
+    return tuple(get_day_length(lat, month) for month in range(12))
+
+
+def day_length_tables(lats):
+    """(stands, 12) day lengths, for an array of stand latitudes"""
+    lats = np.asarray(lats, dtype=np.float64)
+    unique, inverse = np.unique(lats, return_inverse=True)
+    tables = np.array([day_length_table(float(lat)) for lat in unique], dtype=np.float64)
+    return tables[inverse.reshape(lats.shape)]
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+Management events: thinning and defoliation
+
+The events of a stand are read from a text file named by the [IO] option
+management, one event per line, '#' starting a comment:
+
+    # age   event       value   foliage root stem
+    8       stocking    900
+    12      stems       0.3
+    20.5    basal_area  0.25    1       1    0.8
+    15      foliage     0.4
+
+age is the stand age (years) from which the event applies, and the events
+remove
+    stocking,   the stems above value (stems per ha left after thinning)
+    stems,      the fraction value of the stems
+    basal_area, the fraction value of the basal area
+    foliage,    the fraction value of the foliage (defoliation)
+A thinning removes trees holding foliage, root and stem times the foliage,
+root and stem mass of the mean tree (1 by default, below 1 when thinning
+from below).
+
+The events are sorted by age once, and a cursor per stand points at the
+next one, so a month only compares the stand age to the age of that event.
+Schedule feeds stem_mortality through its doThinning and doDefoliation
+callbacks, BatchSchedule does the same for stem_mortality_batch with one
+list of events per stand.
+"""
+
+import collections
+
+import numpy as np
+
+from StemMortality import thin_stand, stems_removed
+
+
+# an event applies in the month the stand age reaches its age, give or take
+# the rounding of the monthly age increments
+tolerance = 1e-6
+
+thinning_kinds = ('stocking', 'stems', 'basal_area')
+defoliation_kinds = ('foliage',)
+
+Event = collections.namedtuple('Event', ['age', 'kind', 'value', 'foliage', 'root', 'stem'])
+
+
+def make_event(age, kind, value, foliage=1.0, root=1.0, stem=1.0):
+    """checked Event, raises ValueError"""
+    kind = kind.lower()
+    age, value = float(age), float(value)
+    foliage, root, stem = float(foliage), float(root), float(stem)
+    if kind not in thinning_kinds + defoliation_kinds:
+        raise ValueError('unknown management event %s' % kind)
+    if kind == 'stocking':
+        if value <= 0:
+            raise ValueError('the stocking left by a thinning must be positive')
+    elif not 0 <= value < 1:
+        raise ValueError('the fraction removed by %s must be in [0, 1)' % kind)
+    if min(foliage, root, stem) < 0:
+        raise ValueError('the relative size of the thinned trees must not be negative')
+    return Event(age, kind, value, foliage, root, stem)
+
+
+def read_events(fpath):
+    """events of a management file, sorted by age"""
+    events = []
+    with open(fpath) as handler:
+        for line_no, line in enumerate(handler, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if not 3 <= len(fields) <= 6:
+                raise ValueError('%s line %d: expected age, event, value '
+                        'and optionally foliage, root, stem' % (fpath, line_no))
+            try:
+                events.append(make_event(*fields))
+            except ValueError as e:
+                raise ValueError('%s line %d: %s' % (fpath, line_no, e))
+    return sort_events(events)
+
+
+def sort_events(events):
+    # stable, the events of the same age keep the order of the file
+    return sorted(events, key=lambda event: event.age)
+
+
+def management_events(config_io, cache=None):
+    """events of the [IO] option management, [] without it; cache maps
+    the paths already read to their events"""
+    fpath = getattr(config_io, 'management', None)
+    if not fpath:
+        return []
+    if cache is None:
+        return read_events(fpath)
+    if fpath not in cache:
+        cache[fpath] = read_events(fpath)
+    return cache[fpath]
+
+
+class Schedule(object):
+    """the management events of one stand, with a cursor on the thinnings
+    and one on the defoliations"""
+
+    def __init__(self, events):
+        super(Schedule, self).__init__()
+        events = sort_events(events)
+        self.thinnings = [event for event in events if event.kind in thinning_kinds]
+        self.defoliations = [event for event in events if event.kind in defoliation_kinds]
+        self.thinning_cursor = 0
+        self.defoliation_cursor = 0
+
+    def seek(self, stand_age):
+        """skip the events applied before the month starting at stand_age,
+        when resuming a run"""
+        previous_age = stand_age - 1.0 / 12 + tolerance
+        while (self.thinning_cursor < len(self.thinnings) and
+                self.thinnings[self.thinning_cursor].age <= previous_age):
+            self.thinning_cursor += 1
+        while (self.defoliation_cursor < len(self.defoliations) and
+                self.defoliations[self.defoliation_cursor].age <= previous_age):
+            self.defoliation_cursor += 1
+
+    def thinning(self, stand_age, WF, WR, WS, StemNo, StemPower):
+        """doThinning of stem_mortality"""
+        events = self.thinnings
+        while (self.thinning_cursor < len(events) and
+                events[self.thinning_cursor].age <= stand_age + tolerance):
+            event = events[self.thinning_cursor]
+            self.thinning_cursor += 1
+            delN = float(stems_removed(event.kind, event.value, StemNo, event.stem, StemPower))
+            WF, WR, WS, StemNo = thin_stand(WF, WR, WS, StemNo, delN,
+                    event.foliage, event.root, event.stem)
+        return WF, WR, WS, StemNo
+
+    def defoliation(self, stand_age, WF):
+        """doDefoliation of stem_mortality"""
+        events = self.defoliations
+        while (self.defoliation_cursor < len(events) and
+                events[self.defoliation_cursor].age <= stand_age + tolerance):
+            WF = WF * (1 - events[self.defoliation_cursor].value)
+            self.defoliation_cursor += 1
+        return WF
+
+
+class EventTrack(object):
+    """events of one kind for many stands, flattened stand after stand,
+    each stand ending with a sentinel event that is never due"""
+
+    def __init__(self, events_per_stand, kinds):
+        super(EventTrack, self).__init__()
+        rows = []
+        starts = []
+        for events in events_per_stand:
+            starts.append(len(rows))
+            rows.extend((event.age, kinds.index(event.kind), event.value,
+                event.foliage, event.root, event.stem)
+                for event in events if event.kind in kinds)
+            rows.append((np.inf, 0, 0.0, 1.0, 1.0, 1.0))
+        table = np.array(rows, dtype=np.float64).reshape(-1, 6)
+        self.ages = table[:, 0]
+        self.kinds = np.array(kinds)[table[:, 1].astype(int)]
+        self.values = table[:, 2]
+        self.foliage = table[:, 3]
+        self.root = table[:, 4]
+        self.stem = table[:, 5]
+        self.cursor = np.array(starts, dtype=int)
+
+    def due(self, stand_age):
+        """stands whose next event is due, and the index of those events"""
+        stands = np.flatnonzero(self.ages[self.cursor] <= stand_age + tolerance)
+        return stands, self.cursor[stands]
+
+    def seek(self, stand_age):
+        while True:
+            stands, events = self.due(stand_age - 1.0 / 12)
+            if not stands.size:
+                return
+            self.cursor[stands] += 1
+
+
+class BatchSchedule(object):
+    """the management events of every stand of a batch, the arrays of the
+    callbacks are over the stand axis"""
+
+    def __init__(self, events_per_stand):
+        super(BatchSchedule, self).__init__()
+        self.thinnings = EventTrack(events_per_stand, thinning_kinds)
+        self.defoliations = EventTrack(events_per_stand, defoliation_kinds)
+
+    def seek(self, stand_age):
+        self.thinnings.seek(stand_age)
+        self.defoliations.seek(stand_age)
+
+    def thinning(self, stand_age, WF, WR, WS, StemNo, StemPower):
+        """doThinning of stem_mortality_batch"""
+        track = self.thinnings
+        stands, events = track.due(stand_age)
+        if not stands.size:
+            return WF, WR, WS, StemNo
+        WF, WR, WS, StemNo = [np.array(np.broadcast_to(v, stand_age.shape), dtype=np.float64)
+                for v in (WF, WR, WS, StemNo)]
+        StemPower = np.broadcast_to(StemPower, stand_age.shape)
+        while stands.size:
+            delN = stems_removed(track.kinds[events], track.values[events],
+                    StemNo[stands], track.stem[events], StemPower[stands])
+            WF[stands], WR[stands], WS[stands], StemNo[stands] = thin_stand(WF[stands],
+                    WR[stands], WS[stands], StemNo[stands], delN,
+                    track.foliage[events], track.root[events], track.stem[events])
+            track.cursor[stands] += 1
+            stands, events = track.due(stand_age)
+        return WF, WR, WS, StemNo
+
+    def defoliation(self, stand_age, WF):
+        """doDefoliation of stem_mortality_batch"""
+        track = self.defoliations
+        stands, events = track.due(stand_age)
+        if not stands.size:
+            return WF
+        WF = np.array(np.broadcast_to(WF, stand_age.shape), dtype=np.float64)
+        while stands.size:
+            WF[stands] *= 1 - track.values[events]
+            track.cursor[stands] += 1
+            stands, events = track.due(stand_age)
+        return WF
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""
+Evaluation plan of the outputs
+
+The [Output] section decides which variables are kept, and with them which
+of the diagnostics a run has to compute at all. The state updates always
+run; a group of diagnostics below runs only when one of its outputs is
+switched on, since nothing else depends on it.
+"""
+
+from framework import select_outputs
+
+
+# diagnostics that no state update depends on, by group
+groups = {
+    # the shrub layer and the split of the transpiration between the
+    # trees and the shrubs (canopy_production, water_balance)
+    'shrub': ['laishrub', 'transpall', 'transpshrub'],
+}
+
+
+class OutputPlan(object):
+    """outputs kept by a run and the groups of diagnostics it evaluates"""
+    __slots__ = ('names', 'shrub')
+
+    def __init__(self, names):
+        self.names = names
+        for group, members in groups.items():
+            setattr(self, group, any(name in names for name in members))
+
+
+def plan_outputs(config_output, mapper):
+    """
+    Input:
+        config_output, the [Output] section
+        mapper, output name -> variable name of the model
+    Output:
+        OutputPlan
+    """
+    names = select_outputs(config_output)
+    unknown = [name for name in names if name not in mapper]
+    if unknown:
+        raise ValueError('unknown outputs %s' % ', '.join(unknown))
+    return OutputPlan(names)
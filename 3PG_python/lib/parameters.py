@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+Model parameters, parsed and checked once per run
+
+The sections returned by framework.load_config hold strings, every option
+used by the model is converted here into a typed, slotted record so the
+monthly modules never call float() themselves. A missing or invalid option
+raises a ValueError at load time.
+
+The option names are the lowercase names of the config file, so
+`params.CanopyProduction.t_min` replaces `float(config.CanopyProduction.t_min)`.
+"""
+
+import numpy as np
+
+
+class Section(object):
+    """parameters of one config section"""
+    __slots__ = ()
+    name = None
+    convert = staticmethod(float)
+
+    def __init__(self, **values):
+        for key in self.__slots__:
+            setattr(self, key, values[key])
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                ', '.join('%s=%r' % item for item in self.items()))
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    @classmethod
+    def from_config(cls, config):
+        section = getattr(config, cls.name, None)
+        if section is None:
+            raise ValueError('missing section [%s]' % cls.name)
+        values = {}
+        for key in cls.__slots__:
+            raw = getattr(section, key, None)
+            if raw is None:
+                raise ValueError('[%s] missing option %s' % (cls.name, key))
+            try:
+                values[key] = cls.convert(raw)
+            except ValueError:
+                raise ValueError('[%s] invalid value for %s: %r' % (cls.name, key, raw))
+        res = cls(**values)
+        res.check()
+        return res
+
+    def check(self):
+        pass
+
+    def fail(self, message):
+        raise ValueError('[%s] %s' % (self.name, message))
+
+
+class TimeRange(Section):
+    __slots__ = ('initialyear', 'initialmonth', 'endyear', 'endage',
+            'yearplanted', 'monthplanted')
+    name = 'TimeRange'
+    convert = staticmethod(int)
+
+
+class SiteCharacteristics(Section):
+    __slots__ = ('lat', 'elev')
+    name = 'SiteCharacteristics'
+
+
+class InitialState(Section):
+    __slots__ = ('initialwf', 'initialwr', 'initialws',
+            'initialstocking', 'initialasw')
+    name = 'InitialState'
+
+    def check(self):
+        if np.any(self.initialstocking <= 0):
+            self.fail('InitialStocking must be positive')
+
+
+class CanopyProduction(Section):
+    __slots__ = ('t_min', 't_opt', 't_max', 'coeffcond',
+            'minasw', 'maxasw', 'swconst0', 'swpower0', 'fr', 'fn0', 'kf',
+            'maxage', 'rage', 'nage', 'fullcanage', 'canpower', 'k',
+            'alpha', 'y')
+    name = 'CanopyProduction'
+
+    def check(self):
+        if np.any((self.t_opt <= self.t_min) | (self.t_opt >= self.t_max)):
+            self.fail('T_opt must lie between T_min and T_max')
+        if np.any(self.maxasw <= 0):
+            self.fail('MaxASW must be positive')
+
+
+class BiomassPartition(Section):
+    # only the conductance options used outside of biomass_partition,
+    # which still reads the raw config section
+    __slots__ = ('tk2', 'tk3', 'maxcond', 'laigcx')
+    name = 'BiomassPartition'
+
+    def check(self):
+        if np.any(self.laigcx <= 0):
+            self.fail('LAIgcx must be positive')
+
+
+class WaterBalance(Section):
+    __slots__ = ('blcond', 'laimaxintcptn', 'maxintcptn')
+    name = 'WaterBalance'
+
+
+class StemMortality(Section):
+    __slots__ = ('wsx1000', 'thinpower', 'mf', 'mr', 'ms',
+            'sla0', 'sla1', 'tsla', 'fracbb0', 'fracbb1', 'tbb',
+            'stemconst', 'stempower', 'density', 'htc0', 'htc1')
+    name = 'StemMortality'
+
+    def check(self):
+        if np.any(self.density <= 0):
+            self.fail('Density must be positive')
+        if np.any(self.stempower == 0):
+            self.fail('StemPower must not be 0')
+
+
+class ShrubEffect(Section):
+    __slots__ = ('kl', 'trshrub', 'lsx', 'counterforshrub')
+    name = 'ShrubEffect'
+
+
+sections = [TimeRange, SiteCharacteristics, InitialState, CanopyProduction,
+        BiomassPartition, WaterBalance, StemMortality, ShrubEffect]
+
+
+class Parameters(object):
+    """all parameters of a run, one attribute per config section"""
+    __slots__ = tuple(cls.name for cls in sections)
+
+    def __init__(self, **values):
+        for key in self.__slots__:
+            setattr(self, key, values[key])
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+
+def compile_parameters(config):
+    """
+    Input:
+        config, returned by framework.load_config
+    Output:
+        Parameters with float (int for TimeRange) options
+    """
+    return Parameters(**dict((cls.name, cls.from_config(config)) for cls in sections))
+
+
+def stack_parameters(params_list):
+    """
+    Input:
+        params_list, list of Parameters, one per stand
+    Output:
+        Parameters whose options are float arrays over the stand axis,
+        TimeRange has to be shared by every stand and is kept as is
+    """
+    first = params_list[0]
+    for params in params_list[1:]:
+        if params.TimeRange.items() != first.TimeRange.items():
+            raise ValueError('all stands in a batch must share the same [TimeRange]')
+    values = {TimeRange.name: first.TimeRange}
+    for cls in sections[1:]:
+        values[cls.name] = cls(**dict((key,
+            np.array([getattr(getattr(params, cls.name), key) for params in params_list]))
+            for key in cls.__slots__))
+    return Parameters(**values)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation of Model3PG.run
+
+    profiler = Profiler(trace=True)
+    model = Model3PG(fpath, profiler=profiler)
+    model.run()
+    profiler.to_json('profile.json')
+    profiler.to_chrome_trace('trace.json')   # chrome://tracing, Perfetto
+
+When a profiler is given, run calls the monthly modules (and the book
+keeper) through timing wrappers, and passes newton_iterations to
+stem_mortality, which reports the Newton iterations of getMortality.
+Without one, run calls the plain functions, the only added cost being one
+test per simulated year.
+"""
+
+import json
+import time
+
+
+class Profiler(object):
+    """cumulative time and call counts per module and per simulated year"""
+
+    def __init__(self, trace=False):
+        super(Profiler, self).__init__()
+        self.origin = time.perf_counter()
+        self.totals = {}
+        self.years = {}
+        self.year = None
+        self.newton = {'solves': 0, 'iterations': 0, 'max': 0, 'histogram': {}}
+        self.events = [] if trace else None
+
+    def wrap(self, name, function):
+        """function timed under name"""
+        clock = time.perf_counter
+        record = self.record
+
+        def timed(*args):
+            start = clock()
+            try:
+                return function(*args)
+            finally:
+                record(name, start, clock())
+        return timed
+
+    def record(self, name, start, end):
+        seconds = end - start
+        total = self.totals.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+        per_year = self.years.setdefault(self.year, {}).setdefault(name, [0.0, 0])
+        per_year[0] += seconds
+        per_year[1] += 1
+        if self.events is not None:
+            self.events.append((name, start, seconds, self.year))
+
+    def newton_iterations(self, n):
+        if n <= 0:
+            return
+        newton = self.newton
+        newton['solves'] += 1
+        newton['iterations'] += n
+        newton['max'] = max(newton['max'], n)
+        newton['histogram'][n] = newton['histogram'].get(n, 0) + 1
+
+    def report(self):
+        def entries(table):
+            return dict((name, {'seconds': seconds, 'calls': calls})
+                    for name, (seconds, calls) in table.items())
+        newton = dict(self.newton)
+        newton['histogram'] = dict((str(n), count)
+                for n, count in sorted(newton['histogram'].items()))
+        return {'modules': entries(self.totals),
+                'years': dict((str(year), entries(table))
+                    for year, table in sorted(self.years.items(),
+                        key=lambda item: (item[0] is not None, item[0] or 0))),
+                'newton': newton}
+
+    def to_json(self, fpath):
+        with open(fpath, 'w') as handler:
+            json.dump(self.report(), handler, indent=2)
+
+    def to_chrome_trace(self, fpath):
+        """complete events in the Trace Event Format, times in microseconds"""
+        if self.events is None:
+            raise ValueError('the profiler was created without trace=True')
+        events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                    'ts': (start - self.origin) * 1e6, 'dur': seconds * 1e6,
+                    'args': {'year': year}}
+                for name, start, seconds, year in self.events]
+        with open(fpath, 'w') as handler:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, handler)
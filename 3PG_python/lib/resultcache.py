@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of run results, addressed by content
+
+A run is identified by the hash of its parsed config in canonical form
+(numbers normalized, the selected outputs only, the [IO] options that do
+not change the results left out), the digest of its climate data, the
+digests of its management and checkpoint files, and the model version (a
+hash of the sources of the modules computing the results). Its outputs,
+the record array a 'records' run keeps, are saved under that key as a .npy
+file in the cache directory.
+
+The directory is bounded to max_bytes, the least recently used results
+(by file modification time, so the order survives restarts and is shared
+by the processes using the directory) are evicted first. The directory is
+scanned again before every eviction, so the results written or removed by
+other processes are accounted for.
+
+    cache = ResultCache('~/.cache/py3pg/results', 512 << 20)
+    records = run_cached(load_config('stand.cfg'), cache)
+    print(cache.stats())
+
+A hit only loads the climate (for its digest) and the .npy file, Model3PG
+and the book keepers are not involved.
+"""
+
+import collections
+import hashlib
+import importlib.util
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from framework import copy_config, select_outputs
+from climate import load_climate, replace_atomic
+
+
+# modules whose code determines the results
+model_modules = ['Model3PG', 'BatchModel3PG', 'CanopyProduction', 'WaterBalance',
+        'BiomassPartition', 'StemMortality', 'kernel', 'utils', 'constants', 'parameters',
+        'lookup', 'drivers', 'management', 'checkpoint', 'framework', 'outputs']
+
+# [IO] options that do not change the results
+io_ignored = ('input', 'output', 'format', 'block_size', 'climate_cache',
+        'climate_stream', 'climate_chunk', 'checkpoint', 'checkpoint_every')
+
+# [IO] options naming files, identified by the digest of their content
+io_files = ('management', 'resume_from')
+
+
+def default_cache_dir():
+    return os.environ.get('PY3PG_RESULT_CACHE_DIR',
+            os.path.join(os.path.expanduser('~'), '.cache', 'py3pg', 'results'))
+
+
+def file_digest(fpath):
+    digest = hashlib.sha1()
+    with open(fpath, 'rb') as handler:
+        for chunk in iter(lambda: handler.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def model_version():
+    """hash of the sources of model_modules"""
+    digest = hashlib.sha1()
+    for name in model_modules:
+        spec = importlib.util.find_spec(name)
+        digest.update(name.encode('utf-8'))
+        if spec is not None and spec.origin and os.path.isfile(spec.origin):
+            digest.update(file_digest(spec.origin).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def canonical_value(value):
+    value = str(value).strip()
+    try:
+        return repr(float(value))
+    except ValueError:
+        return value
+
+
+def canonical_config(config):
+    """the sections of config as a dict of dicts, see the module docstring"""
+    res = {}
+    for section_name, section in vars(config).items():
+        if section_name == 'Output':
+            res[section_name] = sorted(select_outputs(section))
+            continue
+        options = {}
+        for name, value in vars(section).items():
+            if section_name == 'IO':
+                if name in io_ignored:
+                    continue
+                if name in io_files and value:
+                    value = file_digest(value)
+            options[name] = canonical_value(value)
+        res[section_name] = options
+    return res
+
+
+def result_key(config, climate):
+    """key of the run of config over climate (a climate.Climate)"""
+    if climate.digest is None:
+        raise ValueError('the climate has no digest, its runs cannot be cached')
+    content = json.dumps([canonical_config(config), climate.digest, model_version()],
+            sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """run results by key, in a directory bounded to max_bytes"""
+
+    def __init__(self, path=None, max_bytes=1 << 30):
+        super(ResultCache, self).__init__()
+        self.path = os.path.expanduser(path or default_cache_dir())
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # key -> size in bytes, least recently used first
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.scan()
+
+    def scan(self):
+        """index the results in the directory, by modification time, the
+        ties in the order this process used them"""
+        used = dict((key, i) for i, key in enumerate(self.entries))
+        found = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npy'):
+                key = name[:-len('.npy')]
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue # removed by another process meanwhile
+                found.append((stat.st_mtime_ns, used.get(key, -1), key, stat.st_size))
+        self.entries.clear()
+        for mtime, i, key, size in sorted(found):
+            self.entries[key] = size
+        self.n_bytes = sum(self.entries.values())
+
+    def fpath(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """the records kept under key, None on a miss"""
+        fpath = self.fpath(key)
+        try:
+            records = np.load(fpath)
+            os.utime(fpath)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)
+            return None
+        self.hits += 1
+        if key not in self.entries:
+            self.entries[key] = os.path.getsize(fpath)
+            self.n_bytes += self.entries[key]
+        self.entries.move_to_end(key)
+        return records
+
+    def put(self, key, records):
+        records = np.ascontiguousarray(records)
+        replace_atomic(self.fpath(key), lambda handler: np.save(handler, records))
+        self.scan()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used results beyond max_bytes, the
+        newest one is always kept"""
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.n_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.fpath(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.n_bytes, 'max_bytes': self.max_bytes,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def run_records(config, climate):
+    """records of a Model3PG run of config over climate, nothing written"""
+    from Model3PG import Model3PG
+    config = copy_config(config)
+    config.IO.format = 'records'
+    config.IO.checkpoint_every = '0'
+    model = Model3PG(None, data=climate, config=config, verbose=False)
+    try:
+        model.run()
+        return np.array(model.keeper.records)
+    finally:
+        model.teardown()
+
+
+def run_cached(config, cache):
+    """
+    Input:
+        config, as returned by load_config
+        cache, ResultCache
+    Output:
+        record array of the outputs of config, one row per month (or per
+        aggregation period), from the cache when it holds them
+    """
+    climate = load_climate(config.IO.input, getattr(config.IO, 'climate_cache', None))
+    key = result_key(config, climate)
+    records = cache.get(key)
+    if records is None:
+        records = run_records(config, climate)
+        cache.put(key, records)
+    return records
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch runner, fans many control files out over a pool of processes
+
+Each worker process keeps the climate inputs it has already loaded (see
+climate.load_climate), so control files sharing a climate file only map it
+once per worker.
+"""
+
+import os
+import signal
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from climate import load_climate
+from framework import load_config
+from Model3PG import Model3PG
+
+
+class RunTimeout(Exception):
+    pass
+
+
+def on_alarm(signum, frame):
+    raise RunTimeout('run exceeded its time limit')
+
+
+def read_manifest(fpath):
+    """control files listed one per line, blank lines and # comments skipped,
+    relative paths are taken from the manifest directory"""
+    root = os.path.dirname(os.path.abspath(fpath))
+    res = []
+    with open(fpath) as handler:
+        for line in handler:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                res.append(os.path.join(root, line))
+    return res
+
+
+def run_control_file(fpath_control, timeout=None):
+    """
+    Input:
+        fpath_control, path of the control file
+        timeout, seconds allowed for the run, None for no limit
+    Output:
+        (fpath_control, status, wall time in seconds, traceback or '')
+        status is one of ok, invalid, timeout and error
+    """
+    start = time.time()
+    use_alarm = bool(timeout) and hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    model = None
+    status = 'ok'
+    error = ''
+    try:
+        try:
+            config = load_config(fpath_control)
+            data = load_climate(config.IO.input,
+                    getattr(config.IO, 'climate_cache', None))
+            model = Model3PG(fpath_control, data, config=config, verbose=False)
+        except RunTimeout:
+            raise
+        except Exception:
+            status = 'invalid'
+            error = traceback.format_exc()
+        else:
+            model.run()
+    except RunTimeout:
+        status = 'timeout'
+        error = traceback.format_exc()
+    except Exception:
+        status = 'error'
+        error = traceback.format_exc()
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if model is not None:
+            model.teardown()
+    return fpath_control, status, time.time() - start, error
+
+
+def run_one(args):
+    return run_control_file(*args)
+
+
+def run_batch(fpaths_control, workers=None, chunksize=1, timeout=None):
+    """
+    Input:
+        fpaths_control, list of control files
+        workers, number of processes, defaults to the number of CPUs
+        chunksize, control files handed to a worker at a time
+        timeout, seconds allowed for each run
+    Output:
+        list of run_control_file results, in the order of fpaths_control
+    """
+    tasks = [(fpath, timeout) for fpath in fpaths_control]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_one, tasks, chunksize=chunksize))
+
+
+def write_summary(fpath, results):
+    with open(fpath, 'w') as handler:
+        handler.write('control\tstatus\twall_time\terror\n')
+        for fpath_control, status, wall_time, error in results:
+            error = error.strip().replace('\\', '\\\\').replace('\n', '\\n').replace('\t', '\\t')
+            handler.write('%s\t%s\t%.3f\t%s\n' % (fpath_control, status, wall_time, error))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+"""
+Simulation service
+
+A long running HTTP server (over TCP or a Unix socket) answering run
+requests from warm worker processes, which keep the modules imported and
+the climate inputs loaded between requests (see climate.load_climate).
+Requests arriving within batch_window seconds of each other are grouped,
+per compatible time range and outputs, into one BatchModel3PG run. Each
+request is checked (parameters, outputs, climate input) before it joins a
+group, and the requests of a group whose run fails are run again one by
+one, so that a bad request only fails itself.
+
+    POST /run      {"config": "/path/stand.cfg",
+                    "parameters": {"alpha": 0.05},       optional
+                    "outputs": ["ws", "height"],         default [Output]
+                    "format": "json" or "npy"}           default json
+    GET /metrics   request count, batch sizes, p50/p99 latency in ms,
+                   and the result cache statistics
+    GET /health
+
+With a resultcache.ResultCache, a request whose run is in the cache is
+answered from it, without going through the workers.
+
+A json reply is {"steps": n, "outputs": {name: [value per month]}}, an npy
+reply the record array of the outputs in the .npy format.
+"""
+
+import asyncio
+import collections
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from framework import load_config, select_outputs
+from climate import load_climate
+from parameters import compile_parameters
+from outputs import plan_outputs
+from Model3PG import mapper
+from sweep import prepare_config, apply_values
+from resultcache import result_key
+
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def warm_up(fpaths_control):
+    """worker initializer, imports the engine and loads the climate inputs"""
+    # imported for its side effect, the first request of a worker then
+    # finds the engine (and numpy, numba) already loaded
+    import BatchModel3PG  # noqa: F401
+    for fpath in fpaths_control:
+        config = load_config(fpath)
+        load_climate(config.IO.input, getattr(config.IO, 'climate_cache', None))
+
+
+def run_group(configs):
+    """one batched run, records of the outputs as (month, request)"""
+    from BatchModel3PG import BatchModel3PG
+    model = BatchModel3PG(configs)
+    try:
+        model.run()
+        return np.array(model.keeper.records)
+    finally:
+        model.teardown()
+
+
+class Request(object):
+    __slots__ = ('config', 'key', 'future')
+
+    def __init__(self, config, key, future):
+        self.config = config
+        self.key = key
+        self.future = future
+
+
+class Service(object):
+    def __init__(self, workers=None, batch_window=0.005, max_batch=256, preload=(),
+            cache=None, max_configs=1024):
+        super(Service, self).__init__()
+        self.workers = workers
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.preload = list(preload)
+        self.cache = cache
+        # path -> (mtime, parsed control file), least recently used first
+        self.configs = collections.OrderedDict()
+        self.max_configs = max_configs
+        self.latencies = collections.deque(maxlen=10000)
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.started = time.time()
+        self.pool = None
+        self.queue = None
+
+    def load_config(self, fpath):
+        """parsed control file, cached until the file changes; the
+        max_configs control files used last are kept"""
+        key = os.path.abspath(fpath)
+        mtime = os.stat(fpath).st_mtime_ns
+        cached = self.configs.pop(key, None)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, load_config(fpath))
+        self.configs[key] = cached
+        while len(self.configs) > self.max_configs:
+            self.configs.popitem(last=False)
+        return cached[1]
+
+    def prepare(self, payload):
+        """config of a run request and its batching key"""
+        if not isinstance(payload, dict) or 'config' not in payload:
+            raise ValueError('a run request needs a config')
+        config = self.load_config(payload['config'])
+        outputs = payload.get('outputs') or select_outputs(config.Output)
+        config = prepare_config(config, outputs)
+        parameters = payload.get('parameters') or {}
+        if parameters:
+            config = apply_values(config, list(parameters), list(parameters.values()))
+        # fail this request now rather than the batch it would join
+        compile_parameters(config)
+        plan_outputs(config.Output, mapper)
+        if not os.path.isfile(config.IO.input):
+            raise ValueError('missing climate input %s' % config.IO.input)
+        io_options = tuple(sorted(item for item in vars(config.IO).items()
+            if item[0] not in ('input', 'output')))
+        key = (tuple(sorted(vars(config.TimeRange).items())),
+                tuple(sorted(name.lower() for name in outputs)), io_options)
+        return config, key
+
+    async def batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(pending) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            groups = collections.OrderedDict()
+            for request in pending:
+                groups.setdefault(request.key, []).append(request)
+            for group in groups.values():
+                asyncio.ensure_future(self.dispatch(group))
+
+    async def dispatch(self, group):
+        self.batch_sizes.append(len(group))
+        loop = asyncio.get_event_loop()
+        try:
+            records = await loop.run_in_executor(self.pool, run_group,
+                    [request.config for request in group])
+        except Exception as e:
+            if len(group) == 1:
+                group[0].future.set_exception(e)
+            else:
+                # find the failing requests, the others still get their results
+                for request in group:
+                    asyncio.ensure_future(self.dispatch([request]))
+            return
+        for i, request in enumerate(group):
+            request.future.set_result(records[:, i])
+
+    async def submit(self, payload):
+        config, key = self.prepare(payload)
+        cache_key = None
+        if self.cache is not None:
+            # the climate is read (for its digest) off the event loop
+            climate = await asyncio.get_event_loop().run_in_executor(None, load_climate,
+                    config.IO.input, getattr(config.IO, 'climate_cache', None))
+            cache_key = result_key(config, climate)
+            records = self.cache.get(cache_key)
+            if records is not None:
+                return records
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put(Request(config, key, future))
+        records = await future
+        if cache_key is not None:
+            self.cache.put(cache_key, records)
+        return records
+
+    def metrics(self):
+        res = {'requests': self.n_requests, 'errors': self.n_errors,
+                'uptime_seconds': time.time() - self.started,
+                'queued': self.queue.qsize() if self.queue else 0}
+        if self.latencies:
+            p50, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 99])
+            res.update(latency_p50_ms=p50, latency_p99_ms=p99)
+        if self.batch_sizes:
+            res.update(batches=len(self.batch_sizes),
+                    mean_batch_size=float(np.mean(self.batch_sizes)))
+        if self.cache is not None:
+            res['cache'] = self.cache.stats()
+        return res
+
+    async def respond(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, 'application/json', b'{"status": "ok"}'
+        if method == 'GET' and path == '/metrics':
+            return 200, 'application/json', json.dumps(self.metrics()).encode('utf-8')
+        if method != 'POST' or path != '/run':
+            return 404, 'application/json', b'{"error": "not found"}'
+
+        start = time.perf_counter()
+        try:
+            payload = json.loads(body.decode('utf-8'))
+            records = await self.submit(payload)
+        except (ValueError, KeyError, IOError, OSError) as e:
+            self.n_errors += 1
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+        except Exception as e:
+            self.n_errors += 1
+            return 500, 'application/json', json.dumps({'error': repr(e)}).encode('utf-8')
+        self.n_requests += 1
+        if payload.get('format') == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, records)
+            content = 'application/octet-stream', buffer.getvalue()
+        else:
+            content = 'application/json', json.dumps({'steps': len(records),
+                'outputs': dict((name, records[name].tolist())
+                    for name in records.dtype.names)}).encode('utf-8')
+        self.latencies.append(time.perf_counter() - start)
+        return (200,) + content
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if len(request_line) < 2:
+                status, content_type, content = 400, 'application/json', b'{"error": "bad request"}'
+            else:
+                status, content_type, content = await self.respond(request_line[0],
+                        request_line[1], body)
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                'Connection: close\r\n\r\n' % (status, reasons[status], content_type,
+                    len(content))).encode('latin-1') + content)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8030, path=None):
+        """serve until cancelled, on host:port or on the Unix socket path"""
+        self.pool = ProcessPoolExecutor(self.workers, initializer=warm_up,
+                initargs=(self.preload,))
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown()
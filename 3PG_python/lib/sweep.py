@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parameter sweeps and sensitivity analysis
+
+A design is an array of parameter sets, one row per member and one column
+per parameter. Every member is a copy of a base config with the parameters
+of its row substituted, the members are run through BatchModel3PG in
+chunks (optionally over several processes) and only the selected outputs,
+reduced to one value per member, are kept. Nothing is written to disk.
+
+    config = load_config('Test_config.cfg')
+    names = ['alpha', 'MaxCond', 'wSx1000']
+    bounds = [(0.03, 0.06), (0.01, 0.02), (80, 140)]
+    design, A, B = saltelli_design(bounds, 256)
+    Y = run_design(config, names, design, ['ws', 'height'])
+    S1, ST = sobol_indices(Y, 256, len(names))
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from framework import copy_config
+from BatchModel3PG import BatchModel3PG
+from parameters import sections
+
+
+def find_option(config, name):
+    """section holding the parameter name (case insensitive)"""
+    option = name.lower()
+    found = [cls.name for cls in sections[1:]
+            if option in getattr(getattr(config, cls.name, None), '__dict__', {})]
+    if len(found) != 1:
+        raise ValueError('parameter %s is %s' % (name,
+            'ambiguous: ' + ', '.join(found) if found else 'unknown'))
+    return found[0], option
+
+
+def apply_values(config, names, values):
+    """copy of config with the parameters names set to values"""
+    res = copy_config(config)
+    for name, value in zip(names, values):
+        section_name, option = find_option(config, name)
+        setattr(getattr(res, section_name), option, repr(float(value)))
+    return res
+
+
+def scale(unit, bounds):
+    """map points of the unit hypercube onto the parameter bounds"""
+    bounds = np.asarray(bounds, dtype=float)
+    return bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+
+def grid_design(bounds, levels):
+    """full factorial design with levels values per parameter"""
+    axes = [np.linspace(low, high, levels) for low, high in bounds]
+    mesh = np.meshgrid(*axes, indexing='ij')
+    return np.stack([m.ravel() for m in mesh], axis=1)
+
+
+def latin_hypercube(bounds, n, seed=None):
+    rng = np.random.default_rng(seed)
+    k = len(bounds)
+    unit = (rng.random((n, k)) + np.arange(n)[:, None]) / n
+    for j in range(k):
+        unit[:, j] = unit[rng.permutation(n), j]
+    return scale(unit, bounds)
+
+
+def saltelli_design(bounds, n, seed=None):
+    """
+    Output:
+        design, n * (k + 2) rows: A, B then A with column i taken from B
+        A, B, the two base samples (n, k)
+    """
+    k = len(bounds)
+    base = latin_hypercube([(0, 1)] * (2 * k), n, seed)
+    A = scale(base[:, :k], bounds)
+    B = scale(base[:, k:], bounds)
+    blocks = [A, B]
+    for i in range(k):
+        AB = A.copy()
+        AB[:, i] = B[:, i]
+        blocks.append(AB)
+    return np.concatenate(blocks), A, B
+
+
+def sobol_indices(Y, n, k):
+    """
+    Input:
+        Y, outputs of a saltelli_design run, (n * (k + 2),) or (n * (k + 2), n_outputs)
+    Output:
+        first order and total indices, (k,) or (k, n_outputs)
+    Description:
+        Saltelli (2010) estimator for the first order indices,
+        Jansen estimator for the total indices
+    """
+    Y = np.asarray(Y, dtype=float)
+    fA = Y[:n]
+    fB = Y[n:2 * n]
+    V = np.var(np.concatenate([fA, fB]), axis=0)
+    V = np.where(V > 0, V, np.nan)
+    S1 = []
+    ST = []
+    for i in range(k):
+        fAB = Y[(2 + i) * n:(3 + i) * n]
+        S1.append(np.mean(fB * (fAB - fA), axis=0) / V)
+        ST.append(0.5 * np.mean((fA - fAB) ** 2, axis=0) / V)
+    return np.array(S1), np.array(ST)
+
+
+def morris_design(bounds, r, levels=4, seed=None):
+    """
+    Output:
+        design, r trajectories of k + 1 points, (r * (k + 1), k)
+    Description:
+        each trajectory starts on the levels grid and moves one parameter
+        at a time, in random order, by delta = levels / (2 (levels - 1))
+    """
+    rng = np.random.default_rng(seed)
+    k = len(bounds)
+    delta = levels / (2.0 * (levels - 1))
+    starts = np.arange(levels) / (levels - 1.0)
+    starts = starts[starts + delta <= 1 + 1e-12]
+    points = []
+    for _ in range(r):
+        x = rng.choice(starts, k)
+        points.append(x.copy())
+        for i in rng.permutation(k):
+            x[i] += delta
+            points.append(x.copy())
+    return scale(np.array(points), bounds)
+
+
+def morris_indices(design, Y, bounds):
+    """
+    Output:
+        mu_star (mean absolute elementary effect) and sigma, (k,) or (k, n_outputs)
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    k = len(bounds)
+    unit = (design - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+    Y = np.asarray(Y, dtype=float)
+    effects = [[] for _ in range(k)]
+    for start in range(0, len(design), k + 1):
+        for j in range(start, start + k):
+            step = unit[j + 1] - unit[j]
+            i = int(np.argmax(np.abs(step)))
+            effects[i].append((Y[j + 1] - Y[j]) / step[i])
+    effects = [np.array(e) for e in effects]
+    mu_star = np.array([np.mean(np.abs(e), axis=0) for e in effects])
+    sigma = np.array([np.std(e, axis=0) for e in effects])
+    return mu_star, sigma
+
+
+def reduce_records(records, outputs, reduce):
+    res = []
+    for name in outputs:
+        series = records[name]
+        if callable(reduce):
+            res.append(reduce(series))
+        elif reduce == 'last':
+            res.append(series[-1])
+        elif reduce in ('mean', 'max', 'min', 'sum'):
+            res.append(getattr(np, reduce)(series, axis=0))
+        else:
+            raise ValueError('unknown reduction %s' % reduce)
+    return np.stack(res, axis=1)
+
+
+def prepare_config(config, outputs):
+    """copy of config recording only outputs, kept in memory"""
+    res = copy_config(config)
+    for name in list(vars(res.Output)):
+        setattr(res.Output, name, '0')
+    for name in outputs:
+        setattr(res.Output, name.lower(), '1')
+    res.IO.format = 'records'
+    return res
+
+
+def run_members(config, names, rows, outputs, reduce='last'):
+    """run one chunk of members, config as returned by prepare_config"""
+    configs = [apply_values(config, names, row) for row in rows]
+    model = BatchModel3PG(configs)
+    try:
+        model.run()
+        return reduce_records(model.keeper.records, outputs, reduce)
+    finally:
+        model.teardown()
+
+
+def run_member_chunk(args):
+    return run_members(*args)
+
+
+def run_design(config, names, design, outputs, reduce='last',
+        batch_size=500, workers=None):
+    """
+    Input:
+        config, base config returned by load_config
+        names, parameter names, one per design column
+        design, (n_members, len(names)) parameter values
+        outputs, output names as in [Output] (case insensitive)
+        reduce, 'last', 'mean', 'max', 'min', 'sum' or a function of the
+            (n_steps, n_members) series of one output
+        batch_size, members run together in one BatchModel3PG
+        workers, run the chunks over this many processes
+    Output:
+        (n_members, len(outputs)) array
+    """
+    design = np.atleast_2d(np.asarray(design, dtype=float))
+    outputs = [name.lower() for name in outputs]
+    for name in names:
+        find_option(config, name)
+    config = prepare_config(config, outputs)
+    chunks = [(config, names, design[start:start + batch_size], outputs, reduce)
+            for start in range(0, len(design), batch_size)]
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_member_chunk, chunks))
+    else:
+        results = [run_member_chunk(chunk) for chunk in chunks]
+    return np.concatenate(results)
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+"""
+Distributed runs over a work queue on a shared filesystem
+
+The coordinator (submit) splits a manifest of control files into shards,
+written as small json files under the queue directory:
+
+    queue/job.json          shard count, lease and retry settings
+    queue/pending/          shards waiting for a worker
+    queue/leased/           shards being run, the file mtime is the heartbeat
+    queue/done/             run statistics of the finished shards
+    queue/failed/           shards that failed max_attempts times
+    queue/outputs/          per shard, the outputs of its stands as a
+                            (stands, months) record array in .npy and the
+                            status of every stand in .tsv
+
+Workers on any node sharing the directory claim a shard by renaming it from
+pending/ to leased/ (atomic, so only one worker gets it), touch the lease
+while running its stands (through Model3PG, see resultcache.run_records)
+and write the outputs under temporary names before renaming them. A lease
+not touched for lease_seconds is taken back to pending/ by the next worker
+looking for work, a shard raising is put back too, and both count as an
+attempt. A stand failing is not retried: its row is NaN and its status
+error. Running a shard twice writes the same files, so a late worker whose
+lease was taken back does no harm.
+
+merge then consolidates the shards into one .npy of (stands, months) in
+manifest order and one status file, and progress reports the counts, the
+throughput of every node and the stragglers (shards leased for more than
+straggler_factor times the median shard duration).
+"""
+
+import json
+import os
+import socket
+import time
+import traceback
+
+import numpy as np
+
+from climate import load_climate
+from framework import load_config
+from runner import read_manifest, write_summary
+from resultcache import run_records
+
+
+states = ('pending', 'leased', 'done', 'failed')
+
+
+def temporary_path(fpath, suffix='.tmp'):
+    """temporary name of fpath, private to this process (of this node), so
+    workers writing the same shard never share one"""
+    return '%s.%s%s' % (fpath, default_node(), suffix)
+
+
+def write_json(fpath, content):
+    fpath_tmp = temporary_path(fpath)
+    with open(fpath_tmp, 'w') as handler:
+        json.dump(content, handler)
+    os.replace(fpath_tmp, fpath)
+
+
+def read_json(fpath):
+    with open(fpath) as handler:
+        return json.load(handler)
+
+
+def default_node():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def shard_name(shard):
+    return '%06d' % shard
+
+
+def run_stands(fpaths_control, heartbeat=None):
+    """
+    Input:
+        fpaths_control, control files of the stands of a shard
+        heartbeat, called after every stand
+    Output:
+        (stands, months) record array of the outputs, NaN for the stands
+        that failed, and the (control, status, wall time, error) of every
+        stand as written by runner.write_summary. Raises ValueError if
+        every stand failed, more likely a problem of the node than of the
+        stands, so that the shard is retried.
+    """
+    results = []
+    records = []
+    for fpath in fpaths_control:
+        start = time.time()
+        res = None
+        try:
+            config = load_config(fpath)
+            res = run_records(config, load_climate(config.IO.input,
+                getattr(config.IO, 'climate_cache', None)))
+            status, error = 'ok', ''
+        except Exception:
+            status, error = 'error', traceback.format_exc()
+        records.append(res)
+        results.append([fpath, status, time.time() - start, error])
+        if heartbeat is not None:
+            heartbeat()
+
+    first = next((res for res in records if res is not None), None)
+    if first is None:
+        raise ValueError('every stand failed, the first with %s' % results[0][3])
+    outputs = np.zeros((len(records),) + first.shape, first.dtype)
+    for name in first.dtype.names:
+        outputs[name] = np.nan
+    for i, res in enumerate(records):
+        if res is None:
+            continue
+        if res.dtype != first.dtype or res.shape != first.shape:
+            results[i][1:] = ['error', results[i][2],
+                    'the outputs differ from those of %s' % fpaths_control[0]]
+            continue
+        outputs[i] = res
+    return outputs, [tuple(result) for result in results]
+
+
+class WorkQueue(object):
+    def __init__(self, path):
+        super(WorkQueue, self).__init__()
+        self.path = path
+        self.job = read_json(os.path.join(path, 'job.json'))
+
+    @classmethod
+    def submit(cls, path, fpaths_control, shard_size=1000, lease_seconds=600,
+            max_attempts=3, straggler_factor=3.0):
+        """split fpaths_control into shards of shard_size stands, queued
+        under the directory path"""
+        for name in states + ('outputs',):
+            dpath = os.path.join(path, name)
+            if not os.path.isdir(dpath):
+                os.makedirs(dpath)
+        if os.path.exists(os.path.join(path, 'job.json')):
+            raise ValueError('%s already holds a job' % path)
+        n_shards = (len(fpaths_control) + shard_size - 1) // shard_size
+        for shard in range(n_shards):
+            controls = fpaths_control[shard * shard_size:(shard + 1) * shard_size]
+            write_json(os.path.join(path, 'pending', shard_name(shard) + '.json'),
+                    {'shard': shard, 'offset': shard * shard_size,
+                        'controls': controls, 'attempts': 0, 'errors': []})
+        write_json(os.path.join(path, 'job.json'), {'n_stands': len(fpaths_control),
+            'n_shards': n_shards, 'shard_size': shard_size,
+            'lease_seconds': lease_seconds, 'max_attempts': max_attempts,
+            'straggler_factor': straggler_factor, 'submitted': time.time()})
+        return cls(path)
+
+    def fpath(self, state, shard, suffix='.json'):
+        return os.path.join(self.path, state, shard_name(shard) + suffix)
+
+    def shards(self, state):
+        return sorted(int(name[:-len('.json')])
+                for name in os.listdir(os.path.join(self.path, state)) if name.endswith('.json'))
+
+    def reclaim_expired(self, node):
+        """put the shards whose lease expired back to pending"""
+        now = time.time()
+        for shard in self.shards('leased'):
+            fpath = self.fpath('leased', shard)
+            try:
+                if os.path.getmtime(fpath) + self.job['lease_seconds'] > now:
+                    continue
+                # whoever renames the lease first takes it back
+                fpath_reclaim = '%s.reclaim' % fpath
+                os.rename(fpath, fpath_reclaim)
+            except OSError:
+                continue
+            lease = read_json(fpath_reclaim)
+            self.release(lease, 'lease of %s expired, taken back by %s' % (lease.get('node'), node))
+            os.remove(fpath_reclaim)
+
+    def claim(self, node):
+        """lease of the next pending shard, None if there is none"""
+        for shard in self.shards('pending'):
+            fpath = self.fpath('pending', shard)
+            fpath_leased = self.fpath('leased', shard)
+            try:
+                os.utime(fpath)
+                os.rename(fpath, fpath_leased)
+            except OSError:
+                continue
+            lease = read_json(fpath_leased)
+            if os.path.exists(self.fpath('done', shard)):
+                os.remove(fpath_leased)
+                continue
+            lease.update(node=node, started=time.time())
+            write_json(fpath_leased, lease)
+            return lease
+        return None
+
+    def heartbeat(self, lease):
+        """renew the lease, False if it was taken back"""
+        try:
+            os.utime(self.fpath('leased', lease['shard']))
+            return True
+        except OSError:
+            return False
+
+    def owns(self, lease):
+        try:
+            return read_json(self.fpath('leased', lease['shard'])).get('node') == lease['node']
+        except (OSError, ValueError):
+            return False
+
+    def complete(self, lease, outputs, results):
+        shard = lease['shard']
+        fpath_npy = self.fpath('outputs', shard, '.npy')
+        fpath_tmp = temporary_path(fpath_npy, '.tmp.npy')
+        np.save(fpath_tmp, outputs)
+        os.replace(fpath_tmp, fpath_npy)
+        fpath_tsv = self.fpath('outputs', shard, '.tsv')
+        fpath_tmp = temporary_path(fpath_tsv)
+        write_summary(fpath_tmp, results)
+        os.replace(fpath_tmp, fpath_tsv)
+        finished = time.time()
+        write_json(self.fpath('done', shard), {'shard': shard, 'node': lease['node'],
+            'started': lease['started'], 'finished': finished,
+            'seconds': finished - lease['started'], 'n_stands': len(results),
+            'n_failed': sum(1 for result in results if result[1] != 'ok'),
+            'attempts': lease['attempts'] + 1})
+        if self.owns(lease):
+            os.remove(self.fpath('leased', shard))
+
+    def release(self, lease, error):
+        """back to pending after a failed attempt, or to failed after the last"""
+        shard = lease['shard']
+        lease = dict(lease)
+        lease['attempts'] += 1
+        lease['errors'].append(error)
+        lease.pop('node', None)
+        lease.pop('started', None)
+        if lease['attempts'] >= self.job['max_attempts']:
+            write_json(self.fpath('failed', shard), lease)
+        else:
+            write_json(self.fpath('pending', shard), lease)
+
+    def fail(self, lease, error):
+        if self.owns(lease):
+            os.rename(self.fpath('leased', lease['shard']), self.fpath('leased', lease['shard'],
+                '.json.failing'))
+            self.release(lease, error)
+            os.remove(self.fpath('leased', lease['shard'], '.json.failing'))
+
+    def state_of(self, shard):
+        """state and content of the shard file of a shard not done, also
+        while a worker moves it from a state to another"""
+        candidates = [(state, self.fpath(state, shard)) for state in ('failed', 'pending', 'leased')]
+        candidates += [('leased', self.fpath('leased', shard, '.json.reclaim')),
+                ('leased', self.fpath('leased', shard, '.json.failing'))]
+        for state, fpath in candidates:
+            try:
+                return state, read_json(fpath)
+            except (OSError, ValueError):
+                continue
+        raise ValueError('no state file of shard %d, done meanwhile?' % shard)
+
+    def progress(self, now=None):
+        """counts, stands done, throughput per node and stragglers"""
+        now = now or time.time()
+        counts = dict((state, len(self.shards(state))) for state in states)
+        done = []
+        for shard in self.shards('done'):
+            try:
+                done.append(read_json(self.fpath('done', shard)))
+            except (OSError, ValueError):
+                pass
+        nodes = {}
+        for record in done:
+            node = nodes.setdefault(record['node'], {'shards': 0, 'stands': 0,
+                'seconds': 0.0, 'running': 0})
+            node['shards'] += 1
+            node['stands'] += record['n_stands']
+            node['seconds'] += record['seconds']
+        for node in nodes.values():
+            node['stands_per_second'] = node['stands'] / node['seconds'] if node['seconds'] else 0.0
+
+        durations = [record['seconds'] for record in done]
+        median = float(np.median(durations)) if durations else None
+        stragglers = []
+        for shard in self.shards('leased'):
+            try:
+                lease = read_json(self.fpath('leased', shard))
+                heartbeat = os.path.getmtime(self.fpath('leased', shard))
+            except (OSError, ValueError):
+                continue
+            node = lease.get('node')
+            if node is not None:
+                nodes.setdefault(node, {'shards': 0, 'stands': 0, 'seconds': 0.0,
+                    'running': 0, 'stands_per_second': 0.0})['running'] += 1
+            elapsed = now - lease.get('started', heartbeat)
+            expired = heartbeat + self.job['lease_seconds'] < now
+            if expired or (median and elapsed > self.job['straggler_factor'] * median):
+                stragglers.append({'shard': shard, 'node': node, 'elapsed': elapsed,
+                    'attempts': lease['attempts'], 'expired': expired})
+
+        stands_done = sum(record['n_stands'] for record in done)
+        elapsed = now - self.job['submitted']
+        return {'shards': self.job['n_shards'], 'counts': counts,
+                'stands': self.job['n_stands'], 'stands_done': stands_done,
+                'stands_failed': sum(record['n_failed'] for record in done),
+                'fraction_done': stands_done / self.job['n_stands'] if self.job['n_stands'] else 1.0,
+                'elapsed': elapsed,
+                'stands_per_second': stands_done / elapsed if elapsed > 0 else 0.0,
+                'median_shard_seconds': median, 'nodes': nodes, 'stragglers': stragglers}
+
+
+def submit(path, fpath_manifest, shard_size=1000, lease_seconds=600, max_attempts=3,
+        straggler_factor=3.0):
+    """queue the control files of a manifest (see runner.read_manifest)"""
+    return WorkQueue.submit(path, read_manifest(fpath_manifest), shard_size,
+            lease_seconds, max_attempts, straggler_factor)
+
+
+def work(path, node=None, max_shards=None, wait=False, poll_seconds=5.0):
+    """
+    Description:
+        runs shards of the queue at path until none is left (or max_shards
+        were run); with wait, keeps polling while other workers still hold
+        leases, to take over the shards of the workers that die.
+    Output:
+        number of shards run
+    """
+    queue = WorkQueue(path)
+    node = node or default_node()
+    n_run = 0
+    while max_shards is None or n_run < max_shards:
+        queue.reclaim_expired(node)
+        lease = queue.claim(node)
+        if lease is None:
+            if not wait or not (queue.shards('leased') or queue.shards('pending')):
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        # renew the lease every third of its length
+        renewed = [time.time()]
+
+        def heartbeat():
+            if time.time() - renewed[0] > queue.job['lease_seconds'] / 3:
+                queue.heartbeat(lease)
+                renewed[0] = time.time()
+
+        try:
+            outputs, results = run_stands(lease['controls'], heartbeat)
+            queue.complete(lease, outputs, results)
+        except Exception:
+            queue.fail(lease, '%s: %s' % (node, traceback.format_exc()))
+        n_run += 1
+    return n_run
+
+
+def merge(path, fpath_output, fpath_summary, partial=False):
+    """
+    Description:
+        consolidates the outputs of the shards into one (stands, months)
+        .npy at fpath_output, in manifest order, and their status into
+        fpath_summary. Raises ValueError if a shard is not done, unless
+        partial: its stands are then NaN, with the status missing.
+    """
+    queue = WorkQueue(path)
+    done = queue.shards('done')
+    missing = sorted(set(range(queue.job['n_shards'])) - set(done))
+    if missing and not partial:
+        raise ValueError('%d shards are not done, first %d' % (len(missing), missing[0]))
+    if not done:
+        raise ValueError('no shard is done')
+    first = np.load(queue.fpath('outputs', done[0], '.npy'), mmap_mode='r')
+    merged = np.lib.format.open_memmap(fpath_output, mode='w+', dtype=first.dtype,
+            shape=(queue.job['n_stands'],) + first.shape[1:])
+    with open(fpath_summary, 'w') as summary:
+        summary.write('control\tstatus\twall_time\terror\n')
+        for shard in range(queue.job['n_shards']):
+            offset = shard * queue.job['shard_size']
+            if shard in missing:
+                state, lease = queue.state_of(shard)
+                controls = lease['controls']
+                for name in first.dtype.names:
+                    merged[name][offset:offset + len(controls)] = np.nan
+                for fpath_control in controls:
+                    summary.write('%s\tmissing\t0.000\tshard %d %s\n' % (fpath_control,
+                        shard, state))
+                continue
+            outputs = np.load(queue.fpath('outputs', shard, '.npy'), mmap_mode='r')
+            if outputs.dtype != merged.dtype or outputs.shape[1:] != merged.shape[1:]:
+                raise ValueError('the outputs of shard %d differ from those of shard %d' %
+                        (shard, done[0]))
+            merged[offset:offset + len(outputs)] = outputs
+            with open(queue.fpath('outputs', shard, '.tsv')) as handler:
+                handler.readline()
+                summary.write(handler.read())
+    merged.flush()
+
+
+def format_progress(report):
+    lines = ['%(stands_done)d of %(stands)d stands (%(stands_failed)d failed), '
+            '%(stands_per_second).1f stands/s' % report,
+            'shards: ' + ', '.join('%s %d' % item for item in
+                sorted(report['counts'].items()))]
+    for node, stats in sorted(report['nodes'].items()):
+        lines.append('node %s: %d shards, %d stands, %.1f stands/s, %d running' % (node,
+            stats['shards'], stats['stands'], stats['stands_per_second'], stats['running']))
+    for straggler in report['stragglers']:
+        lines.append('straggler: shard %(shard)d on %(node)s for %(elapsed).0f s, '
+                'attempt %(attempts)d, expired %(expired)s' % straggler)
+    return '\n'.join(lines)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+dpath_test = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(dpath_test, '..', 'lib'))
+
+from framework import load_config
+
+
+@pytest.fixture
+def config(tmp_path):
+    """Test_config.cfg over Test_input.txt, outputs kept in memory"""
+    res = load_config(os.path.join(dpath_test, 'Test_config.cfg'))
+    res.IO.input = os.path.join(dpath_test, 'Test_input.txt')
+    res.IO.output = str(tmp_path / 'output.txt')
+    res.IO.format = 'records'
+    return res
+
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from framework import copy_config
+from Model3PG import Model3PG
+from BatchModel3PG import BatchModel3PG
+
+
+def scalar_records(config):
+    model = Model3PG(None, use_kernel=False, config=config, verbose=False)
+    try:
+        model.run()
+        return np.array(model.keeper.records)
+    finally:
+        model.teardown()
+
+
+def stands(config):
+    """the test stand, at another latitude and with other growth parameters"""
+    res = [copy_config(config) for _ in range(3)]
+    res[1].SiteCharacteristics.lat = '30.2'
+    res[1].CanopyProduction.alpha = '0.05'
+    res[2].BiomassPartition.maxcond = '0.02'
+    res[2].StemMortality.wsx1000 = '60'
+    return res
+
+
+def test_batch_matches_scalar(config):
+    configs = stands(config)
+    model = BatchModel3PG(configs)
+    try:
+        model.run()
+        batch = np.array(model.keeper.records)
+    finally:
+        model.teardown()
+    for i, stand in enumerate(configs):
+        ref = scalar_records(stand)
+        assert len(batch) == len(ref)
+        for name in ref.dtype.names:
+            diff = np.abs(batch[name][:, i] - ref[name]) / (1 + np.abs(ref[name]))
+            assert np.max(diff) < 1e-12, (i, name)
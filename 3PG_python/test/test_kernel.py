@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import kernel
+from Model3PG import Model3PG
+
+
+def records(config, use_kernel):
+    model = Model3PG(None, use_kernel=use_kernel, config=config, verbose=False)
+    try:
+        model.run()
+        return np.array(model.keeper.records)
+    finally:
+        model.teardown()
+
+
+def test_kernel_matches_modules(config):
+    # without numba the kernel functions run uncompiled, the fused steps
+    # are checked all the same
+    out = records(config, True)
+    ref = records(config, False)
+    assert len(out) == len(ref)
+    diffs = kernel.parity_difference(out, ref)
+    assert max(diffs.values()) <= kernel.parity_tolerance, diffs
+
+
+def test_kernel_matches_modules_with_thinning(config):
+    # a lower self-thinning line, so the Newton loop of the kernel runs often
+    config.StemMortality.wsx1000 = '60'
+    diffs = kernel.parity_difference(records(config, True), records(config, False))
+    assert max(diffs.values()) <= kernel.parity_tolerance, diffs
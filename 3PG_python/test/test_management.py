@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from management import Schedule, BatchSchedule, make_event, read_events
+from StemMortality import stems_removed
+
+
+def write_events(tmp_path, text):
+    fpath = tmp_path / 'management.txt'
+    fpath.write_text(text)
+    return str(fpath)
+
+
+def test_read_events(tmp_path):
+    fpath = write_events(tmp_path, '# age   event       value   foliage root stem\n'
+            '12      Stems       0.3\n'
+            '\n'
+            '8       stocking    900     # thinning to 900 stems\n'
+            '20.5    basal_area  0.25    1       1    0.8\n'
+            '8       foliage     0.4\n')
+    events = read_events(fpath)
+    assert [(event.age, event.kind) for event in events] == [(8, 'stocking'),
+            (8, 'foliage'), (12, 'stems'), (20.5, 'basal_area')]
+    assert events[0].value == 900
+    assert events[2][3:] == (1.0, 1.0, 1.0)
+    assert events[3][3:] == (1.0, 1.0, 0.8)
+
+
+@pytest.mark.parametrize('line, message', [
+    ('8 stocking', 'line 2: expected age, event, value'),
+    ('8 stocking 900 1 1 1 1', 'line 2: expected age, event, value'),
+    ('8 pruning 0.3', 'line 2: unknown management event pruning'),
+    ('8 stocking 0', 'line 2: the stocking left by a thinning must be positive'),
+    ('8 stems 1', 'line 2: the fraction removed by stems must be in [0, 1)'),
+    ('8 foliage -0.1', 'line 2: the fraction removed by foliage must be in [0, 1)'),
+    ('8 stems 0.3 1 -1 1', 'line 2: the relative size of the thinned trees must not be negative'),
+    ('eight stems 0.3', 'line 2: could not convert'),
+])
+def test_read_events_errors(tmp_path, line, message):
+    fpath = write_events(tmp_path, '12 stems 0.3\n%s\n' % line)
+    with pytest.raises(ValueError) as error:
+        read_events(fpath)
+    assert str(error.value).startswith(fpath + ' ' + message)
+
+
+def test_basal_area_bisection():
+    value = np.linspace(0.05, 0.9, 18)
+    StemPower = 2.4
+    # fS close to 1 goes through the bisection, whose fS == 1 limit is d = value
+    assert np.allclose(stems_removed('basal_area', value, 1000.0, 1 - 1e-12, StemPower),
+            value, rtol=0, atol=1e-9)
+    assert np.array_equal(stems_removed('basal_area', value, 1000.0, 1.0, StemPower), value)
+    # with fS == 0 the basal area left is (1 - d) ** (1 - 2 / StemPower)
+    expected = 1 - (1 - value) ** (1 / (1 - 2 / StemPower))
+    assert np.allclose(stems_removed('basal_area', value, 1000.0, 0.0, StemPower),
+            expected, rtol=0, atol=1e-12)
+
+
+events_per_stand = [
+    [make_event(1, 'stocking', 900), make_event(2.5, 'basal_area', 0.25, 1, 1, 0.8),
+        make_event(2.5, 'foliage', 0.4), make_event(4, 'stems', 0.3)],
+    [],
+    [make_event(0.5, 'foliage', 0.2), make_event(3, 'basal_area', 0.4, 0.9, 0.9, 0.7),
+        make_event(3, 'stems', 0.1)],
+]
+
+
+def run_schedules(start_month, n_months, seek):
+    """states (month, stand, WF WR WS StemNo) of Schedule and BatchSchedule
+    over n_months from start_month, seeking first when seek"""
+    n_stands = len(events_per_stand)
+    scalar = [Schedule(events) for events in events_per_stand]
+    batch = BatchSchedule(events_per_stand)
+    state = np.tile([5.0, 4.0, 30.0, 1200.0], (n_stands, 1))
+    scalar_state = [tuple(row) for row in state]
+    batch_state = tuple(state.T)
+    if seek:
+        stand_age = start_month / 12.0
+        for schedule in scalar:
+            schedule.seek(stand_age)
+        batch.seek(np.full(n_stands, stand_age))
+    res_scalar, res_batch = [], []
+    for month in range(start_month, start_month + n_months):
+        stand_age = month / 12.0
+        for i, schedule in enumerate(scalar):
+            WF, WR, WS, StemNo = schedule.thinning(stand_age, *scalar_state[i], StemPower=2.4)
+            scalar_state[i] = (schedule.defoliation(stand_age, WF), WR, WS, StemNo)
+        WF, WR, WS, StemNo = batch.thinning(np.full(n_stands, stand_age), *batch_state,
+                StemPower=2.4)
+        batch_state = (batch.defoliation(np.full(n_stands, stand_age), WF), WR, WS, StemNo)
+        res_scalar.append(np.array(scalar_state))
+        res_batch.append(np.stack(np.broadcast_arrays(*batch_state), axis=1))
+    return np.array(res_scalar), np.array(res_batch)
+
+
+def test_schedule_matches_batch_schedule():
+    scalar, batch = run_schedules(0, 60, seek=False)
+    assert np.allclose(scalar, batch, rtol=1e-12, atol=0)
+    # every event applied, the stand without events untouched
+    assert np.all(scalar[-1, 0] < scalar[0, 0])
+    assert np.all(scalar[:, 1] == [5.0, 4.0, 30.0, 1200.0])
+
+
+def test_seek_on_resume():
+    # resumed at 2.5 years, the events before are skipped, not applied late
+    scalar, batch = run_schedules(30, 30, seek=True)
+    assert np.allclose(scalar, batch, rtol=1e-12, atol=0)
+    # the first stand skips the thinning to 900 stems at 1 year, and thins
+    # by basal area in its first month
+    delN = stems_removed('basal_area', 0.25, 1200.0, 0.8, 2.4)
+    assert np.isclose(scalar[0, 0, 3], 1200.0 * (1 - delN), rtol=1e-12, atol=0)
+    # the third stand skips the defoliation at half a year
+    assert scalar[0, 2, 0] == 5.0
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+
+from climate import Climate
+from framework import copy_config
+from resultcache import ResultCache, result_key
+
+
+climate = Climate(np.zeros((12, 1)), ['Tav'], digest='climate')
+
+
+def test_key_canonical_numbers(config):
+    assert (config.CanopyProduction.alpha, config.TimeRange.endage) == ('0.04', '272')
+    other = copy_config(config)
+    other.CanopyProduction.alpha = ' 4e-2 '
+    other.TimeRange.endage = '272.0'
+    assert result_key(other, climate) == result_key(config, climate)
+    other.CanopyProduction.alpha = '0.041'
+    assert result_key(other, climate) != result_key(config, climate)
+
+
+def test_key_ignored_io_options(config):
+    other = copy_config(config)
+    other.IO.output = config.IO.output + '.npy'
+    other.IO.format = 'npy'
+    other.IO.block_size = '16'
+    other.IO.climate_cache = '/tmp/elsewhere'
+    assert result_key(other, climate) == result_key(config, climate)
+    other.IO.aggregate = 'annual'
+    assert result_key(other, climate) != result_key(config, climate)
+    other = copy_config(config)
+    assert result_key(other, Climate(climate.data, ['Tav'], digest='other')) != \
+            result_key(config, climate)
+
+
+def records(value):
+    return np.full(100, value, dtype=[('ws', 'f8')])
+
+
+def test_eviction_order(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    for key in 'abc':
+        cache.put(key, records(ord(key)))
+    # room for three results
+    cache.max_bytes = cache.stats()['bytes'] + 100
+    assert cache.get('a')['ws'][0] == ord('a')
+    cache.put('d', records(4))
+    assert sorted(os.listdir(str(tmp_path))) == ['a.npy', 'c.npy', 'd.npy']
+    assert cache.get('b') is None
+    cache.put('e', records(5))
+    assert sorted(cache.entries) == ['a', 'd', 'e']
+    assert cache.stats()['evictions'] == 2
+
+
+def test_eviction_counts_other_writers(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    other = ResultCache(str(tmp_path), max_bytes=1 << 20)
+    cache.put('a', records(1))
+    other.put('b', np.zeros(200000, dtype=[('ws', 'f8')]))
+    cache.max_bytes = os.path.getsize(str(tmp_path / 'b.npy'))
+    cache.put('c', records(3))
+    # the result of the other cache is found and evicted, the newest kept
+    assert sorted(os.listdir(str(tmp_path))) == ['c.npy']
+    assert cache.stats()['bytes'] == os.path.getsize(str(tmp_path / 'c.npy'))